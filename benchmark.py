@@ -0,0 +1,611 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).parent
+SRC_DIR = ROOT / "src"
+SCRIPTS_DIR = SRC_DIR / "scripts"
+
+sys.path.insert(0, str(SRC_DIR))
+from placement import HashRing, placement_key, server_id  # noqa: E402
+
+# Local cluster benchmark.
+#
+# Starts start_name_server.py and N start_file_server.py processes on
+# localhost, each from its own copy of src/ so their data, journals and
+# indexes are separate, then runs a seeded workload against them:
+#   - a PUT/GET/DELETE mix, object sizes drawn from a weighted list, a
+#     number of concurrent workers and a number of buckets to spread over
+#   - requests go straight to an object's owners, like the client does
+#   - a sample of PUTs is followed by polling the other owners until the
+#     object shows up there (replication lag)
+#   - after the run, every server's listing is polled until each one holds
+#     exactly the objects it owns (convergence)
+# Results are printed as JSON (and written to --output), so runs can be
+# compared between commits.
+#
+# Example:
+#   python benchmark.py --servers 3 --operations 2000 --concurrency 32 \
+#       --mix put=40,get=50,delete=10 --sizes 4KiB=60,256KiB=30,4MiB=10
+
+RESULT_VERSION = 1
+SIZE_REGEX = re.compile(r"^(\d+)\s*(B|KiB|MiB|GiB)?$", re.I)
+SIZE_UNITS = {"b": 1, "kib": 1024, "mib": 1024**2, "gib": 1024**3}
+OPERATIONS = ("put", "get", "delete")
+
+STARTUP_TIMEOUT = 30
+STOP_TIMEOUT = 15
+POLL_INTERVAL = 0.01
+CONVERGENCE_POLL_INTERVAL = 0.25
+REQUEST_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark a local SDS3 cluster and print JSON results."
+    )
+    cluster = parser.add_argument_group("cluster")
+    cluster.add_argument(
+        "--servers", type=int, default=3, help="File servers to start."
+    )
+    cluster.add_argument("--replication-factor", type=int, default=2)
+    cluster.add_argument("--name-server-port", type=int, default=18232)
+    cluster.add_argument(
+        "--base-port", type=int, default=18301, help="Port of the first file server."
+    )
+    cluster.add_argument(
+        "--name-server-url",
+        help="Benchmark an already running cluster instead of starting one.",
+    )
+    cluster.add_argument(
+        "--api-key", help="API key of the cluster (generated when starting one)."
+    )
+    cluster.add_argument(
+        "--keep", action="store_true", help="Keep the cluster's working directory."
+    )
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--operations", type=int, default=1000)
+    workload.add_argument(
+        "--duration", type=float, help="Stop after this many seconds instead."
+    )
+    workload.add_argument("--concurrency", type=int, default=16)
+    workload.add_argument(
+        "--mix", default="put=40,get=50,delete=10", help="Weights of each operation."
+    )
+    workload.add_argument(
+        "--sizes",
+        default="4KiB=50,64KiB=35,1MiB=15",
+        help="Object sizes and their weights.",
+    )
+    workload.add_argument("--buckets", type=int, default=4)
+    workload.add_argument(
+        "--bucket-options",
+        default="{}",
+        help='Extra bucket settings as JSON, e.g. {"compression": "zlib"}.',
+    )
+    workload.add_argument(
+        "--payload",
+        choices=["random", "text"],
+        default="random",
+        help="Incompressible bytes, or JSON-like lines.",
+    )
+    workload.add_argument(
+        "--preload", type=int, default=50, help="Objects written before the run."
+    )
+    workload.add_argument("--seed", type=int, default=0)
+    replication = parser.add_argument_group("replication")
+    replication.add_argument(
+        "--lag-sample",
+        type=float,
+        default=0.2,
+        help="Share of PUTs whose replication lag is measured.",
+    )
+    replication.add_argument("--convergence-timeout", type=float, default=60)
+    parser.add_argument("--output", help="Also write the JSON results here.")
+    return parser.parse_args()
+
+
+def parse_weights(spec: str, parse_key=str) -> list[tuple]:
+    """Parse "a=3,b=1" into [(a, 3.0), (b, 1.0)]."""
+    weights = []
+    for item in spec.split(","):
+        key, _, weight = item.partition("=")
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    return weights
+
+
+def parse_size(size: str) -> int:
+    match = SIZE_REGEX.match(size)
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+    return int(match.group(1)) * SIZE_UNITS[(match.group(2) or "B").lower()]
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+class LocalCluster:
+    """A name server and file servers running as local processes."""
+
+    def __init__(self, args, api_key: str):
+        self.servers = args.servers
+        self.name_server_port = args.name_server_port
+        self.base_port = args.base_port
+        self.keep = args.keep
+        self.work_dir = Path(tempfile.mkdtemp(prefix="sds3-bench-"))
+        self.name_server_url = f"http://127.0.0.1:{self.name_server_port}/"
+        self.env = {
+            **os.environ,
+            "NAME_SERVER_URL": self.name_server_url,
+            "API_KEY": api_key,
+            "REPLICATION_FACTOR": str(args.replication_factor),
+        }
+        self.processes = []
+
+    def start(self):
+        name_server_dir = self.install("name_server")
+        self.processes.append(
+            self.launch(
+                name_server_dir,
+                ["start_name_server.py", "--port", str(self.name_server_port)],
+            )
+        )
+        wait_for(self.name_server_url, {})
+        for i in range(self.servers):
+            port = self.base_port + i
+            server_dir = self.install(f"file_server_{port}")
+            self.processes.append(
+                self.launch(server_dir, ["start_file_server.py", "--port", str(port)])
+            )
+        for i in range(self.servers):
+            wait_for(
+                f"http://127.0.0.1:{self.base_port + i}/",
+                {"Authorization": self.env["API_KEY"]},
+            )
+
+    def install(self, name: str) -> Path:
+        """Copy the sources into a directory of their own."""
+        directory = self.work_dir / name
+        directory.mkdir()
+        for source_dir in (SRC_DIR, SCRIPTS_DIR):
+            for file in source_dir.glob("*.py"):
+                shutil.copy2(file, directory)
+        return directory
+
+    def launch(self, directory: Path, command: list[str]) -> subprocess.Popen:
+        with open(directory / "server.log", "wb") as log_file:
+            return subprocess.Popen(
+                [sys.executable, *command],
+                cwd=directory,
+                env=self.env,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+
+    def stop(self):
+        # File servers first, all at once, so they don't rebalance onto each
+        # other while shutting down
+        file_servers, name_server = self.processes[1:], self.processes[:1]
+        for processes in (file_servers, name_server):
+            for process in processes:
+                process.send_signal(signal.SIGINT)
+            for process in processes:
+                try:
+                    process.wait(STOP_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        if self.keep:
+            log(f"Cluster files kept in {self.work_dir}")
+        else:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def wait_for(url: str, headers: dict):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, headers=headers).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {STARTUP_TIMEOUT}s")
+
+
+def load_ring(name_server_url: str, replication_factor: int) -> HashRing:
+    r = httpx.get(name_server_url)
+    r.raise_for_status()
+    return HashRing(
+        [server_id(server["host"], server["port"]) for server in r.json()],
+        replication_factor,
+    )
+
+
+class Stats:
+    """Latencies, errors and bytes of one kind of operation."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    def summary(self, elapsed: float) -> dict:
+        count = len(self.latencies)
+        return {
+            "count": count,
+            "errors": self.errors,
+            "ops_per_second": round(count / elapsed, 2) if elapsed else None,
+            "mb_per_second": round(self.bytes / elapsed / 1e6, 3) if elapsed else None,
+            "latency_ms": latency_summary(self.latencies),
+        }
+
+
+def latency_summary(latencies: list[float]) -> dict | None:
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return {
+        "p50": round(percentile(ordered, 50) * 1000, 3),
+        "p95": round(percentile(ordered, 95) * 1000, 3),
+        "p99": round(percentile(ordered, 99) * 1000, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def percentile(ordered: list[float], p: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    rank = max(int(-(-p * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+class Benchmark:
+    def __init__(self, args, ring: HashRing, api_key: str):
+        self.args = args
+        self.ring = ring
+        self.rng = random.Random(args.seed)
+        self.mix = parse_weights(args.mix)
+        self.sizes = parse_weights(args.sizes, parse_size)
+        self.bucket_options = json.loads(args.bucket_options)
+        self.buckets = [f"bench{i}" for i in range(args.buckets)]
+        self.headers = {"Authorization": api_key}
+        self.sync_headers = {**self.headers, "X-Sync": "true"}
+        # Objects known to exist, per bucket. Names are never reused, and a
+        # DELETE takes its object out before it is sent, so nothing reads an
+        # object that is going away.
+        self.live = {bucket: [] for bucket in self.buckets}
+        # A GET can still be in flight when its object is deleted; its 404
+        # isn't an error
+        self.deleted = set()
+        self.next_object = 0
+        self.stats = {operation: Stats() for operation in OPERATIONS}
+        self.lag_tasks = []
+        self.lags = []
+        self.unreplicated = 0
+
+    @property
+    def replicated(self) -> bool:
+        return self.bucket_options.get("storage_mode", "replicated") == "replicated"
+
+    def owner_urls(self, bucket: str, name: str) -> list[str]:
+        return [
+            f"http://{owner}/"
+            for owner in self.ring.owners(placement_key(bucket, name))
+        ]
+
+    async def run(self, client: httpx.AsyncClient) -> dict:
+        await self.create_buckets(client)
+        for _ in range(self.args.preload):
+            await self.put(client, self.rng.choice(self.buckets), record=False)
+        log(f"Running with {self.args.concurrency} workers")
+        plan = self.plan()
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(self.worker(client, plan) for _ in range(self.args.concurrency))
+        )
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*self.lag_tasks)
+        convergence = await self.wait_for_convergence(client)
+        all_stats = Stats()
+        for stats in self.stats.values():
+            all_stats.latencies += stats.latencies
+            all_stats.errors += stats.errors
+            all_stats.bytes += stats.bytes
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "operations": {
+                **{name: stats.summary(elapsed) for name, stats in self.stats.items()},
+                "all": all_stats.summary(elapsed),
+            },
+            "replication": {
+                "lag_samples": len(self.lags),
+                "unreplicated_samples": self.unreplicated,
+                "lag_ms": latency_summary(self.lags),
+                "convergence_seconds": convergence,
+            },
+        }
+
+    def plan(self):
+        """The seeded sequence of (operation, bucket, size) the workers share."""
+        operations, operation_weights = zip(*self.mix)
+        sizes, size_weights = zip(*self.sizes)
+        deadline = time.monotonic() + self.args.duration if self.args.duration else None
+        count = 0
+        while (deadline is None and count < self.args.operations) or (
+            deadline is not None and time.monotonic() < deadline
+        ):
+            count += 1
+            yield (
+                self.rng.choices(operations, operation_weights)[0],
+                self.rng.choice(self.buckets),
+                self.rng.choices(sizes, size_weights)[0],
+            )
+
+    async def worker(self, client: httpx.AsyncClient, plan):
+        for operation, bucket, size in plan:
+            if operation != "put" and not self.live[bucket]:
+                operation = "put"
+            if operation == "put":
+                await self.put(client, bucket, size)
+            elif operation == "get":
+                await self.get(client, bucket)
+            else:
+                await self.delete(client, bucket)
+
+    async def create_buckets(self, client: httpx.AsyncClient):
+        first_server = f"http://{self.ring.servers[0]}/"
+        for bucket in self.buckets:
+            r = await client.post(
+                first_server, json={"dir_name": bucket, **self.bucket_options}
+            )
+            r.raise_for_status()
+        # Buckets are replicated to every server before objects can land
+        for server in self.ring.servers:
+            for bucket in self.buckets:
+                while (
+                    await client.get(
+                        f"http://{server}/{bucket}", headers=self.sync_headers
+                    )
+                ).status_code != 200:
+                    await asyncio.sleep(POLL_INTERVAL)
+
+    async def put(
+        self, client: httpx.AsyncClient, bucket: str, size: int = 4096, record=True
+    ):
+        name = f"obj-{self.next_object:08d}"
+        self.next_object += 1
+        payload = self.payload(size)
+        owner_urls = self.owner_urls(bucket, name)
+        start = time.perf_counter()
+        try:
+            r = await client.post(
+                f"{owner_urls[0]}{bucket}", files={"file": (name, payload)}
+            )
+            ok = r.status_code == 200 and r.json().get("status") == "ok"
+        except httpx.HTTPError:
+            ok = False
+        done = time.perf_counter()
+        if record:
+            self.record("put", done - start, ok, size)
+        if not ok:
+            return
+        self.live[bucket].append(name)
+        if record and self.replicated and self.rng.random() < self.args.lag_sample:
+            self.lag_tasks.append(
+                asyncio.create_task(
+                    self.measure_lag(client, bucket, name, owner_urls[1:], done)
+                )
+            )
+
+    async def get(self, client: httpx.AsyncClient, bucket: str):
+        """Read a random object, failing over to the next owner like the
+        client does when one doesn't have it yet."""
+        name = self.rng.choice(self.live[bucket])
+        owner_urls = self.owner_urls(bucket, name)
+        self.rng.shuffle(owner_urls)
+        start = time.perf_counter()
+        ok = False
+        for owner_url in owner_urls:
+            size = 0
+            try:
+                async with client.stream("GET", f"{owner_url}{bucket}/{name}.enc") as r:
+                    async for chunk in r.aiter_bytes():
+                        size += len(chunk)
+                ok = r.status_code == 200
+            except httpx.HTTPError:
+                pass
+            if ok:
+                break
+        if not ok and (bucket, name) in self.deleted:
+            return
+        self.record("get", time.perf_counter() - start, ok, size)
+
+    async def delete(self, client: httpx.AsyncClient, bucket: str):
+        names = self.live[bucket]
+        index = self.rng.randrange(len(names))
+        names[index], names[-1] = names[-1], names[index]
+        name = names.pop()
+        self.deleted.add((bucket, name))
+        owner_url = self.owner_urls(bucket, name)[0]
+        start = time.perf_counter()
+        try:
+            r = await client.delete(f"{owner_url}{bucket}/{name}.enc")
+            ok = r.status_code == 200 and r.json().get("status") == "ok"
+        except httpx.HTTPError:
+            ok = False
+        self.record("delete", time.perf_counter() - start, ok, 0)
+
+    def record(self, operation: str, latency: float, ok: bool, size: int):
+        stats = self.stats[operation]
+        if ok:
+            stats.latencies.append(latency)
+            stats.bytes += size
+        else:
+            stats.errors += 1
+
+    def payload(self, size: int) -> bytes:
+        if self.args.payload == "random":
+            return self.rng.randbytes(size)
+        lines = []
+        length = 0
+        while length < size:
+            line = json.dumps(
+                {
+                    "id": self.rng.randrange(10**6),
+                    "user": f"user{self.rng.randrange(1000)}",
+                    "score": round(self.rng.random() * 100, 2),
+                    "tags": self.rng.sample(["red", "green", "blue", "gold"], 2),
+                }
+            )
+            lines.append(line)
+            length += len(line) + 1
+        return "\n".join(lines).encode()[:size]
+
+    async def measure_lag(
+        self,
+        client: httpx.AsyncClient,
+        bucket: str,
+        name: str,
+        replica_urls: list[str],
+        written_at: float,
+    ):
+        """Time from a PUT's response until every other owner has the object."""
+        deadline = written_at + self.args.convergence_timeout
+        for replica_url in replica_urls:
+            while True:
+                try:
+                    r = await client.get(
+                        f"{replica_url}{bucket}/{name}.enc",
+                        headers={**self.sync_headers, "Range": "bytes=0-0"},
+                    )
+                    if r.status_code in (200, 206):
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.perf_counter() > deadline:
+                    self.unreplicated += 1
+                    return
+                await asyncio.sleep(POLL_INTERVAL)
+        self.lags.append(time.perf_counter() - written_at)
+
+    async def wait_for_convergence(self, client: httpx.AsyncClient) -> float | None:
+        """Seconds after the run until every server holds exactly the
+        objects it owns, or None if that doesn't happen in time."""
+        if not self.replicated:
+            return None
+        start = time.perf_counter()
+        expected = {server: set() for server in self.ring.servers}
+        for bucket, names in self.live.items():
+            for name in names:
+                for owner in self.ring.owners(placement_key(bucket, name)):
+                    expected[owner].add(f"{bucket}/{name}.enc")
+        while time.perf_counter() - start < self.args.convergence_timeout:
+            stored = await asyncio.gather(
+                *(self.stored_objects(client, server) for server in expected)
+            )
+            if all(
+                expected[server] == objects for server, objects in zip(expected, stored)
+            ):
+                return round(time.perf_counter() - start, 3)
+            await asyncio.sleep(CONVERGENCE_POLL_INTERVAL)
+        return None
+
+    async def stored_objects(self, client: httpx.AsyncClient, server: str) -> set:
+        """Every object stored on one server, from its local listings."""
+        objects = set()
+        for bucket in self.buckets:
+            params = {}
+            while True:
+                r = await client.get(
+                    f"http://{server}/{bucket}",
+                    params=params,
+                    headers=self.sync_headers,
+                )
+                if r.status_code != 200:
+                    break
+                page = r.json()
+                objects.update(f"{bucket}/{item['name']}" for item in page["contents"])
+                if not page["is_truncated"]:
+                    break
+                params = {"continuation_token": page["next_continuation_token"]}
+        return objects
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args, name_server_url: str, api_key: str) -> dict:
+    ring = load_ring(name_server_url, args.replication_factor)
+    log(f"Cluster: {', '.join(ring.servers)}")
+    benchmark = Benchmark(args, ring, api_key)
+    async with httpx.AsyncClient(
+        headers=benchmark.headers,
+        timeout=REQUEST_TIMEOUT,
+        limits=httpx.Limits(max_connections=args.concurrency * 2),
+    ) as client:
+        return await benchmark.run(client)
+
+
+def main():
+    args = parse_args()
+    api_key = args.api_key or secrets.token_hex(32)
+    config = {
+        key: value for key, value in vars(args).items() if key not in ("api_key",)
+    }
+    result = {
+        "version": RESULT_VERSION,
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "config": config,
+    }
+    cluster = None
+    try:
+        if args.name_server_url:
+            if not args.api_key:
+                exit("Error: --api-key is required with --name-server-url")
+            name_server_url = args.name_server_url
+        else:
+            cluster = LocalCluster(args, api_key)
+            log(f"Starting {args.servers} file servers in {cluster.work_dir}")
+            cluster.start()
+            name_server_url = cluster.name_server_url
+        result.update(asyncio.run(run_benchmark(args, name_server_url, api_key)))
+    finally:
+        if cluster is not None:
+            cluster.stop()
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,23 @@ ROOT = Path(__file__).parent
 SRC_DIR = Path(f"{ROOT}{os.path.sep}src")
 SCRIPTS_DIR = Path(f"{ROOT}{os.path.sep}src{os.path.sep}scripts")
 
+# Modules imported by the servers and the client alongside their main file
+FILE_SERVER_MODULES = [
+    "object_format.py",
+    "journal.py",
+    "metadata.py",
+    "placement.py",
+    "erasure.py",
+    "object_cache.py",
+    "metrics.py",
+    "replication.py",
+    "segments.py",
+    "chunks.py",
+    "versions.py",
+]
+NAME_SERVER_MODULES = ["metrics.py"]
+CLIENT_MODULES = ["object_format.py", "placement.py"]
+
 OUT_DIR = Path("./out")
 OUT_FILE_SERVER_DIR = Path(f"{ROOT}{os.path.sep}out{os.path.sep}file_server")
 OUT_NAME_SERVER_DIR = Path(f"{ROOT}{os.path.sep}out{os.path.sep}name_server")
@@ -32,6 +49,13 @@ for file in SRC_DIR.iterdir():
     elif file.name == "client.py":
         shutil.copy2(file.resolve(), OUT_DIR.resolve())
 
+    if file.name in FILE_SERVER_MODULES:
+        shutil.copy2(file.resolve(), OUT_FILE_SERVER_DIR.resolve())
+    if file.name in NAME_SERVER_MODULES:
+        shutil.copy2(file.resolve(), OUT_NAME_SERVER_DIR.resolve())
+    if file.name in CLIENT_MODULES:
+        shutil.copy2(file.resolve(), OUT_DIR.resolve())
+
 for file in SCRIPTS_DIR.iterdir():
     if file.name == "start_file_server.py":
         shutil.copy2(file.resolve(), OUT_FILE_SERVER_DIR.resolve())
@@ -0,0 +1,319 @@
+import functools
+import hashlib
+import hmac
+import struct
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from object_format import (
+    CODEC_NONE,
+    FLAG_COMPOSITE_DIGEST,
+    FLAG_VARIABLE_FRAMES,
+    FRAME_OVERHEAD,
+    VERSION,
+    Manifest,
+    ObjectHeader,
+    digest_mac,
+    frame_aad,
+    looks_compressed,
+    map_frames,
+    seal_frame,
+)
+from segments import SegmentStore
+
+# Deduplicated storage.
+#
+# Objects in a dedup bucket are cut into content-defined chunks, so an
+# insertion or deletion only changes the chunks around it and the rest
+# line up with those of the earlier version. Each byte is given one bit,
+# the XOR of fixed pseudo-random tables applied to it and the MIXED_BYTES - 1
+# bytes before it, and a boundary falls wherever the bits of the last
+# BOUNDARY_BITS bytes (a rolling hash of them) take one fixed value. Mixing
+# neighbouring bytes keeps the bits balanced for skewed data such as text.
+# The bits are computed with bytes.translate and big-integer XOR and the
+# value is searched for with find, so chunking runs at C speed. Chunks are
+# MIN_CHUNK_SIZE to MAX_CHUNK_SIZE bytes, about 32 KiB on average.
+#
+# A chunk's id is an HMAC of its plaintext (and codec and format version)
+# under the API key, so ids don't reveal what the chunks hold. Each chunk is sealed as one
+# frame, appended to the chunk segments the first time it is seen and
+# indexed with a count of the objects that refer to it. The object itself
+# is stored as a manifest listing its chunks (see object_format).
+#
+# A chunk nothing refers to any more is dropped from the index once it has
+# been unreferenced for a grace period, unless an upload in progress has
+# pinned it, and compaction then reclaims its space. The grace period
+# covers chunks a peer sent ahead of the manifest that refers to them.
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+BOUNDARY_BITS = 14
+MIXED_BYTES = 4
+
+_random = hashlib.shake_256(b"sds3 chunk boundaries").digest(
+    256 * MIXED_BYTES + BOUNDARY_BITS
+)
+BIT_TABLES = [
+    bytes(byte & 1 for byte in _random[256 * i : 256 * (i + 1)])
+    for i in range(MIXED_BYTES)
+]
+BOUNDARY = bytes(byte & 1 for byte in _random[256 * MIXED_BYTES :])
+
+# Chunks are sent between servers as records of id | stored size | frame
+CHUNK_RECORD = struct.Struct("<32sI")
+CHUNK_SEGMENT_BUCKET = "chunks"
+
+
+class Chunker:
+    """Cuts a stream into content-defined chunks."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # One bit (a 0 or 1 byte) per byte of buffer
+        self.bits = bytearray()
+        self.tail = bytes(MIXED_BYTES - 1)
+
+    def feed(self, data: bytes) -> list[bytes]:
+        self.buffer += data
+        self.bits += mix_bits(self.tail + data)
+        self.tail = (self.tail + data)[-(MIXED_BYTES - 1) :]
+        return self._cut(final=False)
+
+    def finish(self) -> list[bytes]:
+        return self._cut(final=True)
+
+    def _cut(self, final: bool) -> list[bytes]:
+        chunks = []
+        start = 0
+        while start < len(self.buffer):
+            window_end = min(start + MAX_CHUNK_SIZE, len(self.buffer))
+            found = self.bits.find(
+                BOUNDARY, start + MIN_CHUNK_SIZE - BOUNDARY_BITS, window_end
+            )
+            if found >= 0:
+                end = found + BOUNDARY_BITS
+            elif window_end - start == MAX_CHUNK_SIZE or final:
+                end = window_end
+            else:
+                # The boundary may be in data that hasn't arrived yet
+                break
+            chunks.append(bytes(self.buffer[start:end]))
+            start = end
+        del self.buffer[:start]
+        del self.bits[:start]
+        return chunks
+
+
+def mix_bits(data: bytes) -> bytes:
+    """The bit of every byte of data after the first MIXED_BYTES - 1, which
+    only serve as the bytes before it."""
+    length = len(data) - MIXED_BYTES + 1
+    if length <= 0:
+        return b""
+    mixed = 0
+    for back, table in enumerate(BIT_TABLES):
+        start = MIXED_BYTES - 1 - back
+        mixed ^= int.from_bytes(data[start : start + length].translate(table), "big")
+    return mixed.to_bytes(length, "big")
+
+
+def chunk_id(key: bytes, codec: int, plaintext: bytes) -> bytes:
+    # The codec and version are part of the id: the stored frame depends
+    # on them
+    mac = hmac.new(key, bytes([codec, VERSION]), hashlib.sha256)
+    mac.update(plaintext)
+    return mac.digest()
+
+
+class ChunkStore:
+    """Sealed chunks in their own segments, located through the index."""
+
+    def __init__(self, segments: SegmentStore, index):
+        self.segments = segments
+        self.index = index
+        self.lock = threading.Lock()
+        self.pinned = Counter()
+
+    @contextmanager
+    def pins(self):
+        """A set of chunk ids that aren't dropped while the block runs."""
+        pinned = set()
+        try:
+            yield pinned
+        finally:
+            with self.lock:
+                self.pinned.subtract(pinned)
+                # Adding an empty Counter drops the ids that reached zero
+                self.pinned += Counter()
+
+    def claim(self, pinned: set, chunk_ids: list[bytes]) -> set[bytes]:
+        """Pin chunks; returns those already stored."""
+        with self.lock:
+            for chunk_id in set(chunk_ids) - pinned:
+                pinned.add(chunk_id)
+                self.pinned[chunk_id] += 1
+            return set(chunk_ids) - set(self.index.missing_chunks(chunk_ids))
+
+    def put(self, chunks: list[tuple[bytes, bytes]]):
+        """Store (id, frame) pairs."""
+        locations = [
+            (
+                chunk_id,
+                len(frame),
+                self.segments.append(
+                    CHUNK_SEGMENT_BUCKET, chunk_id.hex(), frame, time.time()
+                ),
+            )
+            for chunk_id, frame in chunks
+        ]
+        self.index.put_chunks(locations)
+
+    def missing(self, chunk_ids: list[bytes]) -> list[bytes]:
+        return self.index.missing_chunks(chunk_ids)
+
+    def read(self, chunk_ids: list[bytes]):
+        """Yield the frames of chunk_ids in order.
+
+        Raises FileNotFoundError if one is gone.
+        """
+        locations = self.index.chunk_locations(chunk_ids)
+        for chunk_id in chunk_ids:
+            frame = self._read(chunk_id, locations.get(chunk_id))
+            if frame is None:
+                # Looked up again in case compaction moved it in between
+                location = self.index.chunk_locations([chunk_id]).get(chunk_id)
+                frame = self._read(chunk_id, location)
+            if frame is None:
+                raise FileNotFoundError(f"Chunk {chunk_id.hex()}")
+            yield frame
+
+    def _read(self, chunk_id: bytes, location: tuple | None) -> bytes | None:
+        if location is None:
+            return None
+        stored_size, segment, offset = location
+        return self.segments.read(
+            segment, offset, CHUNK_SEGMENT_BUCKET, chunk_id.hex(), stored_size
+        )
+
+    def stored_sizes(self, chunk_ids: list[bytes]) -> dict[bytes, int]:
+        return {
+            chunk_id: location[0]
+            for chunk_id, location in self.index.chunk_locations(chunk_ids).items()
+        }
+
+    def collect(self, released_before: float) -> int:
+        """Drop chunks unreferenced since before released_before; returns
+        how many."""
+        with self.lock:
+            return self.index.drop_chunks(released_before, set(self.pinned))
+
+    def compact(self, compact_ratio: float):
+        """Rewrite the chunk segments that are mostly dropped chunks."""
+        usage = self.index.chunk_segment_usage()
+        for segment, size in self.segments.sealed_segments().items():
+            if usage.get(segment, 0) < size * compact_ratio:
+                self.segments.compact(
+                    segment,
+                    self.index.chunk_offsets(segment),
+                    self.index.move_chunk,
+                )
+
+    def total_size(self) -> int:
+        return self.segments.total_size()
+
+
+class ChunkWriter:
+    """Stores a plaintext stream as deduplicated chunks and writes its
+    manifest to file.
+
+    Used like ObjectWriter. Only chunks the store doesn't hold yet are
+    sealed (by the executor's workers, in parallel) and stored, and every
+    chunk the object uses is pinned in pinned until the caller has indexed
+    the manifest.
+    """
+
+    def __init__(
+        self,
+        file,
+        key: bytes,
+        store: ChunkStore,
+        pinned: set,
+        codec: int = CODEC_NONE,
+        level: int | None = None,
+        executor=None,
+    ):
+        self.file = file
+        self.key = key
+        self.store = store
+        self.pinned = pinned
+        self.level = level
+        self.executor = executor
+        self.header = ObjectHeader(
+            codec=codec, flags=FLAG_VARIABLE_FRAMES, frame_size=MAX_CHUNK_SIZE
+        )
+        self.chunker = Chunker()
+        self.digest = digest_mac(key)
+        self.entries = []
+
+    def write(self, data: bytes):
+        self.digest.update(data)
+        self.header.plaintext_size += len(data)
+        self._write_chunks(self.chunker.feed(data))
+
+    def close(self, digest: bytes | None = None) -> ObjectHeader:
+        """Write the manifest. A multipart upload passes its composite
+        digest, which stands in for the plaintext's."""
+        self._write_chunks(self.chunker.finish())
+        self.header.digest = self.digest.digest()
+        if digest is not None:
+            self.header.digest = digest
+            self.header.flags |= FLAG_COMPOSITE_DIGEST
+        self.file.write(Manifest(self.header, self.entries).pack())
+        return self.header
+
+    def _write_chunks(self, plaintexts: list[bytes]):
+        if not plaintexts:
+            return
+        # The first chunk decides whether the object is worth compressing
+        if self.header.codec != CODEC_NONE and not self.entries:
+            if looks_compressed(plaintexts[0]):
+                self.header.codec = CODEC_NONE
+        ids = [chunk_id(self.key, self.header.codec, chunk) for chunk in plaintexts]
+        stored = self.store.claim(self.pinned, ids)
+        new = {}
+        for id_, plaintext in zip(ids, plaintexts):
+            if id_ not in stored:
+                new.setdefault(id_, plaintext)
+        seal = functools.partial(
+            seal_frame, key=self.key, codec=self.header.codec, level=self.level
+        )
+        # Chunk frames all have the same associated data
+        aads = [frame_aad(self.header, 0)] * len(new)
+        frames = map_frames(self.executor, seal, list(new.values()), aads)
+        self.store.put(list(zip(new, frames)))
+        self.entries += [(id_, len(chunk)) for id_, chunk in zip(ids, plaintexts)]
+
+
+def pack_chunk_records(chunks: list[tuple[bytes, bytes]]) -> bytes:
+    return b"".join(
+        CHUNK_RECORD.pack(chunk_id, len(frame)) + frame for chunk_id, frame in chunks
+    )
+
+
+def unpack_chunk_records(data: bytes) -> list[tuple[bytes, bytes]]:
+    """Parse (id, frame) records, raising ValueError if one is malformed."""
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        if offset + CHUNK_RECORD.size > len(data):
+            raise ValueError("Truncated chunk record")
+        chunk_id, size = CHUNK_RECORD.unpack_from(data, offset)
+        offset += CHUNK_RECORD.size
+        frame = data[offset : offset + size]
+        if len(frame) != size or size < FRAME_OVERHEAD:
+            raise ValueError("Truncated chunk record")
+        chunks.append((chunk_id, frame))
+        offset += size
+    return chunks
@@ -1,110 +1,464 @@
 import argparse
+import asyncio
+import json
+import os
+import random
 import re
+import sys
+import tarfile
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from io import BytesIO
-from Crypto.Cipher import AES
+from urllib.parse import urlencode
 
 import httpx
 
+from object_format import FRAME_SIZE, ObjectDecoder, composite_digest, digest_mac
+from placement import DEFAULT_REPLICATION_FACTOR, HashRing, placement_key, server_id
+
 REST_URL = "http://127.0.0.1:8231"
 
+# With a name server, object requests go straight to one of the object's
+# owners on the placement ring; bucket requests and everything else go to
+# REST_URL.
+NAME_SERVER_URL = os.environ.get("NAME_SERVER_URL")
+REPLICATION_FACTOR = int(
+    os.environ.get("REPLICATION_FACTOR", DEFAULT_REPLICATION_FACTOR)
+)
+ring: HashRing | None = None
+
+# Reads go to the replica with the best moving-average latency among those
+# with a low recent error rate. If it hasn't answered within a few times its
+# usual latency, the next replica is asked too (a hedged request) and the
+# first answer wins. Errors, timeouts and 404s fail over to the next replica.
+LATENCY_ALPHA = 0.2
+ERROR_ALPHA = 0.3
+UNHEALTHY_ERROR_RATE = 0.5
+ERROR_PENALTY = 4
+DEFAULT_LATENCY = 0.1
+HEDGE_LATENCY_MULTIPLE = 3
+MIN_HEDGE_DELAY = 0.05
+# Share of reads sent to a random healthy replica, so the averages of the
+# others don't go stale
+EXPLORE_PROBABILITY = 0.05
+
 BUCKET_REGEX = re.compile(r"/\w+\/?$|\/$", re.I)
 FILENAME_REGEX = re.compile(r'filename="(.+)"')
 BANNED_CHARS_REGEX = re.compile(r"\/:*?\"<>\|")
+RANGE_REGEX = re.compile(r"^(\d+-\d*|-\d+)$")
 
 PARENT_DIR = Path(__file__).parent
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Downloads are decrypted in worker threads, CRYPTO_WORKERS frames at a
+# time, so the event loop keeps serving hedged requests and timers
+CRYPTO_WORKERS = int(os.environ.get("CRYPTO_WORKERS", os.cpu_count() or 1))
+crypto_pool = ThreadPoolExecutor(CRYPTO_WORKERS, thread_name_prefix="crypto")
+
+# ETags of downloaded objects, keyed by local path, so an unchanged object
+# isn't downloaded again. An entry only counts while the local file keeps
+# the size and modification time it was saved with.
+ETAGS_PATH = PARENT_DIR / ".etags.json"
+
+# Parts must be whole frames so the server can join them without
+# re-encrypting
+MULTIPART_PART_SIZE = 128 * FRAME_SIZE
+MULTIPART_CONCURRENCY = 8
+PART_RETRIES = 3
 headers = {}
 
+# Every command runs over a pooled client with up to concurrency
+# connections; requests beyond that wait for a free one however long it
+# takes. In batch mode (--batch) commands on different objects run at the
+# same time over one client.
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 16))
+TRANSFER_TIMEOUT = httpx.Timeout(60.0, connect=5.0, pool=None)
+concurrency = BATCH_CONCURRENCY
+
+# sync skips files the bucket holds with the same size and digest. The
+# others are sent as tar streams of up to SYNC_BATCH_FILES files and
+# SYNC_BATCH_BYTES bytes, except files of a part or more, which are
+# uploaded in parts.
+SYNC_BATCH_FILES = 256
+SYNC_BATCH_BYTES = 64 * 1024 * 1024
+LIST_PAGE_SIZE = 1000
+
+# A new bucket reaches the other servers through replication, so creating
+# one waits until they all have it, for up to BUCKET_WAIT_TIMEOUT seconds
+BUCKET_WAIT_TIMEOUT = 10
+BUCKET_WAIT_INTERVAL = 0.05
+
+# Totals of the batch or sync in progress, if any
+progress = None
+
+
+class ServerStats:
+    """Moving averages of one server's response time and error rate."""
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+
+    def record_success(self, latency: float):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_ALPHA * (latency - self.latency)
+        self.error_rate *= 1 - ERROR_ALPHA
+
+    def record_error(self):
+        self.error_rate += ERROR_ALPHA * (1 - self.error_rate)
+
+    @property
+    def healthy(self) -> bool:
+        return self.error_rate < UNHEALTHY_ERROR_RATE
+
+    @property
+    def expected_latency(self) -> float:
+        return DEFAULT_LATENCY if self.latency is None else self.latency
+
+    def score(self) -> float:
+        return self.expected_latency * (1 + ERROR_PENALTY * self.error_rate)
+
+
+server_stats = defaultdict(ServerStats)
+
+
+class Progress:
+    """Finished items and bytes transferred so far in a batch or sync.
+
+    Transfers inside it add to its byte count (and that of the batch or
+    sync it runs in) instead of printing their own throughput.
+    """
+
+    def __init__(self, total: int, parent=None):
+        self.total = total
+        self.parent = parent
+        self.done = 0
+        self.num_bytes = 0
+        self.start = time.perf_counter()
+
+    def add_bytes(self, num_bytes: int):
+        self.num_bytes += num_bytes
+        if self.parent is not None:
+            self.parent.add_bytes(num_bytes)
+
+    def finish(self, message: str, count: int = 1):
+        self.done += count
+        print(f"[{self.done}/{self.total}] {message}")
+
+    def summary(self, noun: str) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        megabytes = self.num_bytes / 1_000_000
+        return (
+            f"{self.done} {noun} in {elapsed:.2f}s ({self.done / elapsed:.1f}/s), "
+            f"{megabytes:.2f} MB transferred ({megabytes / elapsed:.2f} MB/s)"
+        )
+
+
+class Command:
+    """A parsed command line.
+
+    keys are the objects and local files it reads or writes, so batch
+    mode can run it alongside commands on other objects and files. None
+    means it may touch any object of a bucket, so it runs on its own.
+    """
+
+    def __init__(self, function, args: tuple, keys: set[str] | None = None):
+        self.function = function
+        self.args = args
+        self.keys = keys
+
+    async def run(self, client: httpx.AsyncClient):
+        return await self.function(client, *self.args)
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Script that requires an API key.")
     parser.add_argument("--api_key", type=str, help="API key")
+    parser.add_argument(
+        "--batch",
+        type=str,
+        help="Run the commands in this file (- for stdin) instead of prompting",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=BATCH_CONCURRENCY,
+        help="Requests in flight at once",
+    )
 
     args = parser.parse_args()
 
     if not args.api_key:
         print("Error: API key is required.")
         exit(1)
-    global headers
+    global headers, concurrency
     headers = {"Authorization": args.api_key}
+    concurrency = max(args.concurrency, 1)
+    load_ring()
+
+    if args.batch is not None:
+        try:
+            lines = read_batch(args.batch)
+        except OSError:
+            print("Error: Batch file does not exist.")
+            exit(1)
+        asyncio.run(run_batch(lines))
+        return
 
     while user_input := input("Enter command: "):
         # get /
         # post / test_dir
         # post /testdir ./test_upload.pdf
         # delete /testdir/test_upload.pdf
-        user_input = user_input.strip()
-        type = user_input.split(" ")[0]
-        match type:
-            case "exit":
-                exit(1)
+        # sync ./local_dir /testdir
+        if user_input.strip() == "exit":
+            exit(1)
+        try:
+            command = parse_command(user_input)
+        except ValueError as e:
+            print(e)
+            continue
+        print(asyncio.run(with_client(command.run)))
+
+
+def parse_command(user_input: str) -> Command:
+    """Parse a command line, raising ValueError with what is wrong with it."""
+    args = user_input.strip().split(" ")
+    try:
+        match args[0]:
             case "get":
-                try:
-                    server_side_path = user_input.split(" ")[1]
-                except IndexError:
-                    print("Not enough arguments")
-                    continue
-                handle_get("".join(server_side_path))
+                # get /bucket/object --range 0-4095
+                server_side_path = args[1]
+                byte_range = (
+                    args[args.index("--range") + 1] if "--range" in args else None
+                )
+                if byte_range is not None and not RANGE_REGEX.match(byte_range):
+                    raise ValueError(
+                        "Range must look like start-end, start- or -suffix_length"
+                    )
+                if BUCKET_REGEX.match(server_side_path):
+                    return Command(get_dir, (server_side_path,))
+                # Downloads of objects with the same name, from any bucket,
+                # write the same local file
+                return Command(
+                    get_obj,
+                    (server_side_path, byte_range),
+                    {
+                        object_key(server_side_path),
+                        local_key(download_path(server_side_path)),
+                    },
+                )
             case "post":
+                # post /bucket ./file --multipart --concurrency 8
+                server_side_path = args[1]
+                local_path = args[2]
                 try:
-                    server_side_path = user_input.split(" ")[1]
-                    local_path = user_input.split(" ")[2]
-                except IndexError:
-                    print("Not enough arguments")
-                    continue
-                handle_post("".join(server_side_path), "".join(local_path))
+                    part_concurrency = (
+                        int(args[args.index("--concurrency") + 1])
+                        if "--concurrency" in args
+                        else MULTIPART_CONCURRENCY
+                    )
+                except ValueError:
+                    raise ValueError("Not enough arguments")
+                if server_side_path == "/":
+                    return Command(post_dir, (server_side_path, local_path))
+                keys = {
+                    object_key(f"{server_side_path}/{Path(local_path).name}.enc"),
+                    local_key(Path(local_path)),
+                }
+                if "--multipart" in args:
+                    return Command(
+                        post_obj_multipart,
+                        (server_side_path, local_path, max(part_concurrency, 1)),
+                        keys,
+                    )
+                return Command(post_obj, (server_side_path, local_path), keys)
+            case "delete-many":
+                # delete-many /bucket object1.enc object2.enc ...
+                if len(args) < 3:
+                    raise IndexError
+                return Command(delete_many, (args[1], args[2:]))
+            case "put-dir":
+                # put-dir /bucket ./local_dir
+                return Command(put_dir, (args[1], args[2]))
+            case "sync":
+                # sync ./local_dir /bucket
+                return Command(sync_dir, (args[1], args[2]))
             case "delete":
-                try:
-                    server_side_path = user_input.split(" ")[1]
-                except IndexError:
-                    print("Not enough arguments")
-                    continue
-                handle_del("".join(server_side_path))
+                server_side_path = args[1]
+                if BUCKET_REGEX.match(server_side_path):
+                    return Command(delete_path, (server_side_path,))
+                return Command(
+                    delete_path, (server_side_path,), {object_key(server_side_path)}
+                )
             case _:
-                print("Command not recognized")
-                continue
+                raise ValueError("Command not recognized")
+    except IndexError:
+        raise ValueError("Not enough arguments")
 
 
-def handle_get(server_side_path: str):
-    if BUCKET_REGEX.match(server_side_path):
-        res = get_dir(server_side_path)
-    else:
-        res = get_obj(server_side_path)
-    print(res)
+def object_key(server_side_path: str) -> str:
+    return "/" + server_side_path.strip("/")
 
 
-def handle_post(server_side_path: str, local_path: str):
-    if server_side_path == "/":
-        res = post_dir(server_side_path, local_path)
-        print(res)
-    else:
-        res = post_obj(server_side_path, local_path)
-        print(res)
+def local_key(path: Path) -> str:
+    # Object keys start with /, so the two never collide
+    return f"file:{path.resolve()}"
+
+
+def download_path(server_side_path: str) -> Path:
+    """Local file a download of an object is written to."""
+    return PARENT_DIR / Path(server_side_path).name.removesuffix(".enc")
+
+
+def read_batch(path: str) -> list[str]:
+    if path == "-":
+        return sys.stdin.read().splitlines()
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def new_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    return httpx.AsyncClient(
+        headers=headers,
+        limits=limits,
+        timeout=TRANSFER_TIMEOUT,
+        follow_redirects=True,
+    )
+
+
+async def with_client(function, *args):
+    async with new_client() as client:
+        return await function(client, *args)
+
 
+async def run_batch(lines: list[str]):
+    """Run a list of commands over one pooled client.
 
-def handle_del(command: str):
-    r = httpx.delete((f"{REST_URL}{command}"), headers=headers)
+    Up to concurrency commands run at once. A command waits for the
+    earlier ones on the same object or local file, and one that may touch
+    any object
+    waits for everything before it and holds back everything after it.
+    Each result is printed, with its line number, as it comes in.
+    """
+    global progress
+    commands = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line == "exit":
+            break
+        try:
+            commands.append((line_number, parse_command(line)))
+        except ValueError as e:
+            print(f"line {line_number}: {e}")
+
+    progress = Progress(len(commands))
+    semaphore = asyncio.Semaphore(concurrency)
+    running = set()
+    last_use = {}
+    try:
+        async with new_client() as client:
+            for line_number, command in commands:
+                if command.keys is None:
+                    if running:
+                        await asyncio.wait(running)
+                    await semaphore.acquire()
+                    await run_batch_command(client, semaphore, line_number, command)
+                    continue
+                after = {last_use[key] for key in command.keys if key in last_use}
+                await semaphore.acquire()
+                task = asyncio.create_task(
+                    run_batch_command(client, semaphore, line_number, command, after)
+                )
+                running.add(task)
+                task.add_done_callback(running.discard)
+                last_use.update(dict.fromkeys(command.keys, task))
+            if running:
+                await asyncio.wait(running)
+        print(progress.summary("commands"))
+    finally:
+        progress = None
+
+
+async def run_batch_command(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    line_number: int,
+    command: Command,
+    after: set = frozenset(),
+):
+    """Run a command once the ones in after are done; the caller acquired
+    the semaphore for it."""
+    try:
+        if after:
+            await asyncio.wait(after)
+        try:
+            result = await command.run(client)
+        except Exception as e:
+            # Reported like any other result rather than lost with the task
+            result = f"Error: {e!r}"
+        progress.finish(f"line {line_number}: {result}")
+    finally:
+        semaphore.release()
+
+
+async def delete_path(client: httpx.AsyncClient, server_side_path: str):
+    r = await client.delete(f"{object_url(server_side_path)}{server_side_path}")
     if r.status_code == 200:
-        print(r.json())
-    else:
-        print(f"{r.status_code}: {r.content}")
+        return r.json()
+    return f"{r.status_code}: {r.content}"
 
 
-def post_dir(server_side_path, local_path):
-    url = f"{REST_URL}{server_side_path}"
+async def post_dir(client: httpx.AsyncClient, server_side_path: str, local_path: str):
+    url = f"{object_url(server_side_path)}{server_side_path}"
     req = {"dir_name": local_path}
-    r = httpx.post(url, json=req, headers=headers)
+    r = await client.post(url, json=req)
+    if r.status_code == 200 and r.json().get("status") == "ok":
+        # Commands after this one may go to any server
+        await wait_for_bucket(client, local_path)
     return r.content
 
 
-def post_obj(server_side_path: str, local_path: str):
-    url = f"{REST_URL}{server_side_path}"
+async def wait_for_bucket(client: httpx.AsyncClient, bucket_name: str):
+    """Wait, up to BUCKET_WAIT_TIMEOUT, until every server has a new
+    bucket. Servers that can't be reached aren't waited for."""
+    deadline = time.monotonic() + BUCKET_WAIT_TIMEOUT
+    waiting = all_replicas()
+    while waiting and time.monotonic() < deadline:
+        found = await asyncio.gather(
+            *(has_bucket(client, replica, bucket_name) for replica in waiting)
+        )
+        waiting = [replica for replica, has in zip(waiting, found) if not has]
+        if waiting:
+            await asyncio.sleep(BUCKET_WAIT_INTERVAL)
+
+
+async def has_bucket(client: httpx.AsyncClient, replica: str, bucket_name: str):
+    try:
+        r = await client.get(f"{replica}/{bucket_name}", params={"max_keys": 1})
+    except httpx.HTTPError:
+        return True
+    return r.status_code != 404
+
+
+async def post_obj(client: httpx.AsyncClient, server_side_path: str, local_path: str):
+    rest_url = object_url(f"{server_side_path.rstrip('/')}/{Path(local_path).name}")
+    url = f"{rest_url}{server_side_path}"
     try:
         with open(local_path, "rb") as f:
             files = {"file": f}
-            r = httpx.post(url, files=files, headers=headers)
+            start = time.perf_counter()
+            r = await client.post(url, files=files)
             if r.status_code == 200:
+                print_throughput("Uploaded", os.fstat(f.fileno()).st_size, start)
                 content_type = r.headers.get("Content-Type")
                 if "application/json" in content_type:
                     return r.json()
@@ -116,29 +470,617 @@ def post_obj(server_side_path: str, local_path: str):
         return "File does not exist"
 
 
-def get_dir(command: str):
-    r = httpx.get(f"{REST_URL}{command}", headers=headers)
+async def post_obj_multipart(
+    client: httpx.AsyncClient,
+    server_side_path: str,
+    local_path: str,
+    part_concurrency: int,
+):
+    """Upload a file as fixed-size parts sent concurrently over pooled connections.
+
+    Failed parts are retried on their own; the upload is aborted only if a
+    part keeps failing.
+    """
+    try:
+        size = os.path.getsize(local_path)
+    except OSError:
+        return "File does not exist"
+    object_path = f"/{server_side_path.strip('/')}/{Path(local_path).name}"
+    url = f"{object_url(object_path)}{object_path}/uploads"
+    part_numbers = list(range(1, max(-(-size // MULTIPART_PART_SIZE), 1) + 1))
+    start = time.perf_counter()
+    r = await client.post(url)
+    if r.status_code != 200:
+        return f"Error starting upload:\n{r.status_code}\n{r.text}"
+    upload_url = f"{url}/{r.json()['upload_id']}"
+
+    semaphore = asyncio.Semaphore(part_concurrency)
+    results = await asyncio.gather(
+        *(
+            post_part(client, semaphore, upload_url, local_path, part_number)
+            for part_number in part_numbers
+        )
+    )
+    failed_parts = [n for n, ok in zip(part_numbers, results) if not ok]
+    if failed_parts:
+        await client.delete(upload_url)
+        return f"Upload aborted, parts failed: {failed_parts}"
+
+    r = await client.post(upload_url, json={"parts": part_numbers})
+    if r.status_code != 200:
+        return f"Error completing upload:\n{r.status_code}\n{r.text}"
+    print_throughput("Uploaded", size, start)
     return r.json()
 
 
-def get_obj(command: str):
-    r = httpx.get(f"{REST_URL}{command}", headers=headers)
-    if r.status_code == 200:
-        filename = filename_from_content_disposition(
-            r.headers.get("Content-Disposition")
+async def post_part(client, semaphore, upload_url, local_path, part_number) -> bool:
+    offset = (part_number - 1) * MULTIPART_PART_SIZE
+    async with semaphore:
+        for attempt in range(PART_RETRIES):
+            if attempt:
+                await asyncio.sleep(0.5 * 2**attempt)
+            try:
+                # The server seals the part's frames for this place in the
+                # object
+                r = await client.put(
+                    f"{upload_url}/{part_number}",
+                    params={"offset": offset},
+                    content=read_part(local_path, offset),
+                )
+                if r.status_code == 200 and r.json()["status"] == "ok":
+                    return True
+            except httpx.HTTPError:
+                pass
+    return False
+
+
+async def read_part(local_path: str, offset: int):
+    with open(local_path, "rb") as f:
+        f.seek(offset)
+        remaining = MULTIPART_PART_SIZE
+        while remaining > 0 and (chunk := f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))):
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def delete_many(
+    client: httpx.AsyncClient, server_side_path: str, object_names: list[str]
+):
+    """Delete many objects, one request per server that owns some of them."""
+    bucket_name = server_side_path.strip("/")
+    groups = group_by_owner(bucket_name, object_names)
+    responses = await asyncio.gather(
+        *(
+            client.post(f"{url}/_bulk/{bucket_name}/delete", json={"objects": names})
+            for url, names in groups.items()
+        ),
+        return_exceptions=True,
+    )
+    return merge_bulk_results(responses, "deleted")
+
+
+async def put_dir(client: httpx.AsyncClient, server_side_path: str, local_path: str):
+    """Upload every file at the top level of a directory."""
+    bucket_name = server_side_path.strip("/")
+    try:
+        paths = sorted(path for path in Path(local_path).iterdir() if path.is_file())
+    except OSError:
+        return "Directory does not exist"
+    start = time.perf_counter()
+    result = await upload_files(client, bucket_name, paths)
+    print_throughput("Uploaded", sum(path.stat().st_size for path in paths), start)
+    return result
+
+
+async def upload_files(client: httpx.AsyncClient, bucket_name: str, paths: list[Path]):
+    """Upload files as tar streams, one per server that owns some of them."""
+    groups = group_by_owner(bucket_name, paths)
+    responses = await asyncio.gather(
+        *(
+            client.post(f"{url}/_bulk/{bucket_name}/upload", content=tar_stream(group))
+            for url, group in groups.items()
+        ),
+        return_exceptions=True,
+    )
+    return merge_bulk_results(responses, "uploaded")
+
+
+async def sync_dir(client: httpx.AsyncClient, local_path: str, server_side_path: str):
+    """Upload the files at the top level of a directory that the bucket
+    doesn't already hold with the same size and digest.
+
+    Small files go in tar batches and large ones in parts, up to
+    concurrency batches or files at a time.
+    """
+    global progress
+    bucket_name = server_side_path.strip("/")
+    try:
+        sizes = {
+            path: path.stat().st_size
+            for path in sorted(Path(local_path).iterdir())
+            if path.is_file()
+        }
+    except OSError:
+        return "Directory does not exist"
+    listing = await list_bucket(client, bucket_name)
+    if isinstance(listing, str):
+        return listing
+    unchanged = await asyncio.gather(
+        *(
+            is_unchanged(path, size, listing.get(f"{path.name}.enc"))
+            for path, size in sizes.items()
+        )
+    )
+    changed = [path for path, same in zip(sizes, unchanged) if not same]
+    small = [path for path in changed if sizes[path] < MULTIPART_PART_SIZE]
+    large = [path for path in changed if sizes[path] >= MULTIPART_PART_SIZE]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    parent = progress
+    progress = Progress(len(changed), parent)
+    try:
+        results = await asyncio.gather(
+            *(
+                sync_batch(client, semaphore, bucket_name, batch)
+                for batch in sync_batches(small, sizes)
+            ),
+            *(
+                sync_large_file(client, semaphore, server_side_path, path)
+                for path in large
+            ),
+        )
+    finally:
+        summary = progress.summary("files sent")
+        progress = parent
+
+    result = {
+        "status": "ok",
+        "uploaded": [],
+        "skipped": len(sizes) - len(changed),
+        "errors": [],
+    }
+    for batch_result in results:
+        if batch_result["status"] != "ok":
+            result["status"] = "error"
+        result["uploaded"] += batch_result["uploaded"]
+        result["errors"] += batch_result["errors"]
+    print(
+        f"{summary}; {len(result['uploaded'])} uploaded,"
+        f" {len(changed) - len(result['uploaded'])} failed"
+    )
+    return result
+
+
+async def list_bucket(
+    client: httpx.AsyncClient, bucket_name: str
+) -> dict[str, dict] | str:
+    """Every object of a bucket by name, or why it couldn't be listed."""
+    objects = {}
+    params = {"max_keys": LIST_PAGE_SIZE}
+    while True:
+        r, _, error = await send_hedged(
+            client, f"/{bucket_name}?{urlencode(params)}", all_replicas()
+        )
+        if r is None:
+            return error
+        await r.aread()
+        await r.aclose()
+        if r.status_code != 200:
+            return f"Listing failed with status code {r.status_code}"
+        listing = r.json()
+        objects.update((obj["name"], obj) for obj in listing["contents"])
+        if not listing["is_truncated"]:
+            return objects
+        params["continuation_token"] = listing["next_continuation_token"]
+
+
+async def is_unchanged(path: Path, size: int, stored: dict | None) -> bool:
+    if stored is None or stored["digest"] is None or stored["size"] != size:
+        return False
+    return stored["digest"] in await asyncio.to_thread(file_digests, path)
+
+
+def file_digests(path: Path) -> set[str]:
+    """The digests a server may have recorded for the file: that of its
+    contents, and the composite one a multipart upload of it gets."""
+    key = bytes.fromhex(headers["Authorization"])
+    digest = digest_mac(key)
+    part_digests = []
+    with open(path, "rb") as f:
+        while True:
+            part = f.read(MULTIPART_PART_SIZE)
+            digest.update(part)
+            part_digest = digest_mac(key)
+            part_digest.update(part)
+            part_digests.append(part_digest.digest())
+            # An empty file is still uploaded as one (empty) part
+            if len(part) < MULTIPART_PART_SIZE:
+                break
+    return {digest.hexdigest(), composite_digest(key, part_digests).hex()}
+
+
+def sync_batches(paths: list[Path], sizes: dict[Path, int]):
+    """Split paths into batches of up to SYNC_BATCH_FILES files and
+    SYNC_BATCH_BYTES bytes."""
+    batch = []
+    batch_size = 0
+    for path in paths:
+        if batch and (
+            len(batch) == SYNC_BATCH_FILES
+            or batch_size + sizes[path] > SYNC_BATCH_BYTES
+        ):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(path)
+        batch_size += sizes[path]
+    if batch:
+        yield batch
+
+
+async def sync_batch(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    bucket_name: str,
+    paths: list[Path],
+) -> dict:
+    async with semaphore:
+        start = time.perf_counter()
+        result = await upload_files(client, bucket_name, paths)
+        print_throughput("Uploaded", sum(path.stat().st_size for path in paths), start)
+    # A request that failed as a whole has one error for all its files
+    failed = len(paths) - len(result["uploaded"])
+    message = f"Sent {len(result['uploaded'])} of {len(paths)} files to /{bucket_name}"
+    if failed:
+        message += f", {failed} failed"
+    progress.finish(message, len(paths))
+    return result
+
+
+async def sync_large_file(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    server_side_path: str,
+    path: Path,
+) -> dict:
+    async with semaphore:
+        response = await post_obj_multipart(
+            client, server_side_path, str(path), MULTIPART_CONCURRENCY
         )
-        filename = filename[:-4]
-        file_path = PARENT_DIR / Path(filename)
-        plaintext_contents = decrypt_file(
-            r.content, bytes.fromhex(headers["Authorization"])
+    if isinstance(response, dict) and response.get("status") == "ok":
+        progress.finish(f"Sent {path.name}")
+        return {"status": "ok", "uploaded": [f"{path.name}.enc"], "errors": []}
+    progress.finish(f"Failed to send {path.name}: {response}")
+    return {
+        "status": "error",
+        "uploaded": [],
+        "errors": [{"name": path.name, "message": response}],
+    }
+
+
+async def tar_stream(paths: list[Path]):
+    """Yield a tar archive of the given files without buffering any of them."""
+    for path in paths:
+        info = tarfile.TarInfo(path.name)
+        stat = path.stat()
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        remaining = info.size
+        with open(path, "rb") as f:
+            while remaining > 0 and (
+                chunk := f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            ):
+                remaining -= len(chunk)
+                yield chunk
+        # Keep the archive well-formed if the file shrank while being read
+        yield bytes(remaining + (-info.size % tarfile.BLOCKSIZE))
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+def group_by_owner(bucket_name: str, objects: list) -> dict[str, list]:
+    """Group object names (or paths) by the server that owns them."""
+    groups = {}
+    for obj in objects:
+        name = obj.name if isinstance(obj, Path) else obj
+        groups.setdefault(object_url(f"/{bucket_name}/{name}"), []).append(obj)
+    return groups
+
+
+def merge_bulk_results(responses: list, done_key: str) -> dict:
+    result = {"status": "ok", done_key: [], "errors": []}
+    for r in responses:
+        if isinstance(r, httpx.HTTPError):
+            result["status"] = "error"
+            result["errors"].append({"message": str(r)})
+        elif isinstance(r, BaseException):
+            raise r
+        elif r.status_code != 200:
+            result["status"] = "error"
+            result["errors"].append({"message": f"{r.status_code}: {r.text}"})
+        else:
+            body = r.json()
+            result[done_key] += body[done_key]
+            result["errors"] += body["errors"]
+    return result
+
+
+async def get_dir(client: httpx.AsyncClient, command: str):
+    r, _, error = await send_hedged(client, command, all_replicas())
+    if r is None:
+        return error
+    await r.aread()
+    await r.aclose()
+    return r.json()
+
+
+async def get_obj(
+    client: httpx.AsyncClient, command: str, byte_range: str | None = None
+):
+    key = bytes.fromhex(headers["Authorization"])
+    request_headers = {}
+    if byte_range is not None:
+        request_headers["Range"] = f"bytes={byte_range}"
+    file_path = download_path(command)
+    etag = cached_etag(file_path) if byte_range is None else None
+    if etag is not None:
+        request_headers["If-None-Match"] = etag
+    replicas = object_replicas(command)
+    start = time.perf_counter()
+    while True:
+        r, replica, error = await send_hedged(
+            client, command, replicas, request_headers
+        )
+        if r is None:
+            return error
+        try:
+            if r.status_code == 304:
+                return f"{file_path} is up to date"
+            if r.status_code not in (200, 206):
+                return f"Download failed with status code {r.status_code}"
+            result = await save_download(r, key, byte_range)
+        except httpx.HTTPError as e:
+            # Broke off mid-body; start over from another replica
+            server_stats[replica].record_error()
+            replicas = [other for other in replicas if other != replica]
+            if not replicas:
+                return f"Download from {replica} failed ({e})"
+            print(f"Download from {replica} failed ({e}), failing over")
+            continue
+        finally:
+            await r.aclose()
+        print_throughput("Downloaded", r.num_bytes_downloaded, start)
+        return result
+
+
+async def save_download(r: httpx.Response, key: bytes, byte_range: str | None):
+    filename = filename_from_content_disposition(r.headers.get("Content-Disposition"))
+    filename = filename.removesuffix(".enc")
+    if byte_range is not None and r.status_code == 206:
+        filename = f"{filename}.{byte_range}"
+    elif byte_range is not None:
+        print("Server sent the whole object (ranges need the framed format)")
+    file_path = PARENT_DIR / Path(filename)
+    # Plaintext goes to disk as frames arrive, but the file only takes its
+    # real name once the whole object has been verified
+    partial_path = file_path.with_name(f"{file_path.name}.part")
+    if r.status_code == 206:
+        decoder = ObjectDecoder(
+            key,
+            int(r.headers["X-Frame-Count"]),
+            executor=crypto_pool,
+            offset=int(r.headers["X-Frame-Offset"]),
+        )
+        plaintext = trim_to_range(
+            r, decoder, int(r.headers["X-Frame-Offset"]), r.headers["Content-Range"]
+        )
+    else:
+        decoder = ObjectDecoder(key, executor=crypto_pool)
+        plaintext = (
+            await asyncio.to_thread(decoder.feed, chunk)
+            async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_SIZE)
         )
-        if plaintext_contents is None:
-            return "Invalid encryption"
-        with open(file_path, "w") as f:
-            f.write(plaintext_contents)
-        return f"Wrote {file_path}"
+    try:
+        with open(partial_path, "wb") as f:
+            async for chunk in plaintext:
+                f.write(chunk)
+            decoder.finish()
+    except ValueError:
+        partial_path.unlink(missing_ok=True)
+        return "Invalid encryption"
+    except httpx.HTTPError:
+        partial_path.unlink(missing_ok=True)
+        raise
+    os.replace(partial_path, file_path)
+    if r.status_code == 200:
+        remember_etag(file_path, r.headers.get("ETag"))
+    return f"Wrote {file_path}"
+
+
+def load_etags() -> dict:
+    try:
+        with open(ETAGS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def cached_etag(file_path: Path) -> str | None:
+    entry = load_etags().get(str(file_path))
+    try:
+        stat = file_path.stat()
+    except OSError:
+        return None
+    if (
+        entry is None
+        or entry["size"] != stat.st_size
+        or entry["mtime_ns"] != stat.st_mtime_ns
+    ):
+        return None
+    return entry["etag"]
+
+
+def remember_etag(file_path: Path, etag: str | None):
+    etags = load_etags()
+    if etag is None:
+        etags.pop(str(file_path), None)
     else:
-        return f"Download failed with status code {r.status_code}"
+        stat = file_path.stat()
+        etags[str(file_path)] = {
+            "etag": etag,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+    with open(ETAGS_PATH.with_suffix(".tmp"), "w") as f:
+        json.dump(etags, f)
+    os.replace(ETAGS_PATH.with_suffix(".tmp"), ETAGS_PATH)
+
+
+async def trim_to_range(r, decoder, position: int, content_range: str):
+    """Yield only the decrypted bytes inside the range the server resolved.
+
+    The server sends whole frames, so the first and last frame usually
+    carry some plaintext on either side of the range.
+    """
+    start, end = (int(x) for x in content_range.split(" ")[1].split("/")[0].split("-"))
+    async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+        plaintext = await asyncio.to_thread(decoder.feed, chunk)
+        yield plaintext[max(start - position, 0) : max(end + 1 - position, 0)]
+        position += len(plaintext)
+
+
+async def send_hedged(
+    client: httpx.AsyncClient,
+    path: str,
+    replicas: list[str],
+    request_headers: dict | None = None,
+) -> tuple[httpx.Response | None, str | None, str]:
+    """GET path from the best replica, hedging and failing over to the rest.
+
+    Returns the first response that settles the request, with its body not
+    yet read, and the replica that sent it. Otherwise returns None and why
+    every replica failed.
+    """
+    remaining = rank_replicas(replicas)
+    pending = {}
+    error = "No file servers to ask"
+
+    def ask_next():
+        if not remaining:
+            return
+        replica = remaining.pop(0)
+        request = client.build_request(
+            "GET", f"{replica}{path}", headers=request_headers
+        )
+        pending[asyncio.create_task(timed_send(client, request))] = replica
+
+    ask_next()
+    try:
+        while pending:
+            newest = list(pending.values())[-1]
+            hedge_delay = max(
+                MIN_HEDGE_DELAY,
+                HEDGE_LATENCY_MULTIPLE * server_stats[newest].expected_latency,
+            )
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=hedge_delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                ask_next()
+                continue
+            for task in done:
+                replica = pending.pop(task)
+                try:
+                    r, latency = task.result()
+                except httpx.HTTPError as e:
+                    server_stats[replica].record_error()
+                    error = f"{replica} failed: {e}"
+                else:
+                    if r.status_code < 500:
+                        server_stats[replica].record_success(latency)
+                    else:
+                        server_stats[replica].record_error()
+                    # A replica without the object may just be behind
+                    if r.status_code != 404 and r.status_code < 500:
+                        return r, replica, error
+                    error = f"Download failed with status code {r.status_code}"
+                    await r.aclose()
+                if remaining:
+                    ask_next()
+        return None, None, error
+    finally:
+        for task in pending:
+            task.cancel()
+        for task in pending:
+            try:
+                r, _ = await task
+                await r.aclose()
+            except (asyncio.CancelledError, httpx.HTTPError):
+                pass
+
+
+async def timed_send(client: httpx.AsyncClient, request: httpx.Request):
+    start = time.perf_counter()
+    r = await client.send(request, stream=True)
+    return r, time.perf_counter() - start
+
+
+def rank_replicas(replicas: list[str]) -> list[str]:
+    """Healthy replicas first, fastest first, with the odd random pick."""
+    ranked = sorted(
+        replicas,
+        key=lambda replica: (
+            not server_stats[replica].healthy,
+            server_stats[replica].score(),
+        ),
+    )
+    healthy = [replica for replica in ranked if server_stats[replica].healthy]
+    if len(healthy) > 1 and random.random() < EXPLORE_PROBABILITY:
+        pick = random.choice(healthy[1:])
+        ranked.remove(pick)
+        ranked.insert(0, pick)
+    return ranked
+
+
+def load_ring():
+    """Build the placement ring from the name server's live file servers."""
+    global ring
+    if not NAME_SERVER_URL:
+        return
+    try:
+        r = httpx.get(NAME_SERVER_URL)
+        r.raise_for_status()
+        ring = HashRing(
+            [server_id(server["host"], server["port"]) for server in r.json()],
+            REPLICATION_FACTOR,
+        )
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Could not load placement from the name server: {e}")
+
+
+def object_url(object_path: str) -> str:
+    """Base URL of the primary owner of /bucket/object."""
+    return object_replicas(object_path)[0]
+
+
+def object_replicas(object_path: str) -> list[str]:
+    """Base URLs of every owner of /bucket/object, primary first. Any
+    server can answer for a bucket."""
+    bucket_name, _, object_name = object_path.strip("/").partition("/")
+    if ring is None or not len(ring) or not object_name:
+        return all_replicas()
+    return [
+        f"http://{owner}"
+        for owner in ring.owners(placement_key(bucket_name, object_name))
+    ]
+
+
+def all_replicas() -> list[str]:
+    if ring is None or not len(ring):
+        return [REST_URL]
+    return [f"http://{server}" for server in ring.servers]
 
 
 def verify_input(command: str):
@@ -157,19 +1099,17 @@ def filename_from_content_disposition(content: str | None):
     return str(time.time_ns())
 
 
-def decrypt_file(content, key):
-    try:
-        file = BytesIO(content)
-        file_view = file.getvalue()
-        hmac = file_view[0:16]
-        nonce = file_view[16:32]
-        ciphertext = file_view[32:]
-
-        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-        plain_text = cipher.decrypt_and_verify(ciphertext, hmac)
-        return plain_text.decode("utf-8")
-    except (ValueError, KeyError):
-        return None
+def print_throughput(action: str, num_bytes: int, start: float):
+    if progress is not None:
+        # A batch or sync reports the total instead
+        progress.add_bytes(num_bytes)
+        return
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    megabytes = num_bytes / 1_000_000
+    print(
+        f"{action} {megabytes:.2f} MB in {elapsed:.2f}s "
+        f"({megabytes / elapsed:.2f} MB/s)"
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,309 @@
+import functools
+import json
+import os
+import struct
+
+# Reed-Solomon erasure coding for erasure-coded buckets.
+#
+# An encrypted object is cut into stripes of data_shards chunks, and every
+# stripe gets parity_shards parity chunks computed over GF(256). Any
+# data_shards of the data_shards + parity_shards chunks of a stripe are
+# enough to rebuild it. Shard i of an object is chunk i of every stripe.
+#
+# The parity rows form a Cauchy matrix, so every square submatrix of the
+# generator [identity; parity] is invertible. Multiplying a whole chunk by
+# a constant is one bytes.translate through a 256-byte table, and chunks
+# are added (xor) as big integers, which keeps the loops out of Python.
+#
+# A server stores the shards it holds for an object as one shard set:
+#   magic (4) | header_len (4) | JSON header | stripe | stripe | ...
+# where each stripe holds chunk_size bytes of each held shard, in the order
+# the header lists them. The header also records which server holds every
+# shard, so any one shard set leads to the rest.
+
+MAGIC = b"SDSE"
+SET_PREFIX = struct.Struct("<4sI")
+
+DEFAULT_DATA_SHARDS = 4
+DEFAULT_PARITY_SHARDS = 2
+MAX_SHARDS = 255
+
+# Upper bound on the per-shard chunk of one stripe; small objects use
+# smaller chunks so their shards aren't mostly padding
+MAX_CHUNK_SIZE = 256 * 1024
+
+PRIMITIVE_POLYNOMIAL = 0x11D
+
+SHARD_SET_FIELDS = [
+    "data_shards",
+    "parity_shards",
+    "chunk_size",
+    "stored_size",
+    "plaintext_size",
+    "digest",
+    "holders",
+    "shards",
+]
+
+
+def _build_tables() -> tuple[list[int], list[int]]:
+    exp = [0] * 512
+    log = [0] * 256
+    value = 1
+    for power in range(255):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= PRIMITIVE_POLYNOMIAL
+    for power in range(255, 512):
+        exp[power] = exp[power - 255]
+    return exp, log
+
+
+EXP, LOG = _build_tables()
+
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a: int) -> int:
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+MUL_TABLES = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+
+
+class ShardSetHeader:
+    def __init__(
+        self,
+        data_shards: int,
+        parity_shards: int,
+        chunk_size: int,
+        stored_size: int,
+        plaintext_size: int,
+        digest: bytes,
+        holders: list[str],
+        shards: list[int],
+    ):
+        self.data_shards = data_shards
+        self.parity_shards = parity_shards
+        self.chunk_size = chunk_size
+        self.stored_size = stored_size
+        self.plaintext_size = plaintext_size
+        self.digest = digest
+        self.holders = holders
+        self.shards = shards
+
+    def pack(self) -> bytes:
+        fields = {field: getattr(self, field) for field in SHARD_SET_FIELDS}
+        fields["digest"] = self.digest.hex()
+        body = json.dumps(fields).encode()
+        return SET_PREFIX.pack(MAGIC, len(body)) + body
+
+    @functools.cached_property
+    def size(self) -> int:
+        return len(self.pack())
+
+    @property
+    def stripe_count(self) -> int:
+        stripe_size = self.data_shards * self.chunk_size
+        return max(-(-self.stored_size // stripe_size), 1)
+
+    def chunk_offset(self, shard: int, stripe: int) -> int:
+        """Offset of one shard's chunk of a stripe within the shard set."""
+        position = stripe * len(self.shards) + self.shards.index(shard)
+        return self.size + position * self.chunk_size
+
+
+def read_shard_header(file) -> ShardSetHeader | None:
+    """Read the header of a shard set, or return None with the file
+    position unchanged if file holds something else."""
+    start = file.tell()
+    prefix = file.read(SET_PREFIX.size)
+    if len(prefix) < SET_PREFIX.size or prefix[: len(MAGIC)] != MAGIC:
+        file.seek(start)
+        return None
+    _, body_size = SET_PREFIX.unpack(prefix)
+    fields = json.loads(file.read(body_size))
+    fields["digest"] = bytes.fromhex(fields["digest"])
+    return ShardSetHeader(**fields)
+
+
+def chunk_size_for(stored_size: int, data_shards: int) -> int:
+    return min(max(-(-stored_size // data_shards), 1), MAX_CHUNK_SIZE)
+
+
+@functools.lru_cache
+def parity_matrix(data_shards: int, parity_shards: int) -> list[list[int]]:
+    return [
+        [gf_inv((data_shards + row) ^ column) for column in range(data_shards)]
+        for row in range(parity_shards)
+    ]
+
+
+def generator_row(shard: int, data_shards: int, parity_shards: int) -> list[int]:
+    if shard < data_shards:
+        return [int(column == shard) for column in range(data_shards)]
+    return parity_matrix(data_shards, parity_shards)[shard - data_shards]
+
+
+@functools.lru_cache
+def decode_matrix(
+    shards: tuple[int, ...], data_shards: int, parity_shards: int
+) -> list[list[int]]:
+    """Invert the generator rows of the given shards by Gauss-Jordan
+    elimination, giving the rows that turn those shards back into data."""
+    n = data_shards
+    rows = [
+        generator_row(shard, data_shards, parity_shards)
+        + [int(column == i) for column in range(n)]
+        for i, shard in enumerate(shards)
+    ]
+    for column in range(n):
+        pivot = next(r for r in range(column, n) if rows[r][column])
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        scale = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(scale, value) for value in rows[column]]
+        for r in range(n):
+            factor = rows[r][column]
+            if r != column and factor:
+                rows[r] = [
+                    value ^ gf_mul(factor, pivot_value)
+                    for value, pivot_value in zip(rows[r], rows[column])
+                ]
+    return [row[n:] for row in rows]
+
+
+def combine(coefficients: list[int], chunks: list[bytes]) -> bytes:
+    """Sum of coefficient * chunk over GF(256)."""
+    total = 0
+    for coefficient, chunk in zip(coefficients, chunks):
+        if coefficient:
+            total ^= int.from_bytes(chunk.translate(MUL_TABLES[coefficient]), "big")
+    return total.to_bytes(len(chunks[0]), "big")
+
+
+def encode_stripe(
+    data: bytes, data_shards: int, parity_shards: int, chunk_size: int
+) -> list[bytes]:
+    """Split one stripe into data chunks and append its parity chunks."""
+    data = data.ljust(data_shards * chunk_size, b"\0")
+    chunks = [data[i * chunk_size : (i + 1) * chunk_size] for i in range(data_shards)]
+    return chunks + [
+        combine(row, chunks) for row in parity_matrix(data_shards, parity_shards)
+    ]
+
+
+def decode_stripe(
+    chunks: dict[int, bytes], data_shards: int, parity_shards: int
+) -> bytes:
+    """Rebuild a stripe's data from any data_shards of its chunks."""
+    shards = tuple(sorted(chunks)[:data_shards])
+    if len(shards) < data_shards:
+        raise ValueError("Not enough shards to rebuild the stripe")
+    if shards == tuple(range(data_shards)):
+        return b"".join(chunks[shard] for shard in shards)
+    available = [chunks[shard] for shard in shards]
+    return b"".join(
+        combine(row, available)
+        for row in decode_matrix(shards, data_shards, parity_shards)
+    )
+
+
+def write_shard_sets(source, set_files: list, set_headers: list[ShardSetHeader]):
+    """Encode the object read from source into shard sets, one per file.
+
+    Every header describes the same object and lists the shards its set
+    holds. The object is read one stripe at a time.
+    """
+    for file, header in zip(set_files, set_headers):
+        file.write(header.pack())
+    first = set_headers[0]
+    stripe_size = first.data_shards * first.chunk_size
+    while stripe := source.read(stripe_size):
+        chunks = encode_stripe(
+            stripe, first.data_shards, first.parity_shards, first.chunk_size
+        )
+        for file, header in zip(set_files, set_headers):
+            for shard in header.shards:
+                file.write(chunks[shard])
+
+
+def read_shard_sets(sets: list[tuple]):
+    """Yield the object rebuilt from (file, header) shard sets, stripe by
+    stripe. Data shards are preferred since they need no decoding."""
+    reader = ShardSetReader(sets)
+    yield from reader.iter_range(0, reader.size)
+
+
+class ShardSetReader:
+    """Random access to the object rebuilt from (file, header) shard sets.
+
+    Reads decode only the stripes they cover, and the last stripe decoded
+    is kept, so small reads that follow each other decode every stripe
+    once. Data shards are preferred since they need no decoding.
+    """
+
+    def __init__(self, sets: list[tuple]):
+        self.sources = {}
+        for file, header in sets:
+            for shard in header.shards:
+                self.sources.setdefault(shard, (file, header))
+        self.header = sets[0][1]
+        self.chosen = sorted(self.sources)[: self.header.data_shards]
+        if len(self.chosen) < self.header.data_shards:
+            raise ValueError("Not enough shards to rebuild the object")
+        self.size = self.header.stored_size
+        self.stripe_size = self.header.data_shards * self.header.chunk_size
+        self.position = 0
+        self.cached = (None, b"")
+
+    def stripe(self, stripe: int) -> bytes:
+        """One stripe of the object, without the padding after its end."""
+        if self.cached[0] == stripe:
+            return self.cached[1]
+        chunks = {}
+        for shard in self.chosen:
+            file, header = self.sources[shard]
+            file.seek(header.chunk_offset(shard, stripe))
+            chunks[shard] = file.read(header.chunk_size)
+            if len(chunks[shard]) != header.chunk_size:
+                raise ValueError("Truncated shard set")
+        data = decode_stripe(chunks, self.header.data_shards, self.header.parity_shards)
+        data = data[: max(self.size - stripe * self.stripe_size, 0)]
+        self.cached = (stripe, data)
+        return data
+
+    def iter_range(self, start: int, end: int):
+        """Yield bytes start..end (exclusive) of the object."""
+        end = min(end, self.size)
+        while start < end:
+            stripe, offset = divmod(start, self.stripe_size)
+            data = self.stripe(stripe)[offset : offset + end - start]
+            if not data:
+                break
+            start += len(data)
+            yield data
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size < 0 else self.position + size
+        data = b"".join(self.iter_range(self.position, end))
+        self.position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
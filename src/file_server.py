@@ -1,26 +1,140 @@
+import asyncio
+import errno
 import hmac
+import io
+import json
 import os
 import pickle
-from contextlib import asynccontextmanager
-from datetime import datetime
+import re
+import shutil
+import tarfile
+import threading
+import time
+import traceback
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
 from socket import gethostbyname, gethostname
+from tempfile import NamedTemporaryFile
 from typing import Any
 
 import httpx
-from Crypto.Cipher import AES
 from dotenv import load_dotenv
 from fastapi import BackgroundTasks, FastAPI, File, HTTPException, Request, UploadFile
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from chunks import (
+    ChunkStore,
+    ChunkWriter,
+    pack_chunk_records,
+    unpack_chunk_records,
+)
+from erasure import (
+    DEFAULT_DATA_SHARDS,
+    DEFAULT_PARITY_SHARDS,
+    MAX_SHARDS,
+    ShardSetHeader,
+    ShardSetReader,
+    chunk_size_for,
+    read_shard_header,
+    write_shard_sets,
+)
+from journal import DELETED, DELETING, UPLOADED, UPLOADING, Journal
+from metadata import (
+    HEX_DIGITS,
+    MAX_KEYS,
+    MERKLE_MAX_DEPTH,
+    MetadataIndex,
+    merge_listings,
+)
+from metrics import (
+    CONTENT_TYPE,
+    Callback,
+    Counter,
+    Histogram,
+    MetricsMiddleware,
+    Registry,
+    TimedThreadPool,
+)
+from object_cache import ObjectCache
+from object_format import (
+    CODEC_NONE,
+    CODEC_ZLIB,
+    CODECS,
+    FLAG_COMPOSITE_DIGEST,
+    FRAME_SIZE,
+    HEADER,
+    ObjectHeader,
+    LEVEL_RANGES,
+    Manifest,
+    ObjectDecoder,
+    ObjectWriter,
+    codec_available,
+    composite_digest,
+    is_framed,
+    is_manifest,
+    locate_frames,
+    read_header,
+)
+from placement import DEFAULT_REPLICATION_FACTOR, HashRing, placement_key, server_id
+from replication import PeerBackoff, ReplicationScheduler
+from segments import SegmentStore
+from versions import UNVERSIONED, HybridLogicalClock, load_origin_id, supersedes
 
 app = FastAPI()
 
 
 PARENT_DIR = Path(__file__).parent
 ROOT_DIR = PARENT_DIR / Path("root")
+STAGING_DIR = PARENT_DIR / Path("staging")
+SEGMENTS_DIR = PARENT_DIR / Path("segments")
+CHUNKS_DIR = PARENT_DIR / Path("chunks")
+UPLOADS_DIR = STAGING_DIR / Path("uploads")
 
 os.makedirs(ROOT_DIR, exist_ok=True)
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+
+# Uploads are read and encrypted in chunks of this size, which bounds the
+# memory each request needs regardless of object size.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+UPLOAD_ID_REGEX = re.compile(r"^[0-9a-f]{32}$")
+MAX_PARTS = 10000
+# Multipart uploads nothing has happened to for UPLOAD_TTL seconds are
+# taken to be abandoned, and their parts are dropped at the next compaction
+UPLOAD_TTL = float(os.environ.get("UPLOAD_TTL", 24 * 60 * 60))
+
+# Stored objects smaller than PACKED_OBJECT_SIZE bytes (0 turns this off)
+# are appended to segment files of up to SEGMENT_SIZE bytes instead of
+# getting a file each. Every COMPACTION_INTERVAL seconds, segments whose
+# live records fill less than SEGMENT_COMPACT_RATIO of them are rewritten.
+PACKED_OBJECT_SIZE = int(os.environ.get("PACKED_OBJECT_SIZE", 64 * 1024))
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", 64 * 1024 * 1024))
+SEGMENT_COMPACT_RATIO = float(os.environ.get("SEGMENT_COMPACT_RATIO", 0.5))
+COMPACTION_INTERVAL = 60
+
+# Chunks of deduplicated objects that nothing has referred to for
+# CHUNK_GRACE_PERIOD seconds are dropped at the next compaction. Chunks go
+# to peers in batches of up to BATCH_MAX_BYTES, after asking which of
+# CHUNK_QUERY_SIZE ids at a time they lack, and are read from the chunk
+# segments CHUNK_READ_SIZE at a time.
+CHUNK_GRACE_PERIOD = float(os.environ.get("CHUNK_GRACE_PERIOD", 600))
+CHUNK_QUERY_SIZE = 4096
+CHUNK_READ_SIZE = 64
 
 load_dotenv()
 NAME_SERVER_URL = os.environ.get("NAME_SERVER_URL")
@@ -33,21 +147,319 @@ if not API_KEY:
 
 headers = {"Authorization": API_KEY, "X-Sync": "true"}
 
-journal = {}
+journal: Journal
+metadata_index: MetadataIndex
+segment_store: SegmentStore
+chunk_store: ChunkStore
+
+# Replication state. Peers are reached over one pooled client, with at most
+# PEER_CONCURRENCY transfers in flight to each peer at a time.
+PEER_CONCURRENCY = 4
+# Objects whose versions a peer is asked for per request while rebalancing
+VERSION_BATCH_SIZE = 1000
+SYNC_KEEPALIVE_CONNECTIONS = 32
+SYNC_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+LOCAL_HOST = gethostbyname(gethostname())
+# Set by start_file_server.py so several servers can share one host
+LOCAL_PORT = (
+    int(os.environ["FILE_SERVER_PORT"]) if "FILE_SERVER_PORT" in os.environ else None
+)
+
+# Replication runs in passes once writes have been quiet for
+# REPLICATION_DEBOUNCE seconds, or REPLICATION_MAX_DELAY after the first
+# one. A peer that fails is retried after 1, 2, 4, ... seconds, up to
+# REPLICATION_RETRY_MAX. Objects up to BATCH_OBJECT_SIZE are sent to a peer
+# in tar batches of up to BATCH_MAX_BYTES and BATCH_MAX_OBJECTS; larger ones
+# are streamed on their own.
+REPLICATION_DEBOUNCE = float(os.environ.get("REPLICATION_DEBOUNCE", 0.1))
+REPLICATION_MAX_DELAY = float(os.environ.get("REPLICATION_MAX_DELAY", 0.5))
+REPLICATION_RETRY_MIN = 1
+REPLICATION_RETRY_MAX = 60
+BATCH_OBJECT_SIZE = 256 * 1024
+BATCH_MAX_BYTES = 8 * 1024 * 1024
+BATCH_MAX_OBJECTS = 1000
+
+# Seconds between anti-entropy passes against every peer
+ANTI_ENTROPY_INTERVAL = 300
+
+# Writes and deletes of objects are versioned by this server's hybrid
+# logical clock (see versions). A change is applied only if it is newer
+# than the last one this server has for the object, so replicated changes
+# may arrive in any order, late or more than once, and every replica still
+# ends up with the same version. Versions go to peers in the X-Version
+# header, or for batches in each tar member's pax headers. Deletes leave
+# tombstones so an older write that arrives later isn't applied; they are
+# dropped TOMBSTONE_RETENTION seconds after the delete, which has to be
+# longer than any change can take to reach every replica.
+TOMBSTONE_RETENTION = float(os.environ.get("TOMBSTONE_RETENTION", 7 * 24 * 3600))
+VERSION_HEADER = "X-Version"
+VERSION_PAX_HEADER = "SDS3.version"
+clock = HybridLogicalClock(load_origin_id(PARENT_DIR / "origin_id"))
+# A change to an object holds its stripe of object_locks from the version
+# check until it is indexed, so changes to one object apply in order while
+# the disk I/O of others goes ahead. version_lock is only held for the
+# version check and the index update.
+OBJECT_LOCK_STRIPES = 64
+object_locks = [threading.Lock() for _ in range(OBJECT_LOCK_STRIPES)]
+version_lock = threading.Lock()
+
+# Cluster membership. Peers are cached locally and refreshed by long-polling
+# the name server's watch endpoint, so replication doesn't ask the name
+# server for every write. Heartbeats keep this server marked alive there.
+NAME_SERVER_BASE_URL = NAME_SERVER_URL.rstrip("/")
+HEARTBEAT_INTERVAL = 5
+WATCH_TIMEOUT = 30
+WATCH_RETRY_DELAY = 5
+membership_version = -1
+cached_peer_urls: list[str] | None = None
+
+# Objects live only on the replication_factor servers the ring assigns them
+# to. Buckets are still created on every server. placed_ring is the ring
+# local objects were last moved to match; rebalance() catches up with ring.
+REPLICATION_FACTOR = int(
+    os.environ.get("REPLICATION_FACTOR", DEFAULT_REPLICATION_FACTOR)
+)
+ring: HashRing | None = None
+placed_ring: HashRing | None = None
+# Counts ring changes, so Merkle trees scoped to one ring are never
+# mistaken for those of the next
+ring_generation = 0
+REBALANCE_RETRY_DELAY = 5
+
+# Prometheus metrics, served at /metrics without an API key unless
+# METRICS_API_KEY is set, in which case scrapers must send that instead
+METRICS_PATH = "/metrics"
+METRICS_API_KEY = os.environ.get("METRICS_API_KEY")
+metrics_registry = Registry()
+crypto_frame_seconds = Histogram(
+    metrics_registry,
+    "sds3_crypto_frame_seconds",
+    "Time to compress and encrypt one frame on the crypto pool.",
+)
+replication_push_seconds = Histogram(
+    metrics_registry,
+    "sds3_replication_push_seconds",
+    "Time to push one change to a peer.",
+    ("peer",),
+)
+replication_push_failures = Counter(
+    metrics_registry,
+    "sds3_replication_push_failures_total",
+    "Changes that failed to reach a peer.",
+    ("peer",),
+)
+
+# Frames are compressed and encrypted by a pool of CRYPTO_WORKERS threads
+# (AES-GCM and zlib release the GIL), never on the event loop. Uploads are
+# pipelined: the next chunk is received while the frames of the previous
+# one are sealed and written. Every task on crypto_pool seals a frame, so
+# it feeds crypto_frame_seconds; a lone frame is sealed inline and isn't
+# counted. Parts re-sealed when a multipart upload completes are decrypted
+# on decrypt_pool, which is untimed.
+CRYPTO_WORKERS = int(os.environ.get("CRYPTO_WORKERS", os.cpu_count() or 1))
+crypto_pool = TimedThreadPool(
+    crypto_frame_seconds, CRYPTO_WORKERS, thread_name_prefix="crypto"
+)
+decrypt_pool = ThreadPoolExecutor(CRYPTO_WORKERS, thread_name_prefix="decrypt")
+
+# Hot objects are served from memory. OBJECT_CACHE_BYTES bounds the whole
+# cache and OBJECT_CACHE_MAX_OBJECT_SIZE the objects it will take; either
+# set to 0 turns it off.
+object_cache = ObjectCache(
+    int(os.environ.get("OBJECT_CACHE_BYTES", 64 * 1024 * 1024)),
+    int(os.environ.get("OBJECT_CACHE_MAX_OBJECT_SIZE", 1024 * 1024)),
+)
+
+Callback(
+    metrics_registry,
+    "sds3_replication_queue_depth",
+    "Journaled changes not yet acknowledged by every replica.",
+    lambda: len(journal) if serving else 0,
+)
+Callback(
+    metrics_registry,
+    "sds3_replication_peers_backing_off",
+    "Peers waiting out a backoff after failed pushes.",
+    lambda: len(peer_backoff.waiting()),
+)
+Callback(
+    metrics_registry,
+    "sds3_journal_oldest_change_age_seconds",
+    "How long the oldest unreplicated change has waited.",
+    lambda: journal.oldest_age() if serving else 0,
+)
+Callback(
+    metrics_registry,
+    "sds3_segment_bytes",
+    "Bytes of segment files holding packed objects, live or not.",
+    lambda: segment_store.total_size() if serving else 0,
+)
+Callback(
+    metrics_registry,
+    "sds3_chunk_store_bytes",
+    "Bytes of segment files holding the chunks of deduplicated objects.",
+    lambda: chunk_store.total_size() if serving else 0,
+)
+Callback(
+    metrics_registry,
+    "sds3_object_cache_bytes",
+    "Bytes held by the object cache.",
+    lambda: object_cache.size,
+)
+Callback(
+    metrics_registry,
+    "sds3_object_cache_requests_total",
+    "Object cache lookups.",
+    lambda: {("hit",): object_cache.hits, ("miss",): object_cache.misses},
+    labels=("result",),
+    kind="counter",
+)
+
+# Storage modes. Objects in an erasure-coded bucket are split into
+# data_shards + parity_shards shards spread over the cluster instead of
+# being copied whole; the bucket's settings live in a dotfile inside it.
+# Buckets can also compress objects before they are encrypted, which
+# shrinks what is stored and what replication sends, and deduplicate them:
+# objects are stored as manifests of content-defined chunks, each chunk
+# stored (and sent to a peer) once however many objects contain it.
+REPLICATED = "replicated"
+ERASURE_CODED = "erasure"
+BUCKET_CONFIG_NAME = ".bucket.json"
+bucket_configs: dict[str, dict] = {}
+
+# Startup doesn't hold up the server. recover() loads the local state in
+# the background, and until it has, only the probe and metrics routes are
+# answered (others get 503). /healthz is the liveness probe. /readyz turns
+# ready once the first replication and anti-entropy passes have run. How
+# long each startup phase took is logged, reported by /readyz and
+# exported as a metric. If recovery fails, its traceback is logged and
+# /healthz and every other route answer 500, so the server gets restarted.
+HEALTH_PATH = "/healthz"
+READY_PATH = "/readyz"
+PROBE_PATHS = {HEALTH_PATH, READY_PATH, METRICS_PATH}
+STARTUP_RETRY_AFTER = 1
+serving = False
+ready = False
+recovery_error: str | None = None
+startup_phases: dict[str, float] = {}
+Callback(
+    metrics_registry,
+    "sds3_startup_phase_seconds",
+    "How long each phase of the last startup took.",
+    lambda: {(phase,): seconds for phase, seconds in startup_phases.items()},
+    labels=("phase",),
+)
+
+sync_client: httpx.AsyncClient
+peer_backoff = PeerBackoff(REPLICATION_RETRY_MIN, REPLICATION_RETRY_MAX)
+# Peers each journaled change has reached so far, as key -> (seq, peer
+# URLs), so a retry only goes to the peers that missed it
+delivered_changes: dict[str, tuple[int, set[str]]] = {}
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global journal
-    try:
-        with open(f"{PARENT_DIR}{os.path.sep}journal.pk1", "rb") as file:
-            journal = pickle.load(file)
-    except OSError as e:
-        print(e)
-    await sync_changes()
+    global sync_client
+    sync_client = httpx.AsyncClient(
+        headers=headers,
+        timeout=SYNC_TIMEOUT,
+        limits=httpx.Limits(max_keepalive_connections=SYNC_KEEPALIVE_CONNECTIONS),
+    )
+    recovery = asyncio.create_task(run_recovery())
     yield
-    with open(f"{PARENT_DIR}{os.path.sep}journal.pk1", "wb") as file:
-        pickle.dump(journal, file)
+    for task in [recovery, *background_loops]:
+        task.cancel()
+    await deregister_from_name_server()
+    await sync_client.aclose()
+    if serving:
+        journal.close()
+        metadata_index.close()
+        segment_store.close()
+        chunk_store.segments.close()
+    crypto_pool.shutdown()
+    decrypt_pool.shutdown()
+
+
+background_loops: list[asyncio.Task] = []
+
+
+async def run_recovery():
+    global recovery_error
+    try:
+        await recover()
+    except Exception as e:
+        traceback.print_exc()
+        recovery_error = f"{type(e).__name__}: {e}"
+        print("Startup failed", flush=True)
+
+
+async def recover():
+    """Load the local state, then catch up with the peers."""
+    global journal, metadata_index, segment_store, chunk_store, serving, ready
+    started = time.perf_counter()
+    with startup_phase("journal"):
+        journal = await run_in_threadpool(Journal, PARENT_DIR / "journal.log")
+    with startup_phase("index"):
+        segment_store = await run_in_threadpool(
+            SegmentStore, SEGMENTS_DIR, SEGMENT_SIZE
+        )
+        chunk_segments = await run_in_threadpool(SegmentStore, CHUNKS_DIR, SEGMENT_SIZE)
+        metadata_index = await run_in_threadpool(
+            MetadataIndex,
+            PARENT_DIR / "index.db",
+            ROOT_DIR,
+            segment_store,
+            chunk_segments,
+        )
+        chunk_store = ChunkStore(chunk_segments, metadata_index)
+    with startup_phase("pickled_journal"):
+        await run_in_threadpool(import_pickled_journal)
+    serving = True
+    background_loops.extend(
+        asyncio.create_task(loop())
+        for loop in (heartbeat_loop, watch_membership, compaction_loop)
+    )
+    # Changes journaled before the restart
+    with startup_phase("replication"):
+        try:
+            await replicate()
+        except (OSError, ValueError, httpx.HTTPError) as e:
+            print(e, flush=True)
+    background_loops.append(asyncio.create_task(replication_scheduler.run()))
+    with startup_phase("anti_entropy"):
+        await reconcile_with_peers()
+    background_loops.append(asyncio.create_task(anti_entropy_loop()))
+    startup_phases["total"] = time.perf_counter() - started
+    print(f"Ready after {startup_phases['total']:.3f}s", flush=True)
+    ready = True
+
+
+@contextmanager
+def startup_phase(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phases[phase] = time.perf_counter() - start
+        print(f"Startup: {phase} took {startup_phases[phase]:.3f}s", flush=True)
+
+
+def import_pickled_journal():
+    """Carry over changes from the journal.pk1 written by older versions."""
+    pickled_path = PARENT_DIR / "journal.pk1"
+    try:
+        with open(pickled_path, "rb") as file:
+            pickled_journal = pickle.load(file)
+    except OSError:
+        return
+    for path, status in pickled_journal.items():
+        try:
+            key = Path(path).relative_to(ROOT_DIR).as_posix()
+        except ValueError:
+            continue
+        journal.append(key, status, clock.now())
+    journal.sync(journal.seq)
+    pickled_path.unlink()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -55,6 +467,12 @@ app = FastAPI(lifespan=lifespan)
 
 class DirectoryItem(BaseModel):
     dir_name: str
+    storage_mode: str = REPLICATED
+    data_shards: int = DEFAULT_DATA_SHARDS
+    parity_shards: int = DEFAULT_PARITY_SHARDS
+    compression: str | None = None
+    compression_level: int | None = None
+    dedup: bool = False
 
 
 def secure_compare(val1: str, val2: str) -> bool:
@@ -63,73 +481,852 @@ def secure_compare(val1: str, val2: str) -> bool:
 
 @app.middleware("http")
 async def check_authorization(request: Request, call_next):
+    if request.url.path in (HEALTH_PATH, READY_PATH):
+        return await call_next(request)
+    if request.url.path == METRICS_PATH and METRICS_API_KEY is None:
+        return await call_next(request)
+    expected_key = METRICS_API_KEY if request.url.path == METRICS_PATH else API_KEY
     try:
         auth = request.headers["Authorization"]
     except KeyError:
         return JSONResponse(
             status_code=401, content={"error": "Authorization key not found"}
         )
-    if not secure_compare(auth, API_KEY):
+    if not secure_compare(auth, expected_key):
         return JSONResponse(
             status_code=403, content={"error": "Authorization key not found"}
         )
+    if recovery_error is not None and request.url.path not in PROBE_PATHS:
+        return JSONResponse(status_code=500, content={"error": "Startup failed"})
+    if not serving and request.url.path not in PROBE_PATHS:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Starting up"},
+            headers={"Retry-After": str(STARTUP_RETRY_AFTER)},
+        )
     response = await call_next(request)
     return response
 
 
+# Added after the authorization middleware so it wraps it and also counts
+# rejected requests
+app.add_middleware(MetricsMiddleware, registry=metrics_registry, prefix="sds3")
+
+
+@app.get(METRICS_PATH, include_in_schema=False)
+def read_metrics() -> Response:
+    return Response(metrics_registry.render(), media_type=CONTENT_TYPE)
+
+
+@app.get(HEALTH_PATH, include_in_schema=False)
+def read_health() -> JSONResponse:
+    if recovery_error is not None:
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "serving": serving, "error": recovery_error},
+        )
+    return JSONResponse(content={"status": "ok", "serving": serving})
+
+
+@app.get(READY_PATH, include_in_schema=False)
+def read_readiness() -> JSONResponse:
+    content = {
+        "status": "ready" if ready else "starting",
+        "startup_phases": startup_phases,
+    }
+    if serving:
+        content["pending_changes"] = len(journal)
+        content["oldest_change_age"] = journal.oldest_age()
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
+
+# Routes under /_sync are only used between file servers. They are declared
+# before the bucket routes so /_sync/... never matches a bucket name.
+@app.get("/_sync/merkle")
+def read_merkle_roots(peer: str = "") -> dict[str, str]:
+    return metadata_index.merkle_roots(*merkle_scope(peer))
+
+
+@app.get("/_sync/merkle/{bucket_name}")
+def read_merkle_node(
+    bucket_name: str, node: str = "", peer: str = ""
+) -> dict[str, Any]:
+    if not metadata_index.has_bucket(bucket_name):
+        raise HTTPException(status_code=404, detail="Bucket not found")
+    if len(node) > MERKLE_MAX_DEPTH or any(digit not in HEX_DIGITS for digit in node):
+        raise HTTPException(status_code=400, detail="Invalid node")
+    return metadata_index.merkle_node(bucket_name, node, *merkle_scope(peer))
+
+
+@app.get("/_sync/buckets/{bucket_name}")
+def read_bucket_config(bucket_name: str) -> dict[str, Any]:
+    if not metadata_index.has_bucket(bucket_name):
+        raise HTTPException(status_code=404, detail="Bucket not found")
+    return bucket_config(bucket_name)
+
+
+class ObjectList(BaseModel):
+    objects: list[str]
+    # Sent by peers: the version of each object's delete
+    versions: dict[str, str] = {}
+
+
+@app.post("/_sync/versions/{bucket_name}")
+def read_versions(bucket_name: str, object_list: ObjectList) -> dict[str, Any]:
+    """The version of the last write or delete known here of each listed
+    object that has one."""
+    return {
+        "versions": metadata_index.current_versions(bucket_name, object_list.objects)
+    }
+
+
+class ChunkList(BaseModel):
+    chunks: list[str]
+
+
+def parse_chunk_ids(chunk_list: ChunkList) -> list[bytes]:
+    try:
+        chunk_ids = [bytes.fromhex(chunk_id) for chunk_id in chunk_list.chunks]
+    except ValueError:
+        chunk_ids = None
+    if chunk_ids is None or any(len(chunk_id) != 32 for chunk_id in chunk_ids):
+        raise HTTPException(status_code=400, detail="Invalid chunk id")
+    return chunk_ids
+
+
+@app.post("/_sync/chunks/missing")
+def read_missing_chunks(chunk_list: ChunkList) -> dict[str, list[str]]:
+    missing = chunk_store.missing(parse_chunk_ids(chunk_list))
+    return {"missing": [chunk_id.hex() for chunk_id in missing]}
+
+
+@app.post("/_sync/chunks/read")
+def read_chunks(chunk_list: ChunkList) -> Response:
+    """The requested chunks this server has, as chunk records."""
+    chunk_ids = list(chunk_store.stored_sizes(parse_chunk_ids(chunk_list)))
+    try:
+        records = pack_chunk_records(zip(chunk_ids, chunk_store.read(chunk_ids)))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Chunk not found")
+    return Response(records, media_type="application/octet-stream")
+
+
+@app.post("/_sync/chunks")
+async def create_chunks(request: Request):
+    """Store the chunk records in the body that aren't stored here yet.
+
+    They stay unreferenced until the manifests that use them arrive.
+    """
+    try:
+        chunks = unpack_chunk_records(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid chunk records")
+    await run_in_threadpool(store_chunks, chunks)
+    return {"status": "ok", "stored": len(chunks)}
+
+
+def store_chunks(chunks: list[tuple[bytes, bytes]]):
+    missing = set(chunk_store.missing([chunk_id for chunk_id, _ in chunks]))
+    chunk_store.put([chunk for chunk in chunks if chunk[0] in missing])
+
+
+# Bulk routes change many objects of one bucket with one journal write and
+# one replication pass. Like single writes, they can be sent to any server;
+# the journal forwards each object to its owners. Replication uses them too
+# (with X-Sync) to send a peer many small changes at once.
+@app.post("/_bulk/{bucket_name}/delete")
+def delete_objects(
+    bucket_name: str,
+    object_list: ObjectList,
+    background_tasks: BackgroundTasks,
+    request: Request,
+):
+    do_sync = "X-Sync" in request.headers
+    if not metadata_index.has_bucket(bucket_name):
+        raise HTTPException(status_code=404, detail="Bucket not found")
+    # This server may hold no shards of an erasure-coded object, and a peer
+    # deleting something this server never had is already done
+    missing_ok = do_sync or is_erasure_coded(bucket_name)
+    names = []
+    errors = []
+    for object_name in dict.fromkeys(object_list.objects):
+        if not is_valid_object_name(object_name):
+            errors.append({"name": object_name, "message": "Invalid object name"})
+        elif (
+            not has_object(bucket_name, object_name)
+            and not missing_ok
+            and is_owner(bucket_name, object_name)
+        ):
+            errors.append({"name": object_name, "message": "Object not found"})
+        else:
+            names.append(object_name)
+
+    if do_sync:
+        try:
+            versions = {
+                name: received_version(object_list.versions.get(name)) for name in names
+            }
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid version")
+    else:
+        versions = {name: next_version(bucket_name, name) for name in names}
+        journal.append_many(
+            [(f"{bucket_name}/{name}", DELETING, versions[name]) for name in names]
+        )
+    deleted = []
+    for object_name in names:
+        # A delete older than the object's last change has nothing to do
+        try:
+            delete_stored_object(
+                bucket_name, object_name, versions[object_name], missing_ok=True
+            )
+        except OSError as e:
+            errors.append({"name": object_name, "message": str(e)})
+            continue
+        deleted.append(object_name)
+    if not do_sync:
+        journal.commit_many(
+            [(f"{bucket_name}/{name}", DELETED, versions[name]) for name in deleted]
+        )
+    if deleted and not do_sync:
+        background_tasks.add_task(sync_changes)
+    return {"status": "ok", "deleted": deleted, "errors": errors}
+
+
+@app.post("/_bulk/{bucket_name}/upload")
+async def upload_objects(
+    bucket_name: str, request: Request, background_tasks: BackgroundTasks
+):
+    """Store every regular file of a tar stream as an object.
+
+    The archive is spooled to the staging directory and its members are
+    encrypted one at a time, so memory use doesn't depend on its size.
+    Archives from peers hold stored objects, which are kept as they are.
+    """
+    do_sync = "X-Sync" in request.headers
+    if not metadata_index.has_bucket(bucket_name):
+        raise HTTPException(status_code=404, detail="Bucket not found")
+    with chunk_store.pins() as pinned:
+        spooled = NamedTemporaryFile(dir=STAGING_DIR, delete=False)
+        try:
+            with spooled as f:
+                async for chunk in request.stream():
+                    f.write(chunk)
+            staged_objects, errors = await run_in_threadpool(
+                encrypt_tar_members,
+                Path(spooled.name),
+                None if do_sync else bucket_name,
+                pinned,
+            )
+        except tarfile.TarError:
+            raise HTTPException(status_code=400, detail="Body is not a tar archive")
+        finally:
+            Path(spooled.name).unlink(missing_ok=True)
+
+        # The batch's records get consecutive seqs
+        first_seq = 0
+        if not do_sync:
+            last_seq = journal.append_many(
+                [
+                    (f"{bucket_name}/{object_name}", UPLOADING, version)
+                    for object_name, _, version in staged_objects
+                ]
+            )
+            first_seq = last_seq - len(staged_objects) + 1
+        uploaded = []
+        stored = []
+        failed = []
+        for seq, (object_name, staged_path, version) in enumerate(
+            staged_objects, start=first_seq
+        ):
+            try:
+                if not do_sync and is_erasure_coded(bucket_name):
+                    await store_shards(bucket_name, object_name, staged_path, version)
+                else:
+                    await run_in_threadpool(
+                        store_object, bucket_name, object_name, staged_path, version
+                    )
+                uploaded.append(object_name)
+                stored.append((f"{bucket_name}/{object_name}", UPLOADED, version))
+            except OSError as e:
+                staged_path.unlink(missing_ok=True)
+                errors.append({"name": object_name, "message": str(e)})
+                failed.append((f"{bucket_name}/{object_name}", seq))
+    if not do_sync:
+        if stored:
+            await run_in_threadpool(journal.commit_many, stored)
+        # Objects that weren't stored have nothing to replicate, so their
+        # intents are dropped rather than left pending
+        for key, seq in failed:
+            journal.acknowledge(key, seq)
+    if uploaded and not do_sync:
+        background_tasks.add_task(sync_changes)
+    return {"status": "ok", "uploaded": uploaded, "errors": errors}
+
+
+def encrypt_tar_members(
+    tar_path: Path, bucket_name: str | None, pinned: set
+) -> tuple[list[tuple[str, Path, str]], list]:
+    """Encrypt each regular file in the archive into its own staged object
+    for bucket_name, versioned as a new write; returns (name, staged path,
+    version) of each and the errors.
+
+    Without a bucket name the members are already stored objects from a
+    peer and are staged unchanged, under their own names and with the
+    versions in their pax headers.
+    """
+    staged_objects = []
+    errors = []
+    try:
+        with tarfile.open(tar_path) as tar:
+            for member in tar:
+                name = member.name.removeprefix("./")
+                if member.isdir():
+                    continue
+                if not member.isfile() or not is_valid_object_name(name):
+                    errors.append(
+                        {"name": member.name, "message": "Not a file at the top level"}
+                    )
+                    continue
+                if bucket_name is None:
+                    try:
+                        version = received_version(
+                            member.pax_headers.get(VERSION_PAX_HEADER)
+                        )
+                    except ValueError:
+                        errors.append({"name": name, "message": "Invalid version"})
+                        continue
+                    staged = NamedTemporaryFile(dir=STAGING_DIR, delete=False)
+                    staged_objects.append((name, Path(staged.name), version))
+                    with staged as f, tar.extractfile(member) as source:
+                        shutil.copyfileobj(source, f, UPLOAD_CHUNK_SIZE)
+                    continue
+                staged = NamedTemporaryFile(dir=STAGING_DIR, delete=False)
+                version = next_version(bucket_name, f"{name}.enc")
+                staged_objects.append((f"{name}.enc", Path(staged.name), version))
+                with staged as f, tar.extractfile(member) as source:
+                    writer = object_writer(f, bucket_name, pinned)
+                    while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                        writer.write(chunk)
+                    writer.close()
+    except (OSError, tarfile.TarError):
+        for _, staged_path, _ in staged_objects:
+            staged_path.unlink(missing_ok=True)
+        raise
+    return staged_objects, errors
+
+
 @app.get("/{bucket_name}/{object_name}")
-def read_object(bucket_name, object_name) -> FileResponse:
+async def read_object(bucket_name, object_name, request: Request) -> Response:
+    # Peers asking for an erasure-coded object get this server's shard set
+    if "X-Sync" not in request.headers and is_erasure_coded(bucket_name):
+        # Only answerable without a rebuild if a shard set is stored here
+        stored = metadata_index.get_object(bucket_name, object_name)
+        if stored is not None and is_not_modified(request, stored):
+            return Response(status_code=304, headers=validators(stored))
+        response = await read_erasure_coded_object(
+            bucket_name, object_name, request.headers.get("Range")
+        )
+        if stored is not None:
+            response.headers.update(validators(stored))
+        return response
+    return await run_in_threadpool(
+        read_stored_object, bucket_name, object_name, request
+    )
+
+
+def read_stored_object(bucket_name, object_name, request: Request) -> Response:
     path = f"{ROOT_DIR.resolve()}{os.path.sep}{bucket_name}{os.path.sep}{object_name}"
-    if not os.path.exists(path):
+    stored = metadata_index.get_object(bucket_name, object_name)
+    if stored is None and not os.path.exists(path):
+        owner_urls = replica_urls(f"{bucket_name}/{object_name}")
+        if owner_urls and not is_owner(bucket_name, object_name):
+            # Sent here with a stale ring; point the client at an owner
+            return RedirectResponse(
+                f"{owner_urls[0]}{bucket_name}/{object_name}", status_code=307
+            )
         raise HTTPException(status_code=404, detail="Object not found")
+    response_headers = validators(stored) if stored is not None else {}
+    if stored is not None and is_not_modified(request, stored):
+        return Response(status_code=304, headers=response_headers)
+    # Peers get the manifest itself, and fetch the chunks they lack
+    if stored is not None and stored["chunked"] and "X-Sync" not in request.headers:
+        return read_chunked_object(bucket_name, object_name, stored, request)
+    if stored is not None and stored["segment"] is not None:
+        return read_packed_object(bucket_name, object_name, stored, request)
+
+    range_header = request.headers.get("Range")
+    if range_header is not None:
+        with open(path, "rb") as f:
+            prefix = f.read(HEADER.size)
+            # Legacy objects are one GCM message and can only be sent whole
+            if is_framed(prefix):
+                header = ObjectHeader.unpack(prefix)
+                byte_range = parse_range(range_header, header.plaintext_size)
+                if byte_range is not None:
+                    offsets = None
+                    if header.codec != CODEC_NONE:
+                        offsets = metadata_index.frame_offsets(
+                            bucket_name,
+                            object_name,
+                            header.digest,
+                            os.fstat(f.fileno()).st_size,
+                        )
+                    response = read_object_range(
+                        f, object_name, header, *byte_range, offsets
+                    )
+                    response.headers.update(response_headers)
+                    return response
+
+    if stored is not None and object_cache.accepts(stored["stored_size"]):
+        key = f"{bucket_name}/{object_name}"
+        version = tuple(stored.values())
+        data = object_cache.get(key, version)
+        if data is None:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail="Object not found")
+            object_cache.put(key, version, data)
+        return Response(
+            data,
+            media_type="application/octet-stream",
+            headers={
+                **response_headers,
+                "Content-Disposition": f'attachment; filename="{object_name}"',
+            },
+        )
+
     return FileResponse(
         path,
         filename=object_name,
+        headers=response_headers,
     )
 
 
-@app.get("/{bucket_name}")
-def read_bucket(bucket_name) -> list[Any] | None:
-    objects = ROOT_DIR / Path(bucket_name)
-    if objects is None:
-        raise HTTPException(status_code=404, detail="Bucket not found")
+def read_packed_object(
+    bucket_name: str, object_name: str, stored: dict, request: Request
+) -> Response:
+    """Send an object packed into a segment, read with one pread (or from
+    the cache). Packed objects are small, so ranges are cut in memory."""
+    key = f"{bucket_name}/{object_name}"
+    version = tuple(stored.values())
+    data = object_cache.get(key, version)
+    if data is None:
+        data = read_object_bytes(bucket_name, object_name)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Object not found")
+        object_cache.put(key, version, data)
+    response_headers = validators(stored)
 
-    objects = objects.iterdir()
+    range_header = request.headers.get("Range")
+    if range_header is not None and is_framed(data[: HEADER.size]):
+        header = ObjectHeader.unpack(data[: HEADER.size])
+        byte_range = parse_range(range_header, header.plaintext_size)
+        if byte_range is not None:
+            response = read_object_range(
+                io.BytesIO(data), object_name, header, *byte_range
+            )
+            response.headers.update(response_headers)
+            return response
 
-    metadata = []
-    for object in objects:
-        object_size = object.lstat().st_size
-        creation_time = object.stat().st_ctime
-        created_at = datetime.fromtimestamp(creation_time).strftime("%Y-%m-%d %H:%M:%S")
+    return Response(
+        data,
+        media_type="application/octet-stream",
+        headers={
+            **response_headers,
+            "Content-Disposition": f'attachment; filename="{object_name}"',
+        },
+    )
 
-        metadata.append(
-            {
-                "name": object,
-                "size": object_size,
-                "created_at": created_at,
-            }
+
+def read_chunked_object(
+    bucket_name: str, object_name: str, stored: dict, request: Request
+) -> Response:
+    """Send a deduplicated object as its header followed by the frames of
+    its chunks (or of the chunks covering the requested range), read from
+    the chunk segments as they are sent."""
+    manifest = read_manifest(bucket_name, object_name)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Object not found")
+    entries = manifest.entries
+    response_headers = validators(stored)
+    status_code = 200
+    range_header = request.headers.get("Range")
+    if range_header is not None:
+        byte_range = parse_range(range_header, manifest.header.plaintext_size)
+        if byte_range is not None:
+            first, last, offset = manifest.span(*byte_range)
+            entries = entries[first : last + 1]
+            status_code = 206
+            response_headers.update(
+                {
+                    "Content-Range": "bytes {}-{}/{}".format(
+                        *byte_range, manifest.header.plaintext_size
+                    ),
+                    "X-Frame-Offset": str(offset),
+                    "X-Frame-Count": str(len(entries)),
+                }
+            )
+    chunk_ids = [chunk_id for chunk_id, _ in entries]
+    stored_sizes = chunk_store.stored_sizes(chunk_ids)
+    if len(stored_sizes) < len(set(chunk_ids)):
+        raise HTTPException(status_code=500, detail="Object is missing chunks")
+    header_bytes = manifest.header.pack()
+
+    def stream_chunks():
+        yield header_bytes
+        for start in range(0, len(chunk_ids), CHUNK_READ_SIZE):
+            yield b"".join(chunk_store.read(chunk_ids[start : start + CHUNK_READ_SIZE]))
+
+    return StreamingResponse(
+        stream_chunks(),
+        status_code=status_code,
+        media_type="application/octet-stream",
+        headers={
+            **response_headers,
+            "Content-Length": str(
+                len(header_bytes)
+                + sum(stored_sizes[chunk_id] for chunk_id in chunk_ids)
+            ),
+            "Content-Disposition": f'attachment; filename="{object_name}"',
+        },
+    )
+
+
+def validators(stored: dict) -> dict[str, str]:
+    """ETag, Last-Modified and X-Version headers for an indexed object.
+
+    The ETag is the plaintext digest recorded when the object was written,
+    so every replica of an object gives the same one. Peers pulling the
+    object store it with its X-Version.
+    """
+    response_headers = {
+        "Last-Modified": formatdate(stored["created_at"], usegmt=True),
+        VERSION_HEADER: stored["version"],
+    }
+    if stored["digest"] is not None:
+        response_headers["ETag"] = f'"{stored["digest"]}"'
+    return response_headers
+
+
+def is_not_modified(request: Request, stored: dict) -> bool:
+    """Evaluate If-None-Match, or failing that If-Modified-Since."""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        if stored["digest"] is None:
+            return False
+        etags = {
+            etag.strip().removeprefix("W/").strip('"')
+            for etag in if_none_match.split(",")
+        }
+        return stored["digest"] in etags
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stored["created_at"]) <= since
+    return False
+
+
+async def read_erasure_coded_object(
+    bucket_name: str, object_name: str, range_header: str | None = None
+) -> StreamingResponse:
+    """Rebuild an object from the first shard sets that cover enough shards.
+
+    The shard set on this server is tried first. If it isn't enough, the
+    sets on the servers the ring places the object on, and on the holders
+    every fetched set names, are fetched all at once. Streaming starts as
+    soon as the sets fetched so far cover enough shards, and the fetches
+    still running are cancelled. Only sets of the same version (digest and
+    size) are combined. A range is cut from the rebuilt object, decoding
+    only the stripes it needs (and those before it, for compressed frames).
+    """
+    config = bucket_config(bucket_name)
+    key = placement_key(bucket_name, object_name)
+    candidates = (
+        ring.owners(key, config["data_shards"] + config["parity_shards"])
+        if ring
+        else []
+    )
+    versions = {}
+    staged_paths = []
+
+    def add_set(set_path: Path) -> list | None:
+        """Record a shard set and return its version once it is complete."""
+        with open(set_path, "rb") as f:
+            header = read_shard_header(f)
+        if header is None:
+            return None
+        candidates.extend(header.holders)
+        version = versions.setdefault((header.digest, header.stored_size), [])
+        version.append((set_path, header))
+        shards = {shard for _, set_header in version for shard in set_header.shards}
+        return version if len(shards) >= header.data_shards else None
+
+    tried = set()
+    fetches = set()
+
+    def fetch_new_candidates():
+        for server in candidates:
+            if server in tried or is_local_id(server):
+                continue
+            tried.add(server)
+            fetches.add(
+                asyncio.create_task(fetch_shard_set(server, bucket_name, object_name))
+            )
+
+    object_path = ROOT_DIR / bucket_name / object_name
+    version = add_set(object_path) if object_path.exists() else None
+    try:
+        if version is None:
+            fetch_new_candidates()
+        while version is None and fetches:
+            done, fetches = await asyncio.wait(
+                fetches, return_when=asyncio.FIRST_COMPLETED
+            )
+            for fetch in done:
+                set_path = fetch.result()
+                if set_path is None:
+                    continue
+                staged_paths.append(set_path)
+                if version is None:
+                    version = add_set(set_path)
+            if version is None:
+                fetch_new_candidates()
+    finally:
+        for fetch in fetches:
+            fetch.cancel()
+        # A fetch may have finished before it could be cancelled
+        for result in await asyncio.gather(*fetches, return_exceptions=True):
+            if isinstance(result, Path):
+                result.unlink(missing_ok=True)
+    if version is None:
+        for path in staged_paths:
+            path.unlink(missing_ok=True)
+        if not versions:
+            raise HTTPException(status_code=404, detail="Object not found")
+        raise HTTPException(
+            status_code=503, detail="Not enough shards reachable to rebuild object"
         )
 
-    return metadata
+    files = [open(path, "rb") for path, _ in version]
+    reader = ShardSetReader([(f, header) for f, (_, header) in zip(files, version)])
 
+    def close():
+        for f in files:
+            f.close()
+        for path in staged_paths:
+            path.unlink(missing_ok=True)
 
-@app.get("/")
-def read_root() -> list[Any]:
-    metadata = []
-    for bucket in ROOT_DIR.iterdir():
-        bucket_size = bucket.lstat().st_size
-        creation_time = bucket.stat().st_ctime
-        created_at = datetime.fromtimestamp(creation_time).strftime("%Y-%m-%d %H:%M:%S")
-
-        metadata.append(
-            {
-                "name": bucket.name,
-                "size": bucket_size,
-                "created_at": created_at,
-            }
+    # Run once the response is sent or the client has gone; a client that
+    # hangs up as soon as it has every byte leaves the stream unfinished
+    cleanup = BackgroundTask(close)
+    if range_header is not None:
+        try:
+            response = await run_in_threadpool(
+                read_rebuilt_range, reader, object_name, range_header
+            )
+        except BaseException:
+            close()
+            raise
+        if response is not None:
+            response.background = cleanup
+            return response
+    return StreamingResponse(
+        reader.iter_range(0, reader.size),
+        media_type="application/octet-stream",
+        headers={
+            "Content-Length": str(reader.size),
+            "Content-Disposition": f'attachment; filename="{object_name}"',
+        },
+        background=cleanup,
+    )
+
+
+def read_rebuilt_range(
+    reader: ShardSetReader, object_name: str, range_header: str
+) -> StreamingResponse | None:
+    """Send the frames of a rebuilt object covering the requested range,
+    or return None if the whole object should be sent instead."""
+    prefix = reader.read(HEADER.size)
+    # Legacy objects are one GCM message and can only be sent whole
+    if len(prefix) < HEADER.size or not is_framed(prefix):
+        return None
+    header = ObjectHeader.unpack(prefix)
+    byte_range = parse_range(range_header, header.plaintext_size)
+    if byte_range is None:
+        return None
+    return read_object_range(
+        reader, object_name, header, *byte_range, read_span=reader.iter_range
+    )
+
+
+async def fetch_shard_set(
+    server: str, bucket_name: str, object_name: str
+) -> Path | None:
+    staged = NamedTemporaryFile(dir=STAGING_DIR, delete=False)
+    try:
+        with staged as f:
+            async with sync_client.stream(
+                "GET", f"{server_url(server)}{bucket_name}/{object_name}"
+            ) as r:
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        return Path(staged.name)
+    except (OSError, httpx.HTTPError) as e:
+        Path(staged.name).unlink(missing_ok=True)
+        print(e, flush=True)
+        return None
+    except asyncio.CancelledError:
+        Path(staged.name).unlink(missing_ok=True)
+        raise
+
+
+def read_object_range(
+    file,
+    object_name: str,
+    header: ObjectHeader,
+    start: int,
+    end: int,
+    offsets: bytes | None = None,
+    read_span=None,
+) -> StreamingResponse:
+    """Send only the frames covering plaintext bytes start..end (inclusive).
+
+    The body is the object header followed by those frames. X-Frame-Offset
+    is the plaintext offset of the first frame, which the client needs to
+    trim the decrypted frames down to the requested range. offsets is the
+    file's frame offset index, if it has one. read_span(start, end) yields
+    a byte span of file, for one that can't be opened again by name.
+    """
+    first_frame = start // header.frame_size
+    last_frame = end // header.frame_size
+    span_start, span_end = locate_frames(file, header, first_frame, last_frame, offsets)
+    header_bytes = header.pack()
+
+    def stream_span():
+        if read_span is not None:
+            yield header_bytes
+            yield from read_span(span_start, span_end)
+            return
+        if isinstance(file, io.BytesIO):
+            # A packed object, already in memory
+            yield header_bytes + file.getvalue()[span_start:span_end]
+            return
+        with open(file.name, "rb") as f:
+            yield header_bytes
+            f.seek(span_start)
+            remaining = span_end - span_start
+            while remaining > 0:
+                chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    return StreamingResponse(
+        stream_span(),
+        status_code=206,
+        media_type="application/octet-stream",
+        headers={
+            "Content-Range": f"bytes {start}-{end}/{header.plaintext_size}",
+            "Content-Length": str(len(header_bytes) + span_end - span_start),
+            "Content-Disposition": f'attachment; filename="{object_name}"',
+            "X-Frame-Offset": str(first_frame * header.frame_size),
+            "X-Frame-Count": str(last_frame - first_frame + 1),
+        },
+    )
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """Parse a single plaintext byte range, e.g. bytes=0-99, bytes=100- or bytes=-100.
+
+    Returns None when the header should be ignored (malformed or multiple
+    ranges), in which case the whole object is sent.
+    """
+    match = RANGE_REGEX.match(range_header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start = max(size - int(last), 0)
+        end = size - 1 if int(last) > 0 else -1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    if start >= size or end < start:
+        raise HTTPException(
+            status_code=416,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+@app.get("/{bucket_name}")
+async def read_bucket(
+    bucket_name: str,
+    request: Request,
+    prefix: str = "",
+    delimiter: str = "",
+    max_keys: int = MAX_KEYS,
+    continuation_token: str | None = None,
+    start_after: str = "",
+) -> dict[str, Any]:
+    if not metadata_index.has_bucket(bucket_name):
+        raise HTTPException(status_code=404, detail="Bucket not found")
+    try:
+        listing = await run_in_threadpool(
+            metadata_index.list_objects,
+            bucket_name,
+            prefix,
+            delimiter,
+            max_keys,
+            continuation_token,
+            start_after,
         )
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid continuation token")
+    if "X-Sync" in request.headers:
+        return listing
 
-    return metadata
+    # Objects are spread over the cluster, so gather every server's page
+    peer_listings = await asyncio.gather(
+        *(
+            read_peer_listing(peer_url, bucket_name, request.query_params)
+            for peer_url in await get_peer_urls()
+        )
+    )
+    listings = [listing] + [page for page in peer_listings if page is not None]
+    return merge_listings(listings, max_keys)
+
+
+async def read_peer_listing(
+    peer_url: str, bucket_name: str, params: dict
+) -> dict | None:
+    try:
+        r = await sync_client.get(f"{peer_url}{bucket_name}", params=params)
+        r.raise_for_status()
+        return r.json()
+    except (httpx.HTTPError, ValueError) as e:
+        print(e, flush=True)
+        return None
+
+
+@app.get("/")
+def read_root() -> list[Any]:
+    return metadata_index.list_buckets()
 
 
 @app.post("/")
@@ -139,12 +1336,46 @@ def create_bucket(
     do_sync = "X-Sync" in request.headers
     dir_path = Path(directory_name.dir_name)
     target_dir_path = ROOT_DIR / dir_path
+    if dir_path.name.startswith("_"):
+        raise HTTPException(
+            status_code=400, detail="Bucket names starting with _ are reserved"
+        )
+    if f"/{dir_path.name}" in PROBE_PATHS:
+        raise HTTPException(status_code=400, detail="Bucket name is reserved")
+    config = directory_name.model_dump(exclude={"dir_name"})
+    if config["storage_mode"] not in (REPLICATED, ERASURE_CODED):
+        raise HTTPException(status_code=400, detail="Unknown storage mode")
+    if not (
+        directory_name.data_shards >= 1
+        and directory_name.parity_shards >= 1
+        and directory_name.data_shards + directory_name.parity_shards <= MAX_SHARDS
+    ):
+        raise HTTPException(status_code=400, detail="Invalid shard counts")
+    if directory_name.dedup and config["storage_mode"] == ERASURE_CODED:
+        raise HTTPException(
+            status_code=400, detail="Erasure-coded buckets can't be deduplicated"
+        )
+    if directory_name.compression is not None:
+        codec = CODECS.get(directory_name.compression)
+        if codec is None:
+            raise HTTPException(status_code=400, detail="Unknown compression codec")
+        if not codec_available(codec):
+            raise HTTPException(
+                status_code=400,
+                detail=f"{directory_name.compression} compression is not installed",
+            )
+        level = directory_name.compression_level
+        if level is not None and level not in LEVEL_RANGES[codec]:
+            raise HTTPException(status_code=400, detail="Invalid compression level")
+    # Bucket changes are versioned in the journal but applied in the order
+    # replication sends them: creates before objects, deletes after
+    version = clock.now()
     try:
         if not do_sync:
-            journal[target_dir_path] = "UPLOADING"
-        target_dir_path.mkdir()
+            journal.append(dir_path.name, UPLOADING, version)
+        make_bucket(dir_path.name, config)
         if not do_sync:
-            journal[target_dir_path] = "UPLOADED"
+            journal.commit(dir_path.name, UPLOADED, version)
             background_tasks.add_task(sync_changes)
         return {"status": "ok", "message": f"Bucket made: {target_dir_path.resolve()}"}
     except FileExistsError as _:
@@ -162,7 +1393,6 @@ async def create_object(
     file: UploadFile = File(...),
 ):
     do_sync = "X-Sync" in request.headers
-    contents = await file.read()
     transferred_file_path = (
         f"{ROOT_DIR}{os.path.sep}{bucket_name}{os.path.sep}{file.filename}"
     )
@@ -172,28 +1402,322 @@ async def create_object(
     if not Path(transferred_file_path).parent.exists():
         raise HTTPException(status_code=404, detail="Bucket not found")
 
-    if not do_sync:
-        journal[transferred_file_path] = "UPLOADING"
-    hasFileWriteErrored = False
-
-    (ciphertext, nonce, hmac) = encrypt_file(contents, bytes.fromhex(API_KEY))
+    object_name = Path(transferred_file_path).name
+    journal_key = f"{bucket_name}/{object_name}"
+    if do_sync:
+        version = request_version(request)
+    else:
+        version = next_version(bucket_name, object_name)
+        seq = journal.append(journal_key, UPLOADING, version)
 
+    staged = NamedTemporaryFile(dir=STAGING_DIR, delete=False)
     try:
-        with open(transferred_file_path, "wb") as f:
-            f.write(hmac)
-            f.write(nonce)
-            f.write(ciphertext)
-    except OSError:
-        hasFileWriteErrored = True
+        with chunk_store.pins() as pinned:
+            with staged as f:
+                if do_sync:
+                    # Replicated objects arrive already encrypted
+                    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                else:
+                    writer = object_writer(f, bucket_name, pinned)
+                    await write_pipelined(writer, read_upload(file))
+            if not do_sync and is_erasure_coded(bucket_name):
+                await store_shards(bucket_name, object_name, Path(staged.name), version)
+            else:
+                # A peer's change that is older than what is here is dropped
+                await run_in_threadpool(
+                    store_object, bucket_name, object_name, Path(staged.name), version
+                )
+    except OSError as e:
+        print(e, flush=True)
+        Path(staged.name).unlink(missing_ok=True)
+        if not do_sync:
+            # Nothing was stored, so there is nothing to replicate
+            journal.acknowledge(journal_key, seq)
+        raise HTTPException(
+            status_code=500, detail=f"Error storing object: {transferred_file_path}"
+        )
 
     if not do_sync:
-        journal[transferred_file_path] = "UPLOADED"
+        await run_in_threadpool(journal.commit, journal_key, UPLOADED, version)
         background_tasks.add_task(sync_changes)
-    # TODO http error when bucketname doesnt exist
-    if hasFileWriteErrored:
-        return {"status": "error", "filename": f"{transferred_file_path}"}
-    else:
-        return {"status": "ok", "filename": f"{transferred_file_path}"}
+    return {"status": "ok", "filename": f"{transferred_file_path}"}
+
+
+async def read_upload(file: UploadFile):
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+async def write_pipelined(writer: ObjectWriter | ChunkWriter, chunks) -> ObjectHeader:
+    """Feed chunks to writer off the event loop and close it.
+
+    Each chunk is sealed and written in a worker thread while the next one
+    is received, and at most one chunk is in flight, which keeps memory
+    bounded and the frames in order.
+    """
+    pending = None
+    try:
+        async for chunk in chunks:
+            if pending is not None:
+                await pending
+            pending = asyncio.ensure_future(run_in_threadpool(writer.write, chunk))
+        if pending is not None:
+            await pending
+    except BaseException:
+        if pending is not None:
+            # The writer's file must not be closed under the worker
+            await asyncio.wait([pending])
+        raise
+    return await run_in_threadpool(writer.close)
+
+
+@app.post("/{bucket_name}/{object_name}/uploads")
+def create_multipart_upload(bucket_name: str, object_name: str):
+    if not (ROOT_DIR / Path(bucket_name)).exists():
+        raise HTTPException(status_code=404, detail="Bucket not found")
+    upload_id = uuid.uuid4().hex
+    upload_dir = UPLOADS_DIR / upload_id
+    upload_dir.mkdir()
+    with open(upload_dir / "upload.json", "w") as f:
+        json.dump({"bucket_name": bucket_name, "object_name": object_name}, f)
+    return {"status": "ok", "upload_id": upload_id}
+
+
+@app.put("/{bucket_name}/{object_name}/uploads/{upload_id}/{part_number}")
+async def upload_part(
+    bucket_name: str,
+    object_name: str,
+    upload_id: str,
+    part_number: int,
+    request: Request,
+    offset: int = 0,
+):
+    upload_dir = find_upload(bucket_name, object_name, upload_id)
+    if not 1 <= part_number <= MAX_PARTS:
+        raise HTTPException(status_code=400, detail="Invalid part number")
+    if offset < 0 or offset % FRAME_SIZE:
+        raise HTTPException(status_code=400, detail="Invalid part offset")
+
+    # Parts are encrypted as they arrive, so completing the upload only has
+    # to concatenate frames. They are never compressed: every part would
+    # have to agree on the codec in the one header they end up behind.
+    # Frames are sealed for their place in the object, which starts at the
+    # plaintext offset the client gives for the part.
+    staged = NamedTemporaryFile(dir=upload_dir, delete=False)
+    try:
+        with staged as f:
+            writer = ObjectWriter(
+                f,
+                bytes.fromhex(API_KEY),
+                write_header=False,
+                executor=crypto_pool,
+                first_frame=offset // FRAME_SIZE,
+            )
+            header = await write_pipelined(writer, request.stream())
+        os.replace(staged.name, upload_dir / f"{part_number}.part")
+        with open(upload_dir / f"{part_number}.json", "w") as f:
+            json.dump(
+                {
+                    "size": header.plaintext_size,
+                    "digest": header.digest.hex(),
+                    "offset": offset,
+                },
+                f,
+            )
+    except OSError as e:
+        Path(staged.name).unlink(missing_ok=True)
+        return {"status": "error", "message": f"Error writing part: {str(e)}"}
+    return {
+        "status": "ok",
+        "part_number": part_number,
+        "size": header.plaintext_size,
+        "digest": header.digest.hex(),
+    }
+
+
+class CompletedUpload(BaseModel):
+    parts: list[int]
+
+
+@app.post("/{bucket_name}/{object_name}/uploads/{upload_id}")
+async def complete_multipart_upload(
+    bucket_name: str,
+    object_name: str,
+    upload_id: str,
+    completed_upload: CompletedUpload,
+    background_tasks: BackgroundTasks,
+):
+    upload_dir = find_upload(bucket_name, object_name, upload_id)
+    # Keep the sweep of abandoned uploads off it while the parts are joined
+    os.utime(upload_dir)
+    part_numbers = completed_upload.parts
+    if not part_numbers or part_numbers != sorted(set(part_numbers)):
+        raise HTTPException(status_code=400, detail="Parts must be in ascending order")
+
+    parts = []
+    for part_number in part_numbers:
+        try:
+            with open(upload_dir / f"{part_number}.json") as f:
+                parts.append(json.load(f))
+        except OSError:
+            raise HTTPException(
+                status_code=400, detail=f"Part {part_number} was not uploaded"
+            )
+    # Every part but the last must end on a frame boundary, otherwise the
+    # joined object would not be seekable
+    if any(part["size"] % FRAME_SIZE for part in parts[:-1]):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Parts except the last must be a multiple of {FRAME_SIZE} bytes",
+        )
+
+    header = ObjectHeader(
+        flags=FLAG_COMPOSITE_DIGEST,
+        plaintext_size=sum(part["size"] for part in parts),
+        digest=composite_digest(
+            bytes.fromhex(API_KEY), [bytes.fromhex(part["digest"]) for part in parts]
+        ),
+    )
+    transferred_file_path = (
+        f"{ROOT_DIR}{os.path.sep}{bucket_name}{os.path.sep}{object_name}.enc"
+    )
+    journal_key = f"{bucket_name}/{object_name}.enc"
+    version = next_version(bucket_name, f"{object_name}.enc")
+    seq = journal.append(journal_key, UPLOADING, version)
+    staged = NamedTemporaryFile(dir=STAGING_DIR, delete=False)
+    try:
+        with chunk_store.pins() as pinned:
+            if is_deduplicated(bucket_name):
+                await run_in_threadpool(
+                    rechunk_parts,
+                    staged,
+                    header,
+                    upload_dir,
+                    part_numbers,
+                    parts,
+                    object_writer(staged, bucket_name, pinned),
+                )
+            else:
+                await run_in_threadpool(
+                    join_parts, staged, header, upload_dir, part_numbers, parts
+                )
+            if is_erasure_coded(bucket_name):
+                await store_shards(
+                    bucket_name, f"{object_name}.enc", Path(staged.name), version
+                )
+            else:
+                await run_in_threadpool(
+                    store_object,
+                    bucket_name,
+                    f"{object_name}.enc",
+                    Path(staged.name),
+                    version,
+                )
+    except OSError as e:
+        print(e, flush=True)
+        Path(staged.name).unlink(missing_ok=True)
+        # Nothing was stored, so there is nothing to replicate; the parts
+        # stay until the upload is completed again or aborted
+        journal.acknowledge(journal_key, seq)
+        raise HTTPException(
+            status_code=500, detail=f"Error completing upload: {str(e)}"
+        )
+    shutil.rmtree(upload_dir, ignore_errors=True)
+
+    await run_in_threadpool(journal.commit, journal_key, UPLOADED, version)
+    background_tasks.add_task(sync_changes)
+    return {"status": "ok", "filename": f"{transferred_file_path}"}
+
+
+def join_parts(
+    staged,
+    header: ObjectHeader,
+    upload_dir: Path,
+    part_numbers: list[int],
+    parts: list[dict],
+):
+    """Write the header and the frames of the parts behind it.
+
+    A part sealed for another place in the object, because the client
+    didn't send its offset, is decrypted and sealed again.
+    """
+    offset = 0
+    with staged as f:
+        f.write(header.pack())
+        for part_number, part in zip(part_numbers, parts):
+            with open(upload_dir / f"{part_number}.part", "rb") as source:
+                if part.get("offset", 0) == offset:
+                    shutil.copyfileobj(source, f, UPLOAD_CHUNK_SIZE)
+                else:
+                    writer = ObjectWriter(
+                        f,
+                        bytes.fromhex(API_KEY),
+                        write_header=False,
+                        executor=crypto_pool,
+                        first_frame=offset // FRAME_SIZE,
+                    )
+                    decode_part(source, part, writer)
+                    writer.close()
+            offset += part["size"]
+
+
+def rechunk_parts(
+    staged,
+    header: ObjectHeader,
+    upload_dir: Path,
+    part_numbers: list[int],
+    parts: list[dict],
+    writer: ChunkWriter,
+):
+    """Decrypt the parts and store them chunked, for a dedup bucket.
+
+    The object keeps the composite digest of the parts.
+    """
+    with staged:
+        for part_number, part in zip(part_numbers, parts):
+            with open(upload_dir / f"{part_number}.part", "rb") as source:
+                decode_part(source, part, writer)
+        writer.close(header.digest)
+
+
+def decode_part(source, part: dict, writer: ObjectWriter | ChunkWriter):
+    """Decrypt an uploaded part into writer; raises OSError if it fails to
+    decrypt."""
+    decoder = ObjectDecoder(
+        bytes.fromhex(API_KEY),
+        -(-part["size"] // FRAME_SIZE),
+        executor=decrypt_pool,
+        offset=part.get("offset", 0),
+    )
+    decoder.feed(ObjectHeader().pack())
+    try:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            writer.write(decoder.feed(chunk))
+        decoder.finish()
+    except ValueError as e:
+        raise OSError(f"Part failed to decrypt: {e}")
+
+
+@app.delete("/{bucket_name}/{object_name}/uploads/{upload_id}")
+def abort_multipart_upload(bucket_name: str, object_name: str, upload_id: str):
+    upload_dir = find_upload(bucket_name, object_name, upload_id)
+    shutil.rmtree(upload_dir, ignore_errors=True)
+    return {"status": "ok", "message": f"Upload aborted: {upload_id}"}
+
+
+def find_upload(bucket_name: str, object_name: str, upload_id: str) -> Path:
+    upload_dir = UPLOADS_DIR / upload_id
+    try:
+        if not UPLOAD_ID_REGEX.match(upload_id):
+            raise OSError
+        with open(upload_dir / "upload.json") as f:
+            upload = json.load(f)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if upload != {"bucket_name": bucket_name, "object_name": object_name}:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload_dir
 
 
 @app.delete("/{bucket_name}")
@@ -205,12 +1729,21 @@ def delete_bucket(
     if not bucket_path.exists():
         raise HTTPException(status_code=404, detail="Bucket not found")
 
+    version = clock.now()
     try:
         if not do_sync:
-            journal[bucket_path] = "DELETING"
+            journal.append(bucket_name, DELETING, version)
+        if metadata_index.get_bucket_object_count(bucket_name):
+            # Packed objects don't show up in the directory
+            raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), bucket_name)
+        if os.listdir(bucket_path) == [BUCKET_CONFIG_NAME]:
+            (bucket_path / BUCKET_CONFIG_NAME).unlink()
         bucket_path.rmdir()
+        bucket_configs.pop(bucket_name, None)
+        metadata_index.delete_bucket(bucket_name)
+        object_cache.invalidate_bucket(bucket_name)
         if not do_sync:
-            journal[bucket_path] = "DELETED"
+            journal.commit(bucket_name, DELETED, version)
             background_tasks.add_task(sync_changes)
         return {"status": "ok", "message": f"Bucket deleted: {bucket_path.resolve()}"}
     except OSError as e:
@@ -226,15 +1759,34 @@ def delete_object(
 ):
     do_sync = "X-Sync" in request.headers
     object_path = ROOT_DIR / Path(bucket_name) / Path(object_name)
-    if not object_path.exists():
+    # This server may hold no shards of an erasure-coded object; the delete
+    # still goes to every peer
+    erasure_coded = not do_sync and is_erasure_coded(bucket_name)
+    # A peer's delete of something this server doesn't have still leaves a
+    # tombstone, in case an older write of it is on its way
+    if not has_object(bucket_name, object_name) and not erasure_coded and not do_sync:
+        owner_urls = replica_urls(f"{bucket_name}/{object_name}")
+        if owner_urls and not is_owner(bucket_name, object_name):
+            return RedirectResponse(
+                f"{owner_urls[0]}{bucket_name}/{object_name}", status_code=307
+            )
         raise HTTPException(status_code=404, detail="Object not found")
+    if do_sync:
+        if not metadata_index.has_bucket(bucket_name):
+            raise HTTPException(status_code=404, detail="Bucket not found")
+        version = request_version(request)
+    else:
+        version = next_version(bucket_name, object_name)
 
     try:
+        journal_key = f"{bucket_name}/{object_name}"
         if not do_sync:
-            journal[object_path] = "DELETING"
-        object_path.unlink()
+            journal.append(journal_key, DELETING, version)
+        delete_stored_object(
+            bucket_name, object_name, version, missing_ok=erasure_coded or do_sync
+        )
         if not do_sync:
-            journal[object_path] = "DELETED"
+            journal.commit(journal_key, DELETED, version)
             background_tasks.add_task(sync_changes)
         return {"status": "ok", "message": f"Object deleted: {object_path.resolve()}"}
     except OSError as e:
@@ -242,98 +1794,1210 @@ def delete_object(
 
 
 async def sync_changes():
-    name_server_response = httpx.get(NAME_SERVER_URL, headers=headers)
-    file_servers = name_server_response.json()
-
-    changes_to_remove = []
-    # <path>: <status>
-    for path in journal:
-        all_servers_ok = True
-        if journal[path] == "UPLOADED":
-            # windows only
-            for file_server in file_servers:
-                if file_server["host"] == gethostbyname(gethostname()):
-                    continue
+    """Have the journal replicated once writes settle."""
+    replication_scheduler.notify()
+
+
+async def replicate() -> float | None:
+    """Run one replication pass; returns the seconds until a retry is due."""
+    await replicate_journal()
+    retry_delay = peer_backoff.next_retry()
+    if not await rebalance():
+        # A new owner may not be reachable yet, e.g. it registered before it
+        # started listening
+        retry_delay = min(retry_delay or REBALANCE_RETRY_DELAY, REBALANCE_RETRY_DELAY)
+    return retry_delay
+
+
+replication_scheduler = ReplicationScheduler(
+    replicate, REPLICATION_DEBOUNCE, REPLICATION_MAX_DELAY
+)
+
+
+async def get_peer_urls() -> list[str]:
+    if cached_peer_urls is None:
+        name_server_response = await sync_client.get(NAME_SERVER_URL)
+        update_membership(name_server_response.json())
+    return cached_peer_urls
+
+
+def update_membership(file_servers: list[dict]):
+    global cached_peer_urls, ring, ring_generation
+    cached_peer_urls = [
+        server_url(server_id(file_server["host"], file_server["port"]))
+        for file_server in file_servers
+        if not is_local_server(file_server)
+    ]
+    servers = [
+        server_id(file_server["host"], file_server["port"])
+        for file_server in file_servers
+    ]
+    if LOCAL_PORT is not None:
+        # Replicate as a member even before the name server lists us
+        servers.append(server_id(LOCAL_HOST, LOCAL_PORT))
+    new_ring = HashRing(servers, REPLICATION_FACTOR)
+    if new_ring != ring:
+        ring_generation += 1
+    ring = new_ring
+
 
-                target_file_server_url = (
-                    f"http://{file_server['host']}:{file_server['port']}/"
+async def watch_membership():
+    """Keep the peer cache current by long-polling the name server."""
+    global membership_version
+    while True:
+        try:
+            r = await sync_client.get(
+                f"{NAME_SERVER_BASE_URL}/watch",
+                params={"version": membership_version, "timeout": WATCH_TIMEOUT},
+            )
+            r.raise_for_status()
+            membership = r.json()
+        except (httpx.HTTPError, ValueError) as e:
+            print(e, flush=True)
+            await asyncio.sleep(WATCH_RETRY_DELAY)
+            continue
+        if membership["version"] != membership_version:
+            membership_version = membership["version"]
+            generation = ring_generation
+            update_membership(membership["servers"])
+            if ring_generation != generation:
+                # Trees scoped to the old ring are never asked for again
+                await run_in_threadpool(metadata_index.drop_merkle_scopes)
+            # Peers that came back may have missed changes, and objects may
+            # have new owners; nobody has to wait out an old backoff
+            peer_backoff.reset()
+            await sync_changes()
+
+
+async def heartbeat_loop():
+    if LOCAL_PORT is None:
+        return
+    while True:
+        try:
+            await sync_client.post(
+                f"{NAME_SERVER_BASE_URL}/heartbeat",
+                json={"host": LOCAL_HOST, "port": LOCAL_PORT},
+            )
+        except httpx.HTTPError as e:
+            print(e, flush=True)
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+async def deregister_from_name_server():
+    if LOCAL_PORT is None:
+        return
+    try:
+        await sync_client.delete(f"{NAME_SERVER_BASE_URL}/{LOCAL_HOST}/{LOCAL_PORT}")
+    except httpx.HTTPError as e:
+        print(e, flush=True)
+
+
+async def replicate_journal():
+    """Push every pending change to the peers that don't have it yet.
+
+    Changes are grouped per peer, so each peer gets its small objects in a
+    few batches rather than one request per object. Peers that are backing
+    off are skipped; their changes stay in the journal until they're due.
+    """
+    peer_urls = await get_peer_urls()
+    peer_semaphores = {url: asyncio.Semaphore(PEER_CONCURRENCY) for url in peer_urls}
+
+    changes = [
+        change for change in journal.pending() if change[2] in (UPLOADED, DELETED)
+    ]
+    for key in delivered_changes.keys() - {change[0] for change in changes}:
+        del delivered_changes[key]
+    bucket_changes = [change for change in changes if is_bucket_key(change[0])]
+    # A bucket has to exist on a peer before objects are pushed into it, and
+    # has to be emptied before it can be deleted there
+    phases = [
+        [change for change in bucket_changes if change[2] == UPLOADED],
+        [change for change in changes if not is_bucket_key(change[0])],
+        [change for change in bucket_changes if change[2] == DELETED],
+    ]
+    for phase in phases:
+        peer_changes = {}
+        for key, seq, status, version in phase:
+            for url in undelivered_peers(key, seq, status):
+                if peer_backoff.ready(url):
+                    peer_changes.setdefault(url, []).append((key, seq, status, version))
+        results = await asyncio.gather(
+            *(
+                push_changes(
+                    url,
+                    peer_semaphores.setdefault(
+                        url, asyncio.Semaphore(PEER_CONCURRENCY)
+                    ),
+                    changes,
                 )
-                if os.path.isdir(path):
-                    bucket_name = Path(path).name
-                    payload = {"dir_name": bucket_name}
+                for url, changes in peer_changes.items()
+            )
+        )
+        for (url, changes), pushed_keys in zip(peer_changes.items(), results):
+            for key, seq, _, _ in changes:
+                if key in pushed_keys:
+                    delivered = delivered_changes.get(key)
+                    if delivered is None or delivered[0] != seq:
+                        delivered = delivered_changes[key] = (seq, set())
+                    delivered[1].add(url)
+            if len(pushed_keys) == len(changes):
+                peer_backoff.succeeded(url)
+            else:
+                peer_backoff.failed(url)
+
+        for key, seq, status, _ in phase:
+            if undelivered_peers(key, seq, status):
+                continue
+            # Ignored if the key was written again while we were pushing
+            journal.acknowledge(key, seq)
+            delivered_changes.pop(key, None)
+            bucket_name, _, object_name = key.partition("/")
+            if (
+                status == UPLOADED
+                and object_name
+                and not is_owner(bucket_name, object_name)
+                and journal.get(key) is None
+            ):
+                # Written here by a client with a stale ring; the owners
+                # have it now
+                drop_local_object(bucket_name, object_name)
+
+
+def undelivered_peers(key: str, seq: int, status: str) -> list[str]:
+    bucket_name, _, object_name = key.partition("/")
+    if status == UPLOADED and object_name and is_erasure_coded(bucket_name):
+        # Its shard sets were placed when it was written
+        return []
+    delivered = delivered_changes.get(key)
+    delivered_urls = delivered[1] if delivered and delivered[0] == seq else set()
+    return [url for url in replica_urls(key) if url not in delivered_urls]
+
 
-                    r = httpx.post(
-                        target_file_server_url, json=payload, headers=headers
+async def push_changes(
+    peer_url: str,
+    semaphore: asyncio.Semaphore,
+    changes: list[tuple[str, int, str, str]],
+) -> set[str]:
+    """Push changes to one peer; returns the keys it now has.
+
+    Small uploads and all deletes of a bucket go in batches through the
+    bulk routes. Bucket changes and large objects are pushed one by one.
+    Every push carries its version, so they may all run at once and
+    arrive in any order.
+    """
+    singles = []
+    uploads = {}
+    deletes = {}
+    for key, _, status, version in changes:
+        bucket_name, _, object_name = key.partition("/")
+        if not object_name:
+            singles.append((key, status, version))
+        elif status == DELETED:
+            deletes.setdefault(bucket_name, []).append((object_name, version))
+        else:
+            stored = metadata_index.get_object(bucket_name, object_name)
+            size = stored["stored_size"] if stored is not None else 0
+            if size > BATCH_OBJECT_SIZE:
+                singles.append((key, status, version))
+            else:
+                uploads.setdefault(bucket_name, []).append((object_name, size))
+
+    pushes = [push_change_set(peer_url, semaphore, *change) for change in singles]
+    for bucket_name, object_deletes in deletes.items():
+        for start in range(0, len(object_deletes), BATCH_MAX_OBJECTS):
+            batch = object_deletes[start : start + BATCH_MAX_OBJECTS]
+            pushes.append(push_delete_batch(peer_url, semaphore, bucket_name, batch))
+    for bucket_name, objects in uploads.items():
+        for batch in upload_batches(objects):
+            pushes.append(push_upload_batch(peer_url, semaphore, bucket_name, batch))
+    pushed_keys = set()
+    for keys in await asyncio.gather(*pushes):
+        pushed_keys |= keys
+    return pushed_keys
+
+
+def upload_batches(objects: list[tuple[str, int]]) -> list[list[str]]:
+    batches = [[]]
+    batch_size = 0
+    for object_name, size in objects:
+        if batches[-1] and (
+            batch_size + size > BATCH_MAX_BYTES or len(batches[-1]) == BATCH_MAX_OBJECTS
+        ):
+            batches.append([])
+            batch_size = 0
+        batches[-1].append(object_name)
+        batch_size += size
+    return batches
+
+
+async def push_change_set(
+    peer_url: str,
+    semaphore: asyncio.Semaphore,
+    key: str,
+    status: str,
+    version: str | None,
+) -> set[str]:
+    pushed = await push_change(peer_url, semaphore, key, status, version)
+    return {key} if pushed else set()
+
+
+async def push_delete_batch(
+    peer_url: str,
+    semaphore: asyncio.Semaphore,
+    bucket_name: str,
+    object_deletes: list[tuple[str, str]],
+) -> set[str]:
+    """Push deletes, given as (object name, version), of one bucket."""
+    if len(object_deletes) == 1:
+        object_name, version = object_deletes[0]
+        key = f"{bucket_name}/{object_name}"
+        return await push_change_set(peer_url, semaphore, key, DELETED, version)
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            r = await sync_client.post(
+                f"{peer_url}_bulk/{bucket_name}/delete",
+                json={
+                    "objects": [object_name for object_name, _ in object_deletes],
+                    "versions": dict(object_deletes),
+                },
+            )
+            r.raise_for_status()
+            deleted = r.json()["deleted"]
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            print(e, flush=True)
+            replication_push_failures.inc(1, peer_url)
+            return set()
+    replication_push_seconds.observe(time.perf_counter() - start, peer_url)
+    return {f"{bucket_name}/{object_name}" for object_name in deleted}
+
+
+async def push_upload_batch(
+    peer_url: str, semaphore: asyncio.Semaphore, bucket_name: str, object_names: list
+) -> set[str]:
+    if len(object_names) == 1:
+        key = f"{bucket_name}/{object_names[0]}"
+        return await push_change_set(peer_url, semaphore, key, UPLOADED, None)
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            manifests = await run_in_threadpool(
+                lambda: [read_manifest(bucket_name, name) for name in object_names]
+            )
+            manifests = [manifest for manifest in manifests if manifest is not None]
+            if manifests:
+                await push_chunks(peer_url, manifests)
+            archive, missing = await run_in_threadpool(
+                pack_objects, bucket_name, object_names
+            )
+            r = await sync_client.post(
+                f"{peer_url}_bulk/{bucket_name}/upload", content=archive
+            )
+            r.raise_for_status()
+            uploaded = r.json()["uploaded"]
+        except (OSError, httpx.HTTPError, ValueError, KeyError) as e:
+            print(e, flush=True)
+            replication_push_failures.inc(1, peer_url)
+            return set()
+    replication_push_seconds.observe(time.perf_counter() - start, peer_url)
+    # Objects deleted locally since they were journaled count as pushed;
+    # their deletes replicate them
+    return {f"{bucket_name}/{object_name}" for object_name in uploaded + missing}
+
+
+async def push_chunks(peer_url: str, manifests: list[Manifest]):
+    """Send a peer the chunks of manifests it doesn't have, ahead of the
+    manifests themselves. Raises httpx.HTTPError if that fails."""
+    chunk_ids = list(
+        dict.fromkeys(
+            chunk_id for manifest in manifests for chunk_id in manifest.chunk_ids()
+        )
+    )
+    missing = []
+    for start in range(0, len(chunk_ids), CHUNK_QUERY_SIZE):
+        batch = chunk_ids[start : start + CHUNK_QUERY_SIZE]
+        r = await sync_client.post(
+            f"{peer_url}_sync/chunks/missing",
+            json={"chunks": [chunk_id.hex() for chunk_id in batch]},
+        )
+        r.raise_for_status()
+        missing += [bytes.fromhex(chunk_id) for chunk_id in r.json()["missing"]]
+    stored_sizes = await run_in_threadpool(chunk_store.stored_sizes, missing)
+    for batch in upload_batches(list(stored_sizes.items())):
+        records = await run_in_threadpool(
+            lambda: pack_chunk_records(zip(batch, chunk_store.read(batch)))
+        )
+        r = await sync_client.post(f"{peer_url}_sync/chunks", content=records)
+        r.raise_for_status()
+
+
+async def pull_chunks(peer_url: str, manifest: Manifest):
+    """Fetch the chunks of manifest this server lacks from a peer."""
+    missing = await run_in_threadpool(chunk_store.missing, manifest.chunk_ids())
+    for start in range(0, len(missing), CHUNK_READ_SIZE):
+        batch = missing[start : start + CHUNK_READ_SIZE]
+        r = await sync_client.post(
+            f"{peer_url}_sync/chunks/read",
+            json={"chunks": [chunk_id.hex() for chunk_id in batch]},
+        )
+        r.raise_for_status()
+        chunks = unpack_chunk_records(r.content)
+        await run_in_threadpool(store_chunks, chunks)
+
+
+def pack_objects(bucket_name: str, object_names: list[str]) -> tuple[bytes, list]:
+    """Tar up stored objects as they are, each with its version; returns the
+    archive and the names that no longer exist."""
+    archive = io.BytesIO()
+    missing = []
+    with tarfile.open(fileobj=archive, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for object_name in object_names:
+            # Before the object, as in push_change
+            stored = metadata_index.get_object(bucket_name, object_name)
+            data = read_object_bytes(bucket_name, object_name)
+            if data is None:
+                missing.append(object_name)
+                continue
+            member = tarfile.TarInfo(object_name)
+            member.size = len(data)
+            member.pax_headers = {
+                VERSION_PAX_HEADER: UNVERSIONED if stored is None else stored["version"]
+            }
+            tar.addfile(member, io.BytesIO(data))
+    return archive.getvalue(), missing
+
+
+async def rebalance() -> bool:
+    """Move local objects whose owners changed since the last rebalance.
+
+    Objects whose owners didn't change are left alone, so a membership
+    change only moves the key ranges next to the servers that joined or
+    left. Each object that gains owners is pushed to them by the first of
+    its previous owners still in the cluster, and by any previous owner
+    that has to let go of it, which drops its copy once the push succeeds.
+    Owners that already hold the object at its version or a later one are
+    skipped, so a server that rejoins with its data isn't sent it again.
+    """
+    global placed_ring
+    target_ring = ring
+    if target_ring is None or target_ring == placed_ring:
+        return True
+    semaphore = asyncio.Semaphore(PEER_CONCURRENCY)
+    objects = await run_in_threadpool(metadata_index.all_objects)
+    moves = [
+        (bucket_name, object_name, version, *move)
+        for bucket_name, object_name, version in objects
+        if (move := plan_move(placed_ring, target_ring, bucket_name, object_name))
+        is not None
+    ]
+    held = await held_by_owners(semaphore, moves)
+    results = await asyncio.gather(
+        *(
+            move_object(
+                semaphore,
+                bucket_name,
+                object_name,
+                [
+                    owner
+                    for owner in gained_owners
+                    if (owner, bucket_name, object_name) not in held
+                ],
+                keeps_object,
+            )
+            for bucket_name, object_name, _, gained_owners, keeps_object in moves
+        )
+    )
+    if all(results):
+        placed_ring = target_ring
+    return all(results)
+
+
+def plan_move(
+    old_ring: HashRing | None,
+    new_ring: HashRing,
+    bucket_name: str,
+    object_name: str,
+) -> tuple[list[str], bool] | None:
+    """The remote owners an object has to be pushed to and whether this
+    server keeps it, or None if it stays as it is."""
+    key = f"{bucket_name}/{object_name}"
+    if journal.get(key) or is_erasure_coded(bucket_name):
+        # The journal pushes it to the current owners, and shard sets stay
+        # with the holders they were written to
+        return None
+    new_owners = new_ring.owners(placement_key(bucket_name, object_name))
+    keeps_object = any(is_local_id(owner) for owner in new_owners)
+    if old_ring is None:
+        # Nothing is known about where it was before, e.g. at startup
+        if keeps_object:
+            return None
+        gained_owners = new_owners
+    else:
+        old_owners = old_ring.owners(placement_key(bucket_name, object_name))
+        gained_owners = [owner for owner in new_owners if owner not in old_owners]
+        if not gained_owners and keeps_object:
+            return None
+        remaining_owners = [owner for owner in old_owners if owner in new_ring.servers]
+        if keeps_object and remaining_owners and not is_local_id(remaining_owners[0]):
+            return None
+    return [owner for owner in gained_owners if not is_local_id(owner)], keeps_object
+
+
+async def held_by_owners(
+    semaphore: asyncio.Semaphore, moves: list[tuple]
+) -> set[tuple[str, str, str]]:
+    """(owner, bucket, name) of each object to move whose new owner already
+    holds it at the same version or a later one, asked in bulk.
+
+    Unversioned copies can't be told apart, so they are always pushed. An
+    owner that can't be asked gets every object.
+    """
+    wanted = {}
+    for bucket_name, object_name, version, gained_owners, _ in moves:
+        if version == UNVERSIONED:
+            continue
+        for owner in gained_owners:
+            wanted.setdefault((owner, bucket_name), {})[object_name] = version
+    held = set()
+
+    async def ask(owner: str, bucket_name: str, versions: dict[str, str]):
+        names = list(versions)
+        for start in range(0, len(names), VERSION_BATCH_SIZE):
+            batch = names[start : start + VERSION_BATCH_SIZE]
+            async with semaphore:
+                try:
+                    r = await sync_client.post(
+                        f"{server_url(owner)}_sync/versions/{bucket_name}",
+                        json={"objects": batch},
                     )
-                    if r.status_code != 200:
-                        all_servers_ok = False
-                        break
-                else:
-                    file_path = Path(path)
-                    bucket_path = file_path.parent
+                    r.raise_for_status()
+                    owner_versions = r.json()["versions"]
+                except (httpx.HTTPError, ValueError, KeyError) as e:
+                    print(e, flush=True)
+                    return
+            held.update(
+                (owner, bucket_name, name)
+                for name in batch
+                if name in owner_versions and owner_versions[name] >= versions[name]
+            )
 
-                    target_file_server_url += bucket_path.name
+    await asyncio.gather(
+        *(
+            ask(owner, bucket_name, versions)
+            for (owner, bucket_name), versions in wanted.items()
+        )
+    )
+    return held
+
+
+async def move_object(
+    semaphore: asyncio.Semaphore,
+    bucket_name: str,
+    object_name: str,
+    owner_ids: list[str],
+    keeps_object: bool,
+) -> bool:
+    """Push an object to owner_ids, then drop it unless this server keeps it."""
+    key = f"{bucket_name}/{object_name}"
+    results = await asyncio.gather(
+        *(
+            push_change(server_url(owner), semaphore, key, UPLOADED)
+            for owner in owner_ids
+        )
+    )
+    if not all(results):
+        return False
+    if not keeps_object:
+        drop_local_object(bucket_name, object_name)
+    return True
+
+
+def drop_local_object(bucket_name: str, object_name: str):
+    """Remove a copy this server no longer owns, without journaling it."""
+    unlink_object(bucket_name, object_name, missing_ok=True)
+    metadata_index.delete_object(bucket_name, object_name)
+    object_cache.invalidate(f"{bucket_name}/{object_name}")
 
-                    try:
-                        with open(Path(path), "rb") as f:
-                            files = {"file": f}
-                            r = httpx.post(
-                                target_file_server_url,
-                                files=files,
-                                headers=headers,
-                            )
-                            if r.status_code != 200:
-                                all_servers_ok = False
-                                break
-                    except OSError as e:
-                        print(e, flush=True)
-        elif journal[path] == "DELETED":
-            for file_server in file_servers:
-                if file_server["host"] == gethostbyname(gethostname()):
-                    continue
 
-                target_file_server_url = (
-                    f"http://{file_server['host']}:{file_server['port']}/"
+async def push_change(
+    peer_url: str,
+    semaphore: asyncio.Semaphore,
+    key: str,
+    status: str,
+    version: str | None = None,
+) -> bool:
+    """Push one change to a peer. version is that of a delete; an object is
+    sent with the version it is stored with."""
+    path = ROOT_DIR / key
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            if status == UPLOADED and is_bucket_key(key):
+                r = await sync_client.post(
+                    peer_url, json={"dir_name": path.name, **bucket_config(path.name)}
                 )
-                imaginary_path = Path(path)
-                root, ext = os.path.splitext(imaginary_path)
-                if ext:
-                    # if path is obj
-                    bucket_path = imaginary_path.parent
-
-                    target_file_server_url += bucket_path.name
-
-                    thing = f"{target_file_server_url}/{imaginary_path.name}"
-                    r = httpx.delete(
-                        thing,
-                        headers=headers,
+            elif status == UPLOADED:
+                # Looked up before the object is read, so a write in between
+                # can only pair newer bytes with an older version, which
+                # the push of the newer one supersedes
+                stored = await run_in_threadpool(
+                    metadata_index.get_object, path.parent.name, path.name
+                )
+                stored_version = UNVERSIONED if stored is None else stored["version"]
+                manifest = await run_in_threadpool(
+                    read_manifest, path.parent.name, path.name
+                )
+                if manifest is not None:
+                    await push_chunks(peer_url, [manifest])
+                f = await run_in_threadpool(open_object, path.parent.name, path.name)
+                with f:
+                    r = await sync_client.post(
+                        f"{peer_url}{path.parent.name}",
+                        files={"file": (path.name, f)},
+                        headers={VERSION_HEADER: stored_version},
                     )
-                    if r.status_code != 200:
-                        all_servers_ok = False
-                        break
-                else:
-                    # if path is dir
-                    bucket_name = Path(path).name
-                    payload = {"dir_name": bucket_name}
+            elif is_bucket_key(key):
+                r = await sync_client.delete(f"{peer_url}{path.name}")
+            else:
+                r = await sync_client.delete(
+                    f"{peer_url}{path.parent.name}/{path.name}",
+                    headers={VERSION_HEADER: version} if version is not None else None,
+                )
+        except FileNotFoundError:
+            # Deleted locally since it was journaled; the delete replicates it
+            return True
+        except (OSError, ValueError, httpx.HTTPError) as e:
+            print(e, flush=True)
+            replication_push_failures.inc(1, peer_url)
+            return False
+    replication_push_seconds.observe(time.perf_counter() - start, peer_url)
+    # Deleting something a peer never had still leaves it in the right state
+    if r.status_code == 200 or (status == DELETED and r.status_code == 404):
+        return True
+    replication_push_failures.inc(1, peer_url)
+    return False
 
-                    r = httpx.delete(
-                        target_file_server_url + bucket_name,
-                        headers=headers,
-                    )
-                    if r.status_code != 200:
-                        all_servers_ok = False
 
-        if all_servers_ok:
-            changes_to_remove.append(path)
+async def anti_entropy_loop():
+    """Reconcile with every peer periodically, after the pass at startup.
+
+    The journal only replays what this server wrote. Anti-entropy also
+    catches up a server that was down, lost its journal or joined late.
+    """
+    while True:
+        await asyncio.sleep(ANTI_ENTROPY_INTERVAL)
+        await reconcile_with_peers()
+
+
+async def reconcile_with_peers():
+    try:
+        peer_urls = await get_peer_urls()
+    except (OSError, ValueError, httpx.HTTPError) as e:
+        print(e, flush=True)
+        return
+    for peer_url in peer_urls:
+        # One unreachable peer doesn't stop the others being reconciled
+        try:
+            await reconcile_with_peer(peer_url)
+        except (OSError, ValueError, httpx.HTTPError) as e:
+            print(e, flush=True)
+
+
+async def reconcile_with_peer(peer_url: str):
+    """Pull every object the peer has a newer version of than we do, and
+    apply the deletes it has that are newer than our copies.
+
+    Buckets are compared by Merkle root, and only subtrees whose hashes
+    differ are walked, so traffic grows with the difference rather than
+    the number of objects. Both trees only cover the objects placed on
+    both servers. The peer pulls from us in its own pass.
+    """
+    peer = peer_url.removeprefix("http://").rstrip("/")
+    scope = merkle_scope(peer)
+    r = await sync_client.get(f"{peer_url}_sync/merkle", params=scope_params())
+    r.raise_for_status()
+    local_roots = await run_in_threadpool(metadata_index.merkle_roots, *scope)
+    semaphore = asyncio.Semaphore(PEER_CONCURRENCY)
+    for bucket_name, root_hash in r.json().items():
+        if local_roots.get(bucket_name) == root_hash or journal.get(bucket_name):
+            continue
+        if bucket_name not in local_roots:
+            r = await sync_client.get(f"{peer_url}_sync/buckets/{bucket_name}")
+            r.raise_for_status()
+            make_bucket(bucket_name, r.json(), exist_ok=True)
+        if is_erasure_coded(bucket_name):
+            # Shard sets differ between servers by design
+            continue
+        await reconcile_node(peer_url, semaphore, scope, bucket_name, "")
+
+
+async def reconcile_node(
+    peer_url: str,
+    semaphore: asyncio.Semaphore,
+    scope: tuple,
+    bucket_name: str,
+    node: str,
+):
+    async with semaphore:
+        r = await sync_client.get(
+            f"{peer_url}_sync/merkle/{bucket_name}",
+            params={"node": node, **scope_params()},
+        )
+    r.raise_for_status()
+    peer_node = r.json()
+    local_node = await run_in_threadpool(
+        metadata_index.merkle_node, bucket_name, node, *scope
+    )
+    if peer_node["hash"] == local_node["hash"]:
+        return
+
+    if "children" in peer_node:
+        # Where this server's node is a leaf, every child is compared
+        local_children = local_node.get("children", {})
+        await asyncio.gather(
+            *(
+                reconcile_node(peer_url, semaphore, scope, bucket_name, child)
+                for child, child_hash in peer_node["children"].items()
+                if local_children.get(child) != child_hash
+            )
+        )
+        return
+
+    # The peer's node is a leaf; this server's may not be, so only what it
+    # has of the objects the peer listed is looked up
+    local_objects, local_tombstones = await run_in_threadpool(
+        metadata_index.sync_states,
+        bucket_name,
+        [*peer_node["objects"], *peer_node.get("tombstones", {})],
+    )
+    pulls = []
+    for object_name, peer_object in peer_node["objects"].items():
+        if not is_owner(bucket_name, object_name):
+            continue
+        local_object = local_objects.get(object_name)
+        tombstone = local_tombstones.get(object_name)
+        if is_behind(local_object, tombstone, peer_object):
+            pulls.append(pull_object(peer_url, semaphore, bucket_name, object_name))
+    await asyncio.gather(*pulls)
+    # Deletes that didn't reach this server, e.g. while it was down
+    for object_name, version in peer_node.get("tombstones", {}).items():
+        local_object = local_objects.get(object_name)
+        if local_object is not None and version > local_object["version"]:
+            await run_in_threadpool(
+                delete_stored_object,
+                bucket_name,
+                object_name,
+                received_version(version),
+                True,
+            )
+
+
+def is_behind(
+    local_object: dict | None, tombstone: str | None, peer_object: dict
+) -> bool:
+    """Whether a peer's copy of an object is newer than what this server has.
+
+    Versions decide, and copies that both predate versions fall back on
+    which was stored last. Peers from before versions send none.
+    """
+    peer_version = peer_object.get("version", UNVERSIONED)
+    if local_object is None:
+        return tombstone is None or peer_version > tombstone
+    if local_object["digest"] == peer_object["digest"]:
+        return False
+    if peer_version != local_object["version"]:
+        return peer_version > local_object["version"]
+    return local_object["created_at"] < peer_object["created_at"]
+
+
+async def pull_object(
+    peer_url: str, semaphore: asyncio.Semaphore, bucket_name: str, object_name: str
+):
+    """Copy an object from a peer as stored, with its version and without
+    journaling it."""
+    staged = NamedTemporaryFile(dir=STAGING_DIR, delete=False)
+    try:
+        async with semaphore:
+            with staged as f:
+                async with sync_client.stream(
+                    "GET", f"{peer_url}{bucket_name}/{object_name}"
+                ) as r:
+                    r.raise_for_status()
+                    version = received_version(r.headers.get(VERSION_HEADER))
+                    async for chunk in r.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            manifest = await run_in_threadpool(read_staged_manifest, Path(staged.name))
+            if manifest is not None:
+                await pull_chunks(peer_url, manifest)
+        await run_in_threadpool(
+            store_object, bucket_name, object_name, Path(staged.name), version
+        )
+    except (OSError, ValueError, httpx.HTTPError) as e:
+        Path(staged.name).unlink(missing_ok=True)
+        print(e, flush=True)
+
+
+def read_staged_manifest(staged_path: Path) -> Manifest | None:
+    with open(staged_path, "rb") as f:
+        if not is_manifest(f.read(HEADER.size)):
+            return None
+        f.seek(0)
+        return Manifest.unpack(f.read())
+
+
+async def compaction_loop():
+    while True:
+        await asyncio.sleep(COMPACTION_INTERVAL)
+        try:
+            await run_in_threadpool(compact_segments)
+            await run_in_threadpool(sweep_uploads, time.time() - UPLOAD_TTL)
+        except OSError as e:
+            print(e, flush=True)
+
+
+def compact_segments():
+    """Rewrite the segments that are mostly dead records, after dropping
+    the chunks nothing refers to any more, and drop old tombstones."""
+    usage = metadata_index.segment_usage()
+    for segment, size in segment_store.sealed_segments().items():
+        if usage.get(segment, 0) < size * SEGMENT_COMPACT_RATIO:
+            segment_store.compact(
+                segment,
+                metadata_index.packed_offsets(segment),
+                metadata_index.move_packed_object,
+            )
+    chunk_store.collect(time.time() - CHUNK_GRACE_PERIOD)
+    chunk_store.compact(SEGMENT_COMPACT_RATIO)
+    metadata_index.drop_tombstones(time.time() - TOMBSTONE_RETENTION)
+
+
+def sweep_uploads(idle_since: float):
+    """Discard the multipart uploads untouched since idle_since. Creating,
+    replacing or adding a part updates its directory's mtime."""
+    for upload_dir in UPLOADS_DIR.iterdir():
+        try:
+            if upload_dir.stat().st_mtime < idle_since:
+                shutil.rmtree(upload_dir)
+                print(f"Discarded abandoned upload {upload_dir.name}", flush=True)
+        except FileNotFoundError:
+            # Completed or aborted meanwhile
+            continue
+
+
+def store_object(
+    bucket_name: str, object_name: str, staged_path: Path, version: str
+) -> bool:
+    """Move a staged object into place and index it, unless this server has
+    a change of the object at least as new; returns whether it was stored.
+
+    Objects under PACKED_OBJECT_SIZE are appended to a segment; larger ones
+    and shard sets get a file of their own. A staged object that isn't
+    stored is removed.
+    """
+    object_path = ROOT_DIR / bucket_name / object_name
+    check_manifest(staged_path)
+    with object_lock(bucket_name, object_name):
+        with version_lock:
+            if not is_newer(bucket_name, object_name, version):
+                staged_path.unlink(missing_ok=True)
+                return False
+            previous = metadata_index.get_object(bucket_name, object_name)
+        if staged_path.stat().st_size < PACKED_OBJECT_SIZE and not is_erasure_coded(
+            bucket_name
+        ):
+            data = staged_path.read_bytes()
+            created_at = time.time()
+            location = segment_store.append(bucket_name, object_name, data, created_at)
+            with version_lock:
+                metadata_index.put_packed_object(
+                    bucket_name,
+                    object_name,
+                    data,
+                    len(data),
+                    created_at,
+                    location,
+                    version,
+                )
+            staged_path.unlink()
+            # An earlier version may have had its own file
+            object_path.unlink(missing_ok=True)
+        else:
+            os.replace(staged_path, object_path)
+            with version_lock:
+                metadata_index.put_object(bucket_name, object_path, version)
+            if previous is not None and previous["segment"] is not None:
+                # Or the packed version would come back if the index is
+                # rebuilt after this one is deleted
+                segment_store.delete(bucket_name, object_name)
+    object_cache.invalidate(f"{bucket_name}/{object_name}")
+    return True
+
+
+def delete_stored_object(
+    bucket_name: str, object_name: str, version: str, missing_ok: bool = False
+) -> bool:
+    """Delete an object and leave a tombstone, unless this server has a
+    change of it at least as new; returns whether it was deleted."""
+    with object_lock(bucket_name, object_name):
+        with version_lock:
+            if not is_newer(bucket_name, object_name, version):
+                return False
+        unlink_object(bucket_name, object_name, missing_ok=missing_ok)
+        with version_lock:
+            metadata_index.delete_object(bucket_name, object_name, version)
+    object_cache.invalidate(f"{bucket_name}/{object_name}")
+    return True
+
+
+def object_lock(bucket_name: str, object_name: str) -> threading.Lock:
+    return object_locks[hash((bucket_name, object_name)) % OBJECT_LOCK_STRIPES]
+
+
+def is_newer(bucket_name: str, object_name: str, version: str) -> bool:
+    return supersedes(version, metadata_index.current_version(bucket_name, object_name))
+
+
+def next_version(bucket_name: str, object_name: str) -> str:
+    """Version of a change made here, newer than any this server knows of
+    for the object."""
+    current = metadata_index.current_version(bucket_name, object_name)
+    if current is not None:
+        clock.update(current)
+    return clock.now()
+
+
+def received_version(version: str | None) -> str:
+    """Check the version of a change from a peer and move the clock past
+    it; raises ValueError if it is malformed."""
+    return clock.receive(version)
+
+
+def request_version(request: Request) -> str:
+    try:
+        return received_version(request.headers.get(VERSION_HEADER))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid version")
+
+
+def check_manifest(staged_path: Path):
+    """Raise OSError if the staged object is a manifest whose chunks aren't
+    all stored here."""
+    with open(staged_path, "rb") as f:
+        if not is_manifest(f.read(HEADER.size)):
+            return
+        f.seek(0)
+        try:
+            manifest = Manifest.unpack(f.read())
+        except ValueError as e:
+            raise OSError(str(e))
+    missing = chunk_store.missing(manifest.chunk_ids())
+    if missing:
+        raise OSError(f"{len(missing)} chunks of the object aren't stored here")
+
+
+def read_manifest(bucket_name: str, object_name: str) -> Manifest | None:
+    """The manifest of a deduplicated object, or None if the object isn't
+    one (any more)."""
+    stored = metadata_index.get_object(bucket_name, object_name)
+    if stored is None or not stored["chunked"]:
+        return None
+    data = read_object_bytes(bucket_name, object_name)
+    return Manifest.unpack(data) if data is not None else None
+
+
+def read_object_bytes(bucket_name: str, object_name: str) -> bytes | None:
+    """Read a whole stored object, packed or not, or None if it's gone."""
+    # Looked up again if compaction moved it in between
+    for _ in range(2):
+        stored = metadata_index.get_object(bucket_name, object_name)
+        if stored is None or stored["segment"] is None:
+            try:
+                return (ROOT_DIR / bucket_name / object_name).read_bytes()
+            except FileNotFoundError:
+                return None
+        data = segment_store.read(
+            stored["segment"],
+            stored["offset"],
+            bucket_name,
+            object_name,
+            stored["stored_size"],
+        )
+        if data is not None:
+            return data
+    return None
+
+
+def open_object(bucket_name: str, object_name: str):
+    """Open a stored object for reading; packed objects are read into memory."""
+    stored = metadata_index.get_object(bucket_name, object_name)
+    if stored is not None and stored["segment"] is not None:
+        data = read_object_bytes(bucket_name, object_name)
+        if data is None:
+            raise FileNotFoundError(f"{bucket_name}/{object_name}")
+        return io.BytesIO(data)
+    return open(ROOT_DIR / bucket_name / object_name, "rb")
 
-    for path in changes_to_remove:
-        del journal[path]
+
+def has_object(bucket_name: str, object_name: str) -> bool:
+    return (
+        metadata_index.get_object(bucket_name, object_name) is not None
+        or (ROOT_DIR / bucket_name / object_name).exists()
+    )
+
+
+def unlink_object(bucket_name: str, object_name: str, missing_ok: bool = False):
+    """Remove a stored object's data; the caller updates the index."""
+    stored = metadata_index.get_object(bucket_name, object_name)
+    if stored is not None and stored["segment"] is not None:
+        segment_store.delete(bucket_name, object_name)
+        missing_ok = True
+    (ROOT_DIR / bucket_name / object_name).unlink(missing_ok=missing_ok)
+
+
+def make_bucket(bucket_name: str, config: dict, exist_ok: bool = False):
+    bucket_path = ROOT_DIR / bucket_name
+    bucket_path.mkdir(exist_ok=exist_ok)
+    if (
+        config.get("storage_mode", REPLICATED) != REPLICATED
+        or config.get("compression")
+        or config.get("dedup")
+    ):
+        with open(bucket_path / BUCKET_CONFIG_NAME, "w") as f:
+            json.dump(config, f)
+    bucket_configs[bucket_name] = config
+    metadata_index.put_bucket(bucket_name, bucket_path.stat().st_ctime)
+
+
+def bucket_config(bucket_name: str) -> dict:
+    if bucket_name not in bucket_configs:
+        try:
+            with open(ROOT_DIR / bucket_name / BUCKET_CONFIG_NAME) as f:
+                bucket_configs[bucket_name] = json.load(f)
+        except OSError:
+            return {"storage_mode": REPLICATED}
+    return bucket_configs[bucket_name]
+
+
+def is_erasure_coded(bucket_name: str) -> bool:
+    return bucket_config(bucket_name).get("storage_mode") == ERASURE_CODED
+
+
+def is_deduplicated(bucket_name: str) -> bool:
+    return bool(bucket_config(bucket_name).get("dedup"))
+
+
+def object_writer(file, bucket_name: str, pinned: set) -> ObjectWriter | ChunkWriter:
+    """Writer encrypting a new object for bucket_name into file.
+
+    Dedup buckets get their objects chunked; the chunks are pinned in
+    pinned until the object is stored.
+    """
+    key = bytes.fromhex(API_KEY)
+    if is_deduplicated(bucket_name):
+        return ChunkWriter(
+            file,
+            key,
+            chunk_store,
+            pinned,
+            executor=crypto_pool,
+            **compression_settings(bucket_name),
+        )
+    return ObjectWriter(
+        file, key, executor=crypto_pool, **compression_settings(bucket_name)
+    )
+
+
+def compression_settings(bucket_name: str) -> dict[str, Any]:
+    """ObjectWriter arguments for a bucket's compression settings."""
+    config = bucket_config(bucket_name)
+    codec = CODECS.get(config.get("compression"), CODEC_NONE)
+    if not codec_available(codec):
+        # The bucket was made on a server with zstandard installed
+        return {"codec": CODEC_ZLIB}
+    return {"codec": codec, "level": config.get("compression_level")}
+
+
+async def store_shards(
+    bucket_name: str, object_name: str, object_path: Path, version: str
+):
+    """Erasure-code the encrypted object at object_path over the cluster.
+
+    Shard i goes to the (i mod n)th of the n servers the ring places the
+    object on, and each server gets all of its shards as one shard set.
+    With fewer servers than shards, losing one server loses several shards.
+    Raises OSError unless every shard set was stored, after deleting the
+    sets that were.
+    """
+    config = bucket_config(bucket_name)
+    data_shards, parity_shards = config["data_shards"], config["parity_shards"]
+    key = placement_key(bucket_name, object_name)
+    servers = ring.owners(key, data_shards + parity_shards) if ring else []
+    if not servers:
+        raise OSError("No file servers to store shards on")
+    holders = [
+        servers[shard % len(servers)] for shard in range(data_shards + parity_shards)
+    ]
+    with open(object_path, "rb") as f:
+        object_header = read_header(f)
+        stored_size = os.fstat(f.fileno()).st_size
+    set_headers = [
+        ShardSetHeader(
+            data_shards,
+            parity_shards,
+            chunk_size_for(stored_size, data_shards),
+            stored_size,
+            object_header.plaintext_size,
+            object_header.digest,
+            holders,
+            [shard for shard, holder in enumerate(holders) if holder == server],
+        )
+        for server in servers
+    ]
+    set_files = [NamedTemporaryFile(dir=STAGING_DIR, delete=False) for _ in servers]
+    try:
+        await run_in_threadpool(encode_shard_sets, object_path, set_files, set_headers)
+        results = await asyncio.gather(
+            *(
+                place_shard_set(server, bucket_name, object_name, Path(f.name), version)
+                for server, f in zip(servers, set_files)
+            )
+        )
+    finally:
+        for f in set_files:
+            Path(f.name).unlink(missing_ok=True)
+        object_path.unlink(missing_ok=True)
+    if not all(results):
+        # A partly stored version can't be relied on to rebuild, so the
+        # sets that made it are deleted again, by a change newer than them
+        rollback_version = next_version(bucket_name, object_name)
+        await asyncio.gather(
+            *(
+                remove_shard_set(server, bucket_name, object_name, rollback_version)
+                for server, stored in zip(servers, results)
+                if stored
+            )
+        )
+        raise OSError("Could not store every shard set")
+
+
+def encode_shard_sets(object_path: Path, set_files: list, set_headers: list):
+    with open(object_path, "rb") as source:
+        write_shard_sets(source, set_files, set_headers)
+    for f in set_files:
+        f.close()
 
 
-def encrypt_file(file_data, key):
-    cipher = AES.new(key, AES.MODE_GCM)
-    ciphertext, hmac = cipher.encrypt_and_digest(file_data)
-    return (ciphertext, cipher.nonce, hmac)
+async def place_shard_set(
+    server: str, bucket_name: str, object_name: str, set_path: Path, version: str
+) -> bool:
+    if is_local_id(server):
+        try:
+            await run_in_threadpool(
+                store_object, bucket_name, object_name, set_path, version
+            )
+        except OSError as e:
+            print(e, flush=True)
+            return False
+        return True
+    try:
+        with open(set_path, "rb") as f:
+            r = await sync_client.post(
+                f"{server_url(server)}{bucket_name}",
+                files={"file": (object_name, f)},
+                headers={VERSION_HEADER: version},
+            )
+    except (OSError, httpx.HTTPError) as e:
+        print(e, flush=True)
+        return False
+    return r.status_code == 200 and r.json()["status"] == "ok"
+
+
+async def remove_shard_set(
+    server: str, bucket_name: str, object_name: str, version: str
+):
+    if is_local_id(server):
+        await run_in_threadpool(
+            delete_stored_object, bucket_name, object_name, version, missing_ok=True
+        )
+        return
+    try:
+        r = await sync_client.delete(
+            f"{server_url(server)}{bucket_name}/{object_name}",
+            headers={VERSION_HEADER: version},
+        )
+        r.raise_for_status()
+    except httpx.HTTPError as e:
+        print(e, flush=True)
+
+
+def is_local_server(file_server: dict) -> bool:
+    if file_server["host"] != LOCAL_HOST:
+        return False
+    # Without a known port every server on this host is assumed to be us
+    return LOCAL_PORT is None or file_server["port"] == LOCAL_PORT
+
+
+def is_local_id(file_server_id: str) -> bool:
+    host, _, port = file_server_id.rpartition(":")
+    return is_local_server({"host": host, "port": int(port)})
+
+
+def server_url(file_server_id: str) -> str:
+    return f"http://{file_server_id}/"
+
+
+def is_owner(bucket_name: str, object_name: str) -> bool:
+    if ring is None or not len(ring) or is_erasure_coded(bucket_name):
+        return True
+    owners = ring.owners(placement_key(bucket_name, object_name))
+    return any(is_local_id(owner) for owner in owners)
+
+
+def merkle_scope(peer: str) -> tuple[str, Callable | None]:
+    """Scope of the Merkle trees compared with a peer, and which objects
+    are in it: those the ring places on both this server and the peer.
+    Without a peer, a ring or our own port the trees cover every object."""
+    if not peer or ring is None or not len(ring) or LOCAL_PORT is None:
+        return "", None
+    placement = ring
+
+    def owns(bucket_name: str, object_name: str) -> bool:
+        if is_erasure_coded(bucket_name):
+            return True
+        owners = placement.owners(placement_key(bucket_name, object_name))
+        return peer in owners and any(is_local_id(owner) for owner in owners)
+
+    return f"{peer}@{ring_generation}", owns
+
+
+def scope_params() -> dict[str, str]:
+    """Query parameters asking a peer for trees scoped to both of us."""
+    if LOCAL_PORT is None:
+        return {}
+    return {"peer": server_id(LOCAL_HOST, LOCAL_PORT)}
+
+
+def replica_urls(key: str) -> list[str]:
+    """Peers a journaled change goes to: every peer for buckets, the other
+    owners for objects."""
+    bucket_name, _, object_name = key.partition("/")
+    if not object_name or ring is None or is_erasure_coded(bucket_name):
+        return cached_peer_urls or []
+    return [
+        server_url(owner)
+        for owner in ring.owners(placement_key(bucket_name, object_name))
+        if not is_local_id(owner)
+    ]
+
+
+def is_bucket_key(key: str) -> bool:
+    return "/" not in key
+
+
+def is_valid_object_name(name: str) -> bool:
+    return (
+        bool(name) and "/" not in name and "\\" not in name and not name.startswith(".")
+    )
 
 
 def is_accessible_path(path: Path) -> bool:
@@ -0,0 +1,230 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# Append-only replication journal.
+#
+# Every change is one record: crc32 | seq | ref | op | key_len | key, then
+# version_len | version when op has OP_VERSIONED set. seq increases by one
+# per record. ACK records carry the seq of the change they acknowledge in
+# ref and no version; all other records leave ref at 0. Changes carry the
+# version of the write or delete (see versions), except in logs written
+# before changes had versions. A torn record at the tail (crash
+# mid-append) fails its crc and is cut off on replay.
+
+RECORD = struct.Struct("<IQQBH")
+VERSION_LENGTH = struct.Struct("<B")
+OP_VERSIONED = 0x80
+
+UPLOADING = "UPLOADING"
+UPLOADED = "UPLOADED"
+DELETING = "DELETING"
+DELETED = "DELETED"
+ACK = "ACK"
+
+OPS = [UPLOADING, UPLOADED, DELETING, DELETED, ACK]
+OP_CODES = {op: code for code, op in enumerate(OPS, start=1)}
+
+# Compact once this many records are dead and they outnumber the live ones
+COMPACT_MIN_DEAD_RECORDS = 10000
+
+
+class Journal:
+    """Durable map of key -> (seq, status, version) for changes not yet
+    replicated.
+
+    Appends are written straight to the log; fsyncs happen on a background
+    thread. Callers that need durability wait in sync(), and every waiter
+    that arrived during one fsync is released by the next, so many writes
+    share each fsync (group commit).
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries = {}
+        # When each pending change was made, as far as this process knows;
+        # changes replayed from disk count from startup
+        self.appended_at = {}
+        self.seq = 0
+        self.durable_seq = 0
+        self.dead_records = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self._replay()
+        self.appended_at = dict.fromkeys(self.entries, time.monotonic())
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.durable_seq = self.seq
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def append(self, key: str, status: str, version: str) -> int:
+        with self.cond:
+            self.seq += 1
+            if key in self.entries:
+                self.dead_records += 1
+            self.entries[key] = (self.seq, status, version)
+            self.appended_at[key] = time.monotonic()
+            os.write(self.fd, pack_record(self.seq, 0, status, key, version))
+            self.cond.notify_all()
+            return self.seq
+
+    def append_many(self, changes: list[tuple[str, str, str]]) -> int:
+        """Append a batch of (key, status, version) changes with a single
+        write.
+
+        Returns the seq of the last one, which sync() takes to wait for the
+        whole batch.
+        """
+        with self.cond:
+            records = []
+            for key, status, version in changes:
+                self.seq += 1
+                if key in self.entries:
+                    self.dead_records += 1
+                self.entries[key] = (self.seq, status, version)
+                self.appended_at[key] = time.monotonic()
+                records.append(pack_record(self.seq, 0, status, key, version))
+            os.write(self.fd, b"".join(records))
+            self.cond.notify_all()
+            return self.seq
+
+    def sync(self, seq: int):
+        """Block until the record with this seq is on disk."""
+        with self.cond:
+            while self.durable_seq < seq and not self.closed:
+                self.cond.wait()
+
+    def commit(self, key: str, status: str, version: str) -> int:
+        seq = self.append(key, status, version)
+        self.sync(seq)
+        return seq
+
+    def commit_many(self, changes: list[tuple[str, str, str]]) -> int:
+        seq = self.append_many(changes)
+        self.sync(seq)
+        return seq
+
+    def acknowledge(self, key: str, seq: int):
+        """Drop a change once every peer has it, unless it was superseded."""
+        with self.cond:
+            if self.entries.get(key, (None,))[0] != seq:
+                return
+            del self.entries[key]
+            del self.appended_at[key]
+            self.seq += 1
+            # The change record and this ack are both dead from now on
+            self.dead_records += 2
+            os.write(self.fd, pack_record(self.seq, seq, ACK, key))
+            self.cond.notify_all()
+
+    def get(self, key: str) -> str | None:
+        with self.cond:
+            entry = self.entries.get(key)
+        return entry[1] if entry else None
+
+    def pending(self) -> list[tuple[str, int, str, str]]:
+        """(key, seq, status, version) of every change not yet replicated."""
+        with self.cond:
+            return [(key, *entry) for key, entry in self.entries.items()]
+
+    def oldest_age(self) -> float:
+        """Seconds the oldest change still waiting to replicate has waited."""
+        with self.cond:
+            if not self.appended_at:
+                return 0.0
+            return time.monotonic() - min(self.appended_at.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.flusher.join()
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while self.durable_seq == self.seq and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                target = self.seq
+                fd = self.fd
+            os.fsync(fd)
+            with self.cond:
+                self.durable_seq = max(self.durable_seq, target)
+                self.cond.notify_all()
+                if (
+                    self.dead_records >= COMPACT_MIN_DEAD_RECORDS
+                    and self.dead_records > len(self.entries)
+                ):
+                    self._compact()
+
+    def _compact(self):
+        """Rewrite the log with only the live entries. Caller holds the lock."""
+        compacted_path = self.path.with_suffix(".compact")
+        with open(compacted_path, "wb") as f:
+            for key, (seq, status, version) in sorted(
+                self.entries.items(), key=lambda item: item[1][0]
+            ):
+                f.write(pack_record(seq, 0, status, key, version))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(compacted_path, self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.dead_records = 0
+        # Everything still live was just fsynced as part of the new log
+        self.durable_seq = self.seq
+
+    def _replay(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        records = 0
+        while offset + RECORD.size <= len(data):
+            crc, seq, ref, op_code, key_len = RECORD.unpack_from(data, offset)
+            key_end = end = offset + RECORD.size + key_len
+            version = ""
+            if op_code & OP_VERSIONED and end < len(data):
+                version_start = end + VERSION_LENGTH.size
+                end = version_start + data[end]
+                version = data[version_start:end].decode(errors="replace")
+            if end > len(data) or zlib.crc32(data[offset + 4 : end]) != crc:
+                break
+            key = data[offset + RECORD.size : key_end].decode()
+            op = OPS[(op_code & ~OP_VERSIONED) - 1]
+            if op == ACK:
+                if self.entries.get(key, (None,))[0] == ref:
+                    del self.entries[key]
+            else:
+                self.entries[key] = (seq, op, version)
+            self.seq = max(self.seq, seq)
+            records += 1
+            offset = end
+        if offset < len(data):
+            # Drop the torn tail so new records aren't appended after garbage
+            os.truncate(self.path, offset)
+        self.dead_records = records - len(self.entries)
+
+
+def pack_record(seq: int, ref: int, op: str, key: str, version: str = "") -> bytes:
+    key_bytes = key.encode()
+    op_code = OP_CODES[op]
+    if version:
+        op_code |= OP_VERSIONED
+    body = RECORD.pack(0, seq, ref, op_code, len(key_bytes))[4:] + key_bytes
+    if version:
+        version_bytes = version.encode()
+        body += VERSION_LENGTH.pack(len(version_bytes)) + version_bytes
+    return struct.pack("<I", zlib.crc32(body)) + body
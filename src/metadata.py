@@ -0,0 +1,1040 @@
+import base64
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+
+from chunks import CHUNK_SEGMENT_BUCKET
+from erasure import read_shard_header
+from object_format import (
+    FLAG_MANIFEST,
+    HEADER,
+    LEGACY_HEADER_SIZE,
+    Manifest,
+    index_frames,
+    is_manifest,
+    read_header,
+)
+from segments import RECORD, SegmentStore
+from versions import UNVERSIONED
+
+# Bump when the schema changes; an index with another version is rebuilt
+# from the files under the root directory.
+SCHEMA_VERSION = 9
+
+SCHEMA = """
+CREATE TABLE buckets (
+    name TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    object_count INTEGER NOT NULL DEFAULT 0,
+    logical_bytes INTEGER NOT NULL DEFAULT 0,
+    stored_bytes INTEGER NOT NULL DEFAULT 0,
+    chunked_bytes INTEGER NOT NULL DEFAULT 0,
+    chunk_bytes INTEGER NOT NULL DEFAULT 0,
+    chunk_stored_bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE objects (
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL,
+    digest TEXT,
+    created_at REAL NOT NULL,
+    shard TEXT NOT NULL,
+    segment INTEGER,
+    offset INTEGER,
+    chunked INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    PRIMARY KEY (bucket, name)
+) WITHOUT ROWID;
+CREATE INDEX objects_by_shard ON objects (bucket, shard);
+CREATE INDEX objects_by_segment ON objects (segment) WHERE segment IS NOT NULL;
+CREATE TABLE tombstones (
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    shard TEXT NOT NULL,
+    deleted_at REAL NOT NULL,
+    PRIMARY KEY (bucket, name)
+) WITHOUT ROWID;
+CREATE INDEX tombstones_by_shard ON tombstones (bucket, shard);
+CREATE INDEX tombstones_by_age ON tombstones (deleted_at);
+CREATE TABLE chunks (
+    chunk BLOB PRIMARY KEY,
+    stored_size INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0,
+    released_at REAL NOT NULL,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX chunks_by_segment ON chunks (segment);
+CREATE INDEX unreferenced_chunks ON chunks (released_at) WHERE refs = 0;
+CREATE TABLE object_chunks (
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,
+    chunk BLOB NOT NULL,
+    PRIMARY KEY (bucket, name, chunk)
+) WITHOUT ROWID;
+CREATE TABLE bucket_chunks (
+    bucket TEXT NOT NULL,
+    chunk BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL,
+    PRIMARY KEY (bucket, chunk)
+) WITHOUT ROWID;
+CREATE TABLE merkle_nodes (
+    bucket TEXT NOT NULL,
+    node TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (bucket, node, scope)
+) WITHOUT ROWID;
+CREATE TABLE frame_offsets (
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,
+    offsets BLOB NOT NULL,
+    PRIMARY KEY (bucket, name)
+);
+"""
+
+MAX_KEYS = 1000
+# Names looked up per query by current_versions
+VERSION_QUERY_SIZE = 500
+
+# Size of a chunk's segment record beyond its frame; chunks are named by
+# their id in hex
+CHUNK_RECORD_OVERHEAD = RECORD.size + len(CHUNK_SEGMENT_BUCKET) + 64
+
+# Chunk ids per query, under SQLite's limit on bound parameters
+CHUNK_QUERY_SIZE = 500
+
+# Each bucket's Merkle tree follows the hex digits of sha256(object name),
+# its shard. A node is named by a prefix of them, so the root is "" and a
+# node's 16 children each add one digit. A node covering at most
+# MERKLE_LEAF_SIZE objects, or MERKLE_MAX_DEPTH digits long, is a leaf
+# and hashes its objects' names and digests; a larger one hashes its
+# children's hashes. The tree deepens as the bucket grows, so a leaf
+# that differs never lists more than MERKLE_LEAF_SIZE objects (bar hash
+# collisions), and as the shape only depends on the objects covered,
+# servers that hold the same objects build the same tree. Node hashes are
+# cached and dropped whenever one of their objects changes.
+#
+# A server only holds the objects placed on it, so two servers compare
+# trees scoped to the objects placed on both. A scope names such a subset
+# and owns(bucket, name) tells which objects are in it; the unscoped tree
+# ("") covers every object. Scoped hashes are cached alongside the
+# unscoped ones, under the scope's name.
+HEX_DIGITS = "0123456789abcdef"
+MERKLE_MAX_DEPTH = 8
+MERKLE_LEAF_SIZE = 128
+
+
+class MetadataIndex:
+    """SQLite index of buckets and objects, kept up to date by the write paths.
+
+    Listings are answered from here so they never touch the filesystem. Each
+    bucket row also carries running totals of its objects and their
+    plaintext (logical) and on-disk (stored) bytes, adjusted in the same
+    transaction as every object write or delete. Objects packed into a
+    segment have its number and their record's offset in it; the others
+    are files named after them in their bucket's directory.
+
+    Every object has the version of the write that stored it, and a delete
+    leaves a tombstone with its version (see versions) until it is old
+    enough to be dropped. Versions can't be recovered from the stored
+    objects, so a rebuild carries them over from the old index; objects it
+    has no version for get UNVERSIONED.
+
+    Deduplicated objects are manifests whose chunks live in chunk_segments.
+    Each chunk row counts the objects referring to it. The same transaction
+    that indexes or removes a manifest adjusts those counts, and each
+    bucket's totals of the plaintext it stores as chunks and of the
+    distinct chunks that takes.
+
+    Compressed objects stored as files also have a frame offset index (see
+    index_frames), so a range read seeks straight to its first frame
+    instead of following the length prefixes of every frame before it.
+    Packed objects are small enough to do without.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        root_dir: Path,
+        segments: SegmentStore,
+        chunk_segments: SegmentStore,
+    ):
+        self.root_dir = root_dir
+        self.segments = segments
+        self.chunk_segments = chunk_segments
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            self.rebuild()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def rebuild(self):
+        """Recreate the index with one scan of the root directory and one of
+        the segments of objects and of chunks."""
+        with self.lock, self.db:
+            versions, tombstones = self._saved_versions()
+            for (table,) in self.db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).fetchall():
+                self.db.execute(f"DROP TABLE {table}")
+            self.db.executescript(SCHEMA)
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.db.executemany(
+                "INSERT INTO tombstones VALUES (?, ?, ?, ?, ?)",
+                (
+                    (bucket, name, version, shard_of(name), deleted_at)
+                    for bucket, name, version, _, deleted_at in tombstones
+                ),
+            )
+        # Chunks first, so manifests find the chunks they refer to
+        self.put_chunks(
+            (
+                bytes.fromhex(record.name),
+                len(record.data),
+                (record.segment, record.offset),
+            )
+            for record in self.chunk_segments.scan()
+        )
+        # The latest record of each key, without its data unless it's a
+        # manifest
+        packed = {}
+        for record in self.segments.scan():
+            key = (record.bucket, record.name)
+            if key not in packed or record.created_at >= packed[key][0]:
+                prefix = None if record.is_tombstone else record.data[: HEADER.size]
+                if prefix is not None and is_manifest(prefix):
+                    prefix = record.data
+                packed[key] = (
+                    record.created_at,
+                    prefix,
+                    len(record.data),
+                    (record.segment, record.offset),
+                )
+        buckets = set()
+        for bucket in self.root_dir.iterdir():
+            if not bucket.is_dir():
+                continue
+            buckets.add(bucket.name)
+            self.put_bucket(bucket.name, bucket.stat().st_ctime)
+            for object_path in bucket.iterdir():
+                # Dotfiles hold bucket settings, not objects
+                if object_path.name.startswith("."):
+                    continue
+                key = (bucket.name, object_path.name)
+                created_at, prefix, _, _ = packed.get(key, (0, None, 0, None))
+                # A file older than a packed copy was left behind by a crash
+                if prefix is None or object_path.stat().st_ctime > created_at:
+                    packed.pop(key, None)
+                    self.put_object(
+                        bucket.name, object_path, versions.get(key, UNVERSIONED)
+                    )
+        for (bucket, name), (created_at, prefix, size, location) in packed.items():
+            if bucket in buckets and prefix is not None:
+                self.put_packed_object(
+                    bucket,
+                    name,
+                    prefix,
+                    size,
+                    created_at,
+                    location,
+                    versions.get((bucket, name), UNVERSIONED),
+                )
+
+    def _saved_versions(self) -> tuple[dict, list]:
+        """Object versions and tombstones of the index being rebuilt, if it
+        has them. Caller holds the lock."""
+        try:
+            versions = self.db.execute(
+                "SELECT bucket, name, version FROM objects"
+            ).fetchall()
+            tombstones = self.db.execute("SELECT * FROM tombstones").fetchall()
+        except sqlite3.OperationalError:
+            return {}, []
+        return {(bucket, name): version for bucket, name, version in versions}, (
+            tombstones
+        )
+
+    def put_bucket(self, name: str, created_at: float):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO buckets (name, created_at) VALUES (?, ?)",
+                (name, created_at),
+            )
+
+    def delete_bucket(self, name: str):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE bucket = ?", (name,))
+            self.db.execute("DELETE FROM tombstones WHERE bucket = ?", (name,))
+            self.db.execute("DELETE FROM merkle_nodes WHERE bucket = ?", (name,))
+            self.db.execute("DELETE FROM frame_offsets WHERE bucket = ?", (name,))
+            self.db.execute("DELETE FROM buckets WHERE name = ?", (name,))
+
+    def has_bucket(self, name: str) -> bool:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM buckets WHERE name = ?", (name,)
+            ).fetchone()
+        return row is not None
+
+    def get_bucket_object_count(self, name: str) -> int:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT object_count FROM buckets WHERE name = ?", (name,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def put_object(self, bucket: str, object_path: Path, version: str):
+        """Index the object stored at object_path, reading only its header
+        (or all of it, for a manifest).
+
+        For an erasure-coded object, object_path is this server's shard set
+        and stored_size counts only the shards held here.
+        """
+        with open(object_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            manifest = None
+            frame_offsets = None
+            header = read_shard_header(f)
+            # Shard sets are never manifests
+            if header is None:
+                header = read_header(f)
+                if header is not None and header.flags & FLAG_MANIFEST:
+                    f.seek(0)
+                    manifest = Manifest.unpack(f.read())
+                elif header is not None:
+                    frame_offsets = index_frames(f, header)
+        self._insert(
+            bucket,
+            object_path.name,
+            header,
+            stat.st_size,
+            stat.st_ctime,
+            version,
+            manifest=manifest,
+            frame_offsets=frame_offsets,
+        )
+
+    def put_packed_object(
+        self,
+        bucket: str,
+        name: str,
+        prefix: bytes,
+        stored_size: int,
+        created_at: float,
+        location: tuple[int, int],
+        version: str,
+    ):
+        """Index an object packed at location, a (segment, offset) pair.
+
+        prefix is the start of the stored object, long enough to hold its
+        header, or all of it for a manifest.
+        """
+        header = read_header(io.BytesIO(prefix))
+        manifest = None
+        if header is not None and header.flags & FLAG_MANIFEST:
+            manifest = Manifest.unpack(prefix)
+        self._insert(
+            bucket, name, header, stored_size, created_at, version, location, manifest
+        )
+
+    def _insert(
+        self,
+        bucket: str,
+        name: str,
+        header,
+        stored_size: int,
+        created_at: float,
+        version: str,
+        location: tuple[int, int] | tuple[None, None] = (None, None),
+        manifest: Manifest | None = None,
+        frame_offsets: bytes | None = None,
+    ):
+        if header is None:
+            size = max(stored_size - LEGACY_HEADER_SIZE, 0)
+            digest = None
+        else:
+            size = header.plaintext_size
+            digest = header.digest.hex()
+        with self.lock, self.db:
+            self._remove_from_totals(bucket, name)
+            self.db.execute(
+                "DELETE FROM tombstones WHERE bucket = ? AND name = ?", (bucket, name)
+            )
+            self.db.execute(
+                "INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    bucket,
+                    name,
+                    size,
+                    stored_size,
+                    digest,
+                    created_at,
+                    shard_of(name),
+                    *location,
+                    manifest is not None,
+                    version,
+                ),
+            )
+            self.db.execute(
+                "UPDATE buckets SET object_count = object_count + 1,"
+                " logical_bytes = logical_bytes + ?, stored_bytes = stored_bytes + ?"
+                " WHERE name = ?",
+                (size, stored_size, bucket),
+            )
+            if manifest is not None:
+                self._add_chunk_refs(bucket, name, manifest)
+            if frame_offsets is not None:
+                self.db.execute(
+                    "INSERT INTO frame_offsets VALUES (?, ?, ?)",
+                    (bucket, name, frame_offsets),
+                )
+
+    def _add_chunk_refs(self, bucket: str, name: str, manifest: Manifest):
+        sizes = dict(manifest.entries)
+        chunk_bytes = chunk_stored_bytes = 0
+        for chunk in manifest.chunk_ids():
+            row = self.db.execute(
+                "UPDATE chunks SET refs = refs + 1 WHERE chunk = ?"
+                " RETURNING stored_size",
+                (chunk,),
+            ).fetchone()
+            if row is None:
+                # Never stored here; the manifest was checked before it was
+                continue
+            self.db.execute(
+                "INSERT INTO object_chunks VALUES (?, ?, ?)", (bucket, name, chunk)
+            )
+            (refs,) = self.db.execute(
+                "INSERT INTO bucket_chunks VALUES (?, ?, ?, 1)"
+                " ON CONFLICT DO UPDATE SET refs = refs + 1 RETURNING refs",
+                (bucket, chunk, sizes[chunk]),
+            ).fetchone()
+            if refs == 1:
+                chunk_bytes += sizes[chunk]
+                chunk_stored_bytes += row[0]
+        self.db.execute(
+            "UPDATE buckets SET chunked_bytes = chunked_bytes + ?,"
+            " chunk_bytes = chunk_bytes + ?,"
+            " chunk_stored_bytes = chunk_stored_bytes + ? WHERE name = ?",
+            (manifest.header.plaintext_size, chunk_bytes, chunk_stored_bytes, bucket),
+        )
+
+    def _remove_chunk_refs(self, bucket: str, name: str, size: int):
+        chunks = self.db.execute(
+            "DELETE FROM object_chunks WHERE bucket = ? AND name = ? RETURNING chunk",
+            (bucket, name),
+        ).fetchall()
+        now = time.time()
+        chunk_bytes = chunk_stored_bytes = 0
+        for (chunk,) in chunks:
+            (stored_size,) = self.db.execute(
+                "UPDATE chunks SET refs = refs - 1,"
+                " released_at = CASE WHEN refs = 1 THEN ? ELSE released_at END"
+                " WHERE chunk = ? RETURNING stored_size",
+                (now, chunk),
+            ).fetchone()
+            chunk_size, refs = self.db.execute(
+                "UPDATE bucket_chunks SET refs = refs - 1"
+                " WHERE bucket = ? AND chunk = ? RETURNING size, refs",
+                (bucket, chunk),
+            ).fetchone()
+            if refs == 0:
+                self.db.execute(
+                    "DELETE FROM bucket_chunks WHERE bucket = ? AND chunk = ?",
+                    (bucket, chunk),
+                )
+                chunk_bytes += chunk_size
+                chunk_stored_bytes += stored_size
+        self.db.execute(
+            "UPDATE buckets SET chunked_bytes = chunked_bytes - ?,"
+            " chunk_bytes = chunk_bytes - ?,"
+            " chunk_stored_bytes = chunk_stored_bytes - ? WHERE name = ?",
+            (size, chunk_bytes, chunk_stored_bytes, bucket),
+        )
+
+    def put_chunks(self, chunks):
+        """Index stored chunks, as (id, stored size, (segment, offset)).
+
+        A chunk stored twice by concurrent writers keeps its first copy.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO chunks"
+                " (chunk, stored_size, released_at, segment, offset)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    (chunk, stored_size, now, *location)
+                    for chunk, stored_size, location in chunks
+                ),
+            )
+
+    def missing_chunks(self, chunks: list[bytes]) -> list[bytes]:
+        present = self.chunk_locations(chunks)
+        return [chunk for chunk in dict.fromkeys(chunks) if chunk not in present]
+
+    def chunk_locations(self, chunks: list[bytes]) -> dict[bytes, tuple[int, int, int]]:
+        """(stored size, segment, offset) of each chunk that is indexed."""
+        chunks = list(dict.fromkeys(chunks))
+        locations = {}
+        with self.lock:
+            for start in range(0, len(chunks), CHUNK_QUERY_SIZE):
+                batch = chunks[start : start + CHUNK_QUERY_SIZE]
+                rows = self.db.execute(
+                    "SELECT chunk, stored_size, segment, offset FROM chunks"
+                    f" WHERE chunk IN ({', '.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for chunk, *location in rows:
+                    locations[chunk] = tuple(location)
+        return locations
+
+    def drop_chunks(self, released_before: float, keep: set[bytes]) -> int:
+        """Unindex the chunks no object has referred to since before
+        released_before, except those in keep; returns how many."""
+        with self.lock, self.db:
+            chunks = self.db.execute(
+                "SELECT chunk FROM chunks WHERE refs = 0 AND released_at < ?",
+                (released_before,),
+            ).fetchall()
+            chunks = [chunk for chunk in chunks if chunk[0] not in keep]
+            self.db.executemany(
+                "DELETE FROM chunks WHERE chunk = ? AND refs = 0", chunks
+            )
+        return len(chunks)
+
+    def move_chunk(
+        self,
+        bucket: str,
+        name: str,
+        old_location: tuple[int, int],
+        new_location: tuple[int, int],
+    ):
+        """Repoint a chunk copied by compaction, unless it was dropped."""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE chunks SET segment = ?, offset = ?"
+                " WHERE chunk = ? AND segment = ? AND offset = ?",
+                (*new_location, bytes.fromhex(name), *old_location),
+            )
+
+    def chunk_segment_usage(self) -> dict[int, int]:
+        """Bytes of indexed chunk records in each chunk segment."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT segment, SUM(stored_size + ?) FROM chunks GROUP BY segment",
+                (CHUNK_RECORD_OVERHEAD,),
+            ).fetchall()
+        return dict(rows)
+
+    def chunk_offsets(self, segment: int) -> set[int]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT offset FROM chunks WHERE segment = ?", (segment,)
+            ).fetchall()
+        return {offset for (offset,) in rows}
+
+    def move_packed_object(
+        self,
+        bucket: str,
+        name: str,
+        old_location: tuple[int, int],
+        new_location: tuple[int, int],
+    ):
+        """Repoint a packed object copied by compaction, unless it was
+        rewritten or deleted in the meantime."""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE objects SET segment = ?, offset = ?"
+                " WHERE bucket = ? AND name = ? AND segment = ? AND offset = ?",
+                (*new_location, bucket, name, *old_location),
+            )
+
+    def segment_usage(self) -> dict[int, int]:
+        """Bytes of live records in each segment."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT segment, SUM(stored_size + length(CAST(bucket AS BLOB))"
+                " + length(CAST(name AS BLOB)) + ?) FROM objects"
+                " WHERE segment IS NOT NULL GROUP BY segment",
+                (RECORD.size,),
+            ).fetchall()
+        return dict(rows)
+
+    def packed_offsets(self, segment: int) -> set[int]:
+        """Offsets of the live records in a segment."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT offset FROM objects WHERE segment = ?", (segment,)
+            ).fetchall()
+        return {offset for (offset,) in rows}
+
+    def get_object(self, bucket: str, name: str) -> dict | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, stored_size, digest, created_at, segment, offset,"
+                " chunked, version FROM objects WHERE bucket = ? AND name = ?",
+                (bucket, name),
+            ).fetchone()
+        if row is None:
+            return None
+        size, stored_size, digest, created_at, segment, offset, chunked, version = row
+        return {
+            "size": size,
+            "stored_size": stored_size,
+            "digest": digest,
+            "created_at": created_at,
+            "segment": segment,
+            "offset": offset,
+            "chunked": bool(chunked),
+            "version": version,
+        }
+
+    def frame_offsets(
+        self, bucket: str, name: str, digest: bytes, stored_size: int
+    ) -> bytes | None:
+        """Frame offset index of an object, if it has one and the indexed
+        object has this digest and stored size. A caller that opened the
+        object checks it describes that file and not one written since."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT offsets FROM frame_offsets JOIN objects USING (bucket, name)"
+                " WHERE bucket = ? AND name = ? AND digest = ? AND stored_size = ?",
+                (bucket, name, digest.hex(), stored_size),
+            ).fetchone()
+        return row[0] if row else None
+
+    def current_version(self, bucket: str, name: str) -> str | None:
+        """Version of the last write or delete of an object known here, or
+        None if there is neither an object nor a tombstone."""
+        with self.lock:
+            (version,) = self.db.execute(
+                "SELECT MAX(version) FROM (SELECT version FROM objects"
+                " WHERE bucket = ? AND name = ? UNION ALL SELECT version"
+                " FROM tombstones WHERE bucket = ? AND name = ?)",
+                (bucket, name, bucket, name),
+            ).fetchone()
+        return version
+
+    def current_versions(self, bucket: str, names: list[str]) -> dict[str, str]:
+        """current_version of each of names that has one."""
+        versions = {}
+        with self.lock:
+            for start in range(0, len(names), VERSION_QUERY_SIZE):
+                batch = names[start : start + VERSION_QUERY_SIZE]
+                marks = ", ".join("?" * len(batch))
+                rows = self.db.execute(
+                    "SELECT name, MAX(version) FROM (SELECT name, version FROM"
+                    f" objects WHERE bucket = ? AND name IN ({marks}) UNION ALL"
+                    " SELECT name, version FROM tombstones WHERE bucket = ?"
+                    f" AND name IN ({marks})) GROUP BY name",
+                    (bucket, *batch, bucket, *batch),
+                )
+                versions.update(rows)
+        return versions
+
+    def delete_object(self, bucket: str, name: str, version: str | None = None):
+        """Unindex an object, leaving a tombstone if the delete has a
+        version. Copies dropped because this server no longer owns the
+        object don't."""
+        with self.lock, self.db:
+            self._remove_from_totals(bucket, name)
+            if version is not None:
+                self._put_tombstone(bucket, name, version)
+
+    def _put_tombstone(self, bucket: str, name: str, version: str):
+        self.db.execute(
+            "INSERT INTO tombstones VALUES (?, ?, ?, ?, ?) ON CONFLICT DO UPDATE"
+            " SET version = excluded.version, deleted_at = excluded.deleted_at"
+            " WHERE excluded.version > tombstones.version",
+            (bucket, name, version, shard_of(name), time.time()),
+        )
+
+    def drop_tombstones(self, deleted_before: float) -> int:
+        """Forget deletes made before deleted_before; returns how many."""
+        with self.lock, self.db:
+            return self.db.execute(
+                "DELETE FROM tombstones WHERE deleted_at < ?", (deleted_before,)
+            ).rowcount
+
+    def _remove_from_totals(self, bucket: str, name: str):
+        """Delete an object row and its frame offsets, take it out of its
+        bucket's totals, release its chunks and drop the cached hashes of
+        its Merkle nodes."""
+        row = self.db.execute(
+            "SELECT size, stored_size, chunked FROM objects"
+            " WHERE bucket = ? AND name = ?",
+            (bucket, name),
+        ).fetchone()
+        shard = shard_of(name)
+        self.db.execute(
+            "DELETE FROM merkle_nodes WHERE bucket = ? AND node IN"
+            f" ({', '.join('?' * (MERKLE_MAX_DEPTH + 1))})",
+            (bucket, *(shard[:depth] for depth in range(MERKLE_MAX_DEPTH + 1))),
+        )
+        if row is not None:
+            self.db.execute(
+                "DELETE FROM objects WHERE bucket = ? AND name = ?", (bucket, name)
+            )
+            self.db.execute(
+                "DELETE FROM frame_offsets WHERE bucket = ? AND name = ?",
+                (bucket, name),
+            )
+            size, stored_size, chunked = row
+            self.db.execute(
+                "UPDATE buckets SET object_count = object_count - 1,"
+                " logical_bytes = logical_bytes - ?, stored_bytes = stored_bytes - ?"
+                " WHERE name = ?",
+                (size, stored_size, bucket),
+            )
+            if chunked:
+                self._remove_chunk_refs(bucket, name, size)
+
+    def all_objects(self) -> list[tuple[str, str, str]]:
+        """(bucket, name, version) of every object held by this server."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT bucket, name, version FROM objects"
+            ).fetchall()
+
+    def list_buckets(self) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, created_at, object_count, logical_bytes, stored_bytes,"
+                " chunked_bytes, chunk_bytes, chunk_stored_bytes"
+                " FROM buckets ORDER BY name"
+            ).fetchall()
+        buckets = []
+        for (
+            name,
+            created_at,
+            object_count,
+            logical_bytes,
+            stored_bytes,
+            chunked_bytes,
+            chunk_bytes,
+            chunk_stored_bytes,
+        ) in rows:
+            bucket = {
+                "name": name,
+                "size": stored_bytes,
+                "created_at": format_time(created_at),
+                "object_count": object_count,
+                "logical_bytes": logical_bytes,
+                "stored_bytes": stored_bytes,
+            }
+            if chunked_bytes:
+                # Chunks shared with other buckets count in each of them
+                bucket["dedup_ratio"] = round(chunked_bytes / max(chunk_bytes, 1), 3)
+                bucket["chunk_store_bytes"] = chunk_stored_bytes
+            buckets.append(bucket)
+        return buckets
+
+    def merkle_roots(
+        self, scope: str = "", owns: Callable | None = None
+    ) -> dict[str, str]:
+        """Root hash of every bucket's tree."""
+        with self.lock, self.db:
+            buckets = [name for (name,) in self.db.execute("SELECT name FROM buckets")]
+            return {
+                bucket: self._node_hash(bucket, "", scope, owns).hex()
+                for bucket in buckets
+            }
+
+    def merkle_node(
+        self,
+        bucket: str,
+        node: str = "",
+        scope: str = "",
+        owns: Callable | None = None,
+    ) -> dict:
+        """Hash of one tree node plus its children's hashes, or for a leaf,
+        the objects it covers and the versions of their tombstones. Only
+        objects count towards the hash.
+        """
+        with self.lock, self.db:
+            rows = self._node_objects(bucket, node, owns, MERKLE_LEAF_SIZE + 1)
+            if len(rows) <= MERKLE_LEAF_SIZE or len(node) == MERKLE_MAX_DEPTH:
+                rows = self._node_objects(bucket, node, owns)
+                tombstones = {
+                    name: version
+                    for name, version in self.db.execute(
+                        "SELECT name, version FROM tombstones"
+                        " WHERE bucket = ? AND shard >= ? AND shard < ?",
+                        (bucket, node, node + "g"),
+                    )
+                    if owns is None or owns(bucket, name)
+                }
+                return {
+                    "node": node,
+                    "hash": self._node_hash(bucket, node, scope, owns).hex(),
+                    "objects": {
+                        name: {
+                            "digest": digest,
+                            "stored_size": stored_size,
+                            "created_at": created_at,
+                            "version": version,
+                        }
+                        for name, digest, stored_size, created_at, version in rows
+                    },
+                    "tombstones": tombstones,
+                }
+            return {
+                "node": node,
+                "hash": self._node_hash(bucket, node, scope, owns).hex(),
+                "children": {
+                    child: self._node_hash(bucket, child, scope, owns).hex()
+                    for child in (node + digit for digit in HEX_DIGITS)
+                },
+            }
+
+    def _node_hash(
+        self, bucket: str, node: str, scope: str, owns: Callable | None
+    ) -> bytes:
+        """The cached hash of a node, computed (with those of the children
+        it needs) if it isn't cached. Caller holds the lock."""
+        row = self.db.execute(
+            "SELECT hash FROM merkle_nodes WHERE bucket = ? AND node = ? AND scope = ?",
+            (bucket, node, scope),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        # Counting stops past MERKLE_LEAF_SIZE, so deciding costs no more
+        # than hashing a leaf
+        rows = self._node_objects(bucket, node, owns, MERKLE_LEAF_SIZE + 1)
+        if len(rows) <= MERKLE_LEAF_SIZE or len(node) == MERKLE_MAX_DEPTH:
+            node_hash = hashlib.sha256()
+            for name, digest, stored_size, _, _ in sorted(
+                self._node_objects(bucket, node, owns)
+            ):
+                # Legacy objects have no digest, so their size stands in
+                node_hash.update(f"{name}\0{digest or stored_size}\n".encode())
+        else:
+            node_hash = hashlib.sha256(
+                b"".join(
+                    self._node_hash(bucket, node + digit, scope, owns)
+                    for digit in HEX_DIGITS
+                )
+            )
+        self.db.execute(
+            "INSERT OR REPLACE INTO merkle_nodes VALUES (?, ?, ?, ?)",
+            (bucket, node, scope, node_hash.digest()),
+        )
+        return node_hash.digest()
+
+    def _node_objects(
+        self, bucket: str, node: str, owns: Callable | None, limit: int = -1
+    ) -> list[tuple]:
+        """(name, digest, stored_size, created_at, version) of up to limit
+        objects under a node, only those owns accepts if given. Caller holds
+        the lock."""
+        rows = self.db.execute(
+            "SELECT name, digest, stored_size, created_at, version FROM objects"
+            " WHERE bucket = ? AND shard >= ? AND shard < ?"
+            + (" LIMIT ?" if owns is None else ""),
+            (bucket, node, node + "g", *((limit,) if owns is None else ())),
+        )
+        if owns is None:
+            return rows.fetchall()
+        owned = []
+        for row in rows:
+            if len(owned) == limit:
+                break
+            if owns(bucket, row[0]):
+                owned.append(row)
+        return owned
+
+    def drop_merkle_scopes(self):
+        """Forget the cached hashes of every scoped tree, e.g. once the
+        objects placed on each server have changed."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM merkle_nodes WHERE scope != ''")
+
+    def sync_states(self, bucket: str, names: list[str]) -> tuple[dict, dict]:
+        """The objects among names, described as in Merkle leaves, and the
+        versions of the tombstones among them."""
+        objects = {}
+        tombstones = {}
+        with self.lock:
+            for start in range(0, len(names), VERSION_QUERY_SIZE):
+                batch = names[start : start + VERSION_QUERY_SIZE]
+                marks = ", ".join("?" * len(batch))
+                for name, digest, stored_size, created_at, version in self.db.execute(
+                    "SELECT name, digest, stored_size, created_at, version"
+                    f" FROM objects WHERE bucket = ? AND name IN ({marks})",
+                    (bucket, *batch),
+                ):
+                    objects[name] = {
+                        "digest": digest,
+                        "stored_size": stored_size,
+                        "created_at": created_at,
+                        "version": version,
+                    }
+                tombstones.update(
+                    self.db.execute(
+                        "SELECT name, version FROM tombstones"
+                        f" WHERE bucket = ? AND name IN ({marks})",
+                        (bucket, *batch),
+                    )
+                )
+        return objects, tombstones
+
+    def list_objects(
+        self,
+        bucket: str,
+        prefix: str = "",
+        delimiter: str = "",
+        max_keys: int = MAX_KEYS,
+        continuation_token: str | None = None,
+        start_after: str = "",
+    ) -> dict:
+        """List one page of a bucket in the style of S3 ListObjectsV2.
+
+        Keys that share a prefix up to the next delimiter are rolled up into
+        one common prefix, and the scan seeks past the rest of them, so a
+        page costs at most one index range scan per common prefix.
+        """
+        max_keys = min(max(max_keys, 0), MAX_KEYS)
+        after = decode_token(continuation_token) if continuation_token else start_after
+        upper = prefix_successor(prefix)
+
+        contents = []
+        common_prefixes = []
+        is_truncated = False
+        with self.lock:
+            while True:
+                remaining = max_keys - len(contents) - len(common_prefixes)
+                rows = self.db.execute(
+                    "SELECT name, size, digest, created_at FROM objects"
+                    " WHERE bucket = ? AND name > ? AND name >= ?"
+                    + (" AND name < ?" if upper else "")
+                    + " ORDER BY name LIMIT ?",
+                    (bucket, after, prefix)
+                    + ((upper,) if upper else ())
+                    + (remaining + 1,),
+                ).fetchall()
+                rolled_up = False
+                for name, size, digest, created_at in rows:
+                    if len(contents) + len(common_prefixes) >= max_keys:
+                        is_truncated = True
+                        break
+                    index = name.find(delimiter, len(prefix)) if delimiter else -1
+                    if index >= 0:
+                        common_prefix = name[: index + len(delimiter)]
+                        common_prefixes.append(common_prefix)
+                        after = listing_position(common_prefix)
+                        rolled_up = True
+                        break
+                    contents.append(
+                        {
+                            "name": name,
+                            "size": size,
+                            "digest": digest,
+                            "created_at": format_time(created_at),
+                        }
+                    )
+                    after = name
+                if not rolled_up:
+                    break
+
+        return {
+            "name": bucket,
+            "prefix": prefix,
+            "delimiter": delimiter,
+            "max_keys": max_keys,
+            "key_count": len(contents) + len(common_prefixes),
+            "is_truncated": is_truncated,
+            "next_continuation_token": encode_token(after) if is_truncated else None,
+            "contents": contents,
+            "common_prefixes": common_prefixes,
+        }
+
+
+def merge_listings(listings: list[dict], max_keys: int = MAX_KEYS) -> dict:
+    """Merge pages of the same listing taken from several servers.
+
+    Each server only holds the objects placed on it, so a bucket listing
+    is the union of every server's page. A truncated page says nothing
+    about keys after its last one, so the merged page stops there too.
+    """
+    max_keys = min(max(max_keys, 0), MAX_KEYS)
+    entries = {}
+    for listing in listings:
+        for item in listing["contents"]:
+            entries[item["name"]] = item
+        for common_prefix in listing["common_prefixes"]:
+            entries[common_prefix] = None
+    cutoffs = [
+        decode_token(listing["next_continuation_token"])
+        for listing in listings
+        if listing["is_truncated"]
+    ]
+    names = sorted(entries)
+    if cutoffs:
+        names = [name for name in names if name <= min(cutoffs)]
+    is_truncated = bool(cutoffs) or len(names) > max_keys
+    names = names[:max_keys]
+
+    merged = dict(listings[0])
+    merged.update(
+        {
+            "max_keys": max_keys,
+            "key_count": len(names),
+            "is_truncated": is_truncated,
+            "next_continuation_token": None,
+            "contents": [entries[name] for name in names if entries[name]],
+            "common_prefixes": [name for name in names if entries[name] is None],
+        }
+    )
+    if is_truncated and names:
+        last = names[-1]
+        merged["next_continuation_token"] = encode_token(
+            last if entries[last] else listing_position(last)
+        )
+    elif is_truncated:
+        merged["next_continuation_token"] = encode_token(min(cutoffs))
+    return merged
+
+
+def listing_position(common_prefix: str) -> str:
+    """Listing position just past every key under common_prefix."""
+    return common_prefix + "\U0010ffff"
+
+
+def encode_token(after: str) -> str:
+    return base64.urlsafe_b64encode(after.encode()).decode()
+
+
+def decode_token(token: str) -> str:
+    return base64.urlsafe_b64decode(token).decode()
+
+
+def shard_of(name: str) -> str:
+    return hashlib.sha256(name.encode()).hexdigest()[:MERKLE_MAX_DEPTH]
+
+
+def format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def prefix_successor(prefix: str) -> str | None:
+    """Smallest string greater than every string starting with prefix."""
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
@@ -0,0 +1,323 @@
+import abc
+import bisect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Prometheus metrics in the text exposition format, shared by the file and
+# name servers.
+#
+# Recording has to be cheap enough to leave on. Counters and histograms
+# keep one cell per recording thread and a thread only ever writes its own
+# cell, so recording takes no lock; a scrape sums the cells. Coroutines on
+# the event loop share its thread's cell, which is safe since they can't
+# be preempted mid-update. Histograms have fixed bucket bounds, so an
+# observation is one bisect and two additions.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class Cells:
+    """Per-thread lists of numbers, summed when read."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.cells = {}
+
+    def local(self) -> list:
+        cell = self.cells.get(threading.get_ident())
+        if cell is None:
+            cell = self.cells.setdefault(threading.get_ident(), [0] * self.size)
+        return cell
+
+    def totals(self) -> list:
+        totals = [0] * self.size
+        for cell in list(self.cells.values()):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(
+        self, registry: Registry, name: str, help: str, labels: tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        registry.metrics.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abc.abstractmethod
+    def render(self) -> list[str]: ...
+
+
+class RecordedMetric(Metric):
+    """A metric recorded into one child per combination of label values."""
+
+    def __init__(
+        self, registry: Registry, name: str, help: str, labels: tuple[str, ...] = ()
+    ):
+        super().__init__(registry, name, help, labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            # Only creating a child takes the lock
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    @abc.abstractmethod
+    def new_child(self): ...
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for values, child in list(self.children.items()):
+            lines += self.render_child(format_labels(self.label_names, values), child)
+        return lines
+
+    @abc.abstractmethod
+    def render_child(self, labels: str, child) -> list[str]: ...
+
+
+class Counter(RecordedMetric):
+    kind = "counter"
+
+    def new_child(self) -> Cells:
+        return Cells(1)
+
+    def inc(self, amount: float = 1, *label_values):
+        self.labels(*label_values).local()[0] += amount
+
+    def render_child(self, labels: str, child: Cells) -> list[str]:
+        return [f"{self.name}{labels} {format_value(child.totals()[0])}"]
+
+
+class Histogram(RecordedMetric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(registry, name, help, labels)
+        self.bounds = buckets
+
+    def new_child(self) -> Cells:
+        # One count per bucket, one for +Inf, then the sum
+        return Cells(len(self.bounds) + 2)
+
+    def observe(self, value: float, *label_values):
+        cell = self.labels(*label_values).local()
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    def time(self, *label_values) -> "Timer":
+        return Timer(self, label_values)
+
+    def render_child(self, labels: str, child: Cells) -> list[str]:
+        totals = child.totals()
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.bounds, "+Inf"), totals[:-1]):
+            cumulative += count
+            bucket_labels = labels[:-1] + "," if labels else "{"
+            lines.append(
+                f'{self.name}_bucket{bucket_labels}le="{bound}"}} {cumulative}'
+            )
+        lines.append(f"{self.name}_sum{labels} {format_value(totals[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Timer:
+    """Context manager that observes how long its block took."""
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Callback(Metric):
+    """A metric whose value is read from a function at scrape time.
+
+    For a labelled metric, the function returns a dict of label value
+    tuples to values.
+    """
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        help: str,
+        function,
+        labels: tuple[str, ...] = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(registry, name, help, labels)
+        self.function = function
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        values = self.function()
+        if not self.label_names:
+            values = {(): values}
+        lines = self.header()
+        for label_values, value in values.items():
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}{labels} {format_value(value)}")
+        return lines
+
+
+class TimedThreadPool(ThreadPoolExecutor):
+    """Thread pool that records how long each task runs."""
+
+    def __init__(self, histogram: Histogram, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.histogram = histogram
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(self._timed, fn, args, kwargs)
+
+    def _timed(self, fn, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.histogram.observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording each request's latency, status and bytes.
+
+    Latency runs until the last byte of the response is sent, so streamed
+    downloads count in full. Requests are labelled by route template, not
+    by path, to keep the number of series bounded.
+    """
+
+    def __init__(self, app, registry: Registry, prefix: str):
+        self.app = app
+        self.duration = Histogram(
+            registry,
+            f"{prefix}_http_request_duration_seconds",
+            "Time to handle a request, until its response was sent.",
+            ("method", "route"),
+        )
+        self.requests = Counter(
+            registry,
+            f"{prefix}_http_requests_total",
+            "Requests handled, by status code.",
+            ("method", "route", "status"),
+        )
+        self.received = Counter(
+            registry,
+            f"{prefix}_http_received_bytes_total",
+            "Request body bytes received.",
+            ("route",),
+        )
+        self.sent = Counter(
+            registry,
+            f"{prefix}_http_sent_bytes_total",
+            "Response body bytes sent.",
+            ("route",),
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        received = 0
+        sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            self.duration.observe(time.perf_counter() - start, method, route)
+            self.requests.inc(1, method, route, str(status))
+            self.received.inc(received, route)
+            self.sent.inc(sent, route)
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape_label(str(value))}"' for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
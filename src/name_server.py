@@ -1,30 +1,91 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel, Field
 from contextlib import asynccontextmanager
 from typing import Annotated
+import asyncio
 import pickle
 import os
+import time
 from pathlib import Path
 
+from metrics import (
+    CONTENT_TYPE,
+    Callback,
+    Counter,
+    MetricsMiddleware,
+    Registry as MetricsRegistry,
+)
+
 registries = []
 
 PARENT_DIR = Path(__file__).parent
 
+# A server that misses heartbeats for HEARTBEAT_TTL seconds is marked dead,
+# and forgotten once it has been dead for EXPIRE_AFTER seconds.
+HEARTBEAT_TTL = 15
+EXPIRE_AFTER = 300
+LIVENESS_CHECK_INTERVAL = 1
+MAX_WATCH_TIMEOUT = 60
+
+# Bumped on every membership change so file servers can watch for changes
+membership_version = 0
+membership_changed = asyncio.Event()
+watchers = 0
+
+metrics_registry = MetricsRegistry()
+heartbeats = Counter(
+    metrics_registry, "sds3_name_server_heartbeats_total", "Heartbeats received."
+)
+Callback(
+    metrics_registry,
+    "sds3_name_server_servers",
+    "Registered file servers by liveness.",
+    lambda: {
+        ("alive",): sum(registry.alive for registry in registries),
+        ("dead",): sum(not registry.alive for registry in registries),
+    },
+    labels=("state",),
+)
+Callback(
+    metrics_registry,
+    "sds3_name_server_membership_version",
+    "Current membership version.",
+    lambda: membership_version,
+)
+Callback(
+    metrics_registry,
+    "sds3_name_server_watchers",
+    "File servers currently long-polling for membership changes.",
+    lambda: watchers,
+)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global registries
+    global registries, membership_version
     try:
         with open(f"{PARENT_DIR}{os.path.sep}registries.pk1", "rb") as file:
-            registries = pickle.load(file)
+            saved = pickle.load(file)
+        if isinstance(saved, list):
+            # Written by a version without liveness state
+            registries = [Registry(host=r.host, port=r.port) for r in saved]
+        else:
+            registries, membership_version = saved
     except Exception as e:
         print(e)
+    # Give every server a full TTL to check in after a name server restart
+    for registry in registries:
+        registry.last_heartbeat = time.time()
+    liveness_task = asyncio.create_task(check_liveness())
     yield
-    with open(f"{PARENT_DIR}{os.path.sep}registries.pk1", "wb") as file:
-        pickle.dump(registries, file)
+    liveness_task.cancel()
+    save_registries()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    MetricsMiddleware, registry=metrics_registry, prefix="sds3_name_server"
+)
 
 
 class Registry(BaseModel):
@@ -35,19 +96,121 @@ class Registry(BaseModel):
         ),
     ]
     port: Annotated[int, Field(strict=True, ge=0, le=65535)]
+    # Liveness state, maintained by the name server
+    alive: bool = True
+    last_heartbeat: float = 0
 
 
 @app.get("/")
-def read_servers():
-    return registries
+def read_servers(include_dead: bool = False):
+    return [registry for registry in registries if registry.alive or include_dead]
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics() -> Response:
+    return Response(metrics_registry.render(), media_type=CONTENT_TYPE)
 
 
+@app.get("/watch")
+async def watch_servers(version: int = -1, timeout: float = 30):
+    """Long-poll for membership changes.
+
+    Returns as soon as the membership version differs from the one the
+    caller already has, or after timeout seconds with the same version.
+    """
+    global watchers
+    if version == membership_version:
+        watchers += 1
+        try:
+            await asyncio.wait_for(
+                membership_changed.wait(), min(timeout, MAX_WATCH_TIMEOUT)
+            )
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            watchers -= 1
+    return {"version": membership_version, "servers": read_servers()}
+
+
+# Handlers that change membership are async so they run on the event loop
+# alongside the watchers they wake up.
 @app.post("/")
-def register_server(registry: Registry):
+async def register_server(registry: Registry):
     for existing_registry in registries:
         if (
             existing_registry.host == registry.host
             and existing_registry.port == registry.port
         ):
             raise HTTPException(status_code=409, detail="Duplicate registry")
+    registry.alive = True
+    registry.last_heartbeat = time.time()
     registries.append(registry)
+    notify_membership_changed()
+
+
+@app.post("/heartbeat")
+async def heartbeat(registry: Registry):
+    """Refresh a server's TTL, registering or reviving it if needed."""
+    heartbeats.inc()
+    existing_registry = find_registry(registry.host, registry.port)
+    if existing_registry is None:
+        registry.alive = True
+        registry.last_heartbeat = time.time()
+        registries.append(registry)
+        notify_membership_changed()
+    else:
+        existing_registry.last_heartbeat = time.time()
+        if not existing_registry.alive:
+            existing_registry.alive = True
+            notify_membership_changed()
+    return {"version": membership_version}
+
+
+@app.delete("/{host}/{port}")
+async def deregister_server(host: str, port: int):
+    registry = find_registry(host, port)
+    if registry is None:
+        raise HTTPException(status_code=404, detail="Registry not found")
+    registries.remove(registry)
+    notify_membership_changed()
+    return {"version": membership_version}
+
+
+def find_registry(host: str, port: int) -> Registry | None:
+    for registry in registries:
+        if registry.host == host and registry.port == port:
+            return registry
+    return None
+
+
+async def check_liveness():
+    while True:
+        now = time.time()
+        changed = False
+        for registry in list(registries):
+            silent_for = now - registry.last_heartbeat
+            if registry.alive and silent_for > HEARTBEAT_TTL:
+                registry.alive = False
+                changed = True
+            elif not registry.alive and silent_for > HEARTBEAT_TTL + EXPIRE_AFTER:
+                registries.remove(registry)
+                changed = True
+        if changed:
+            notify_membership_changed()
+        await asyncio.sleep(LIVENESS_CHECK_INTERVAL)
+
+
+def notify_membership_changed():
+    global membership_version, membership_changed
+    membership_version += 1
+    save_registries()
+    # Wake every watcher, then start a fresh event for the next change
+    membership_changed.set()
+    membership_changed = asyncio.Event()
+
+
+def save_registries():
+    path = PARENT_DIR / "registries.pk1"
+    with open(path.with_suffix(".tmp"), "wb") as file:
+        pickle.dump((registries, membership_version), file)
+    os.replace(path.with_suffix(".tmp"), path)
@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+# In-memory LRU cache of small, frequently read stored objects.
+#
+# Entries hold an object's stored (encrypted) bytes, so a hit is sent as is.
+# The cache holds at most max_bytes in total, and objects larger than
+# max_object_size are never cached. Every entry records the version of the
+# object it was read from (the index row's digest, size and time), and a
+# lookup with another version misses; that keeps a read that raced a write
+# from serving the old bytes. Writes and deletes also drop entries
+# explicitly, so memory isn't held by objects that are gone.
+
+
+class ObjectCache:
+    def __init__(self, max_bytes: int, max_object_size: int):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[tuple, bytes]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def accepts(self, size: int) -> bool:
+        return size <= min(self.max_object_size, self.max_bytes)
+
+    def get(self, key: str, version: tuple) -> bytes | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, version: tuple, data: bytes):
+        if not self.accepts(len(data)):
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (version, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self._remove(key)
+
+    def invalidate_bucket(self, bucket_name: str):
+        with self.lock:
+            for key in [
+                key for key in self.entries if key.startswith(f"{bucket_name}/")
+            ]:
+                self._remove(key)
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
@@ -0,0 +1,616 @@
+import functools
+import hashlib
+import hmac
+import math
+import os
+import struct
+import zlib
+from collections import Counter
+
+from Crypto.Cipher import AES
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# On-disk layout of an encrypted object.
+#
+# Version 1 (legacy): hmac (16) | nonce (16) | ciphertext
+#   The whole object is a single GCM message.
+#
+# Version 3: header | frame | frame | ...
+#   header = magic, version, codec, flags, frame_size, plaintext_size, digest
+#   frame  = ciphertext_len (4) | nonce (12) | tag (16) | ciphertext
+#   Every frame holds frame_size bytes of plaintext (the last one may hold
+#   fewer) and is authenticated on its own, so objects can be written and
+#   read in bounded memory. With a codec, each frame's plaintext is
+#   compressed on its own before it is encrypted, so frames still decode
+#   independently but vary in size.
+#
+#   Each frame's associated data (see frame_aad) is the header fields that
+#   say how frames are read, which are fixed before the first frame is
+#   sealed, and the frame's index. A frame therefore fails to verify if it
+#   is moved or those fields are changed. digest is an HMAC-SHA256 of the
+#   plaintext under a key derived from the API key (see digest_mac), so it
+#   doesn't reveal the plaintext's sha256. A decoder that reads a whole
+#   object checks it, which also catches dropped frames and a changed
+#   plaintext_size.
+#
+# Version 2 is the same without associated data, and its digest is a
+# plain sha256. Such objects are still read.
+#
+# Manifest: header | entry | entry | ...
+#   entry = chunk id (32) | plaintext size (4)
+#   How a server stores a deduplicated object: the header it is sent with
+#   (plus FLAG_MANIFEST) and the chunks it is made of, in order. Each chunk
+#   is sealed once as one frame and shared by every object that contains
+#   it, so the object a client receives is the header followed by those
+#   frames, each holding up to frame_size bytes of plaintext. Chunk frames
+#   have no index in their associated data, as they sit at different
+#   places in different objects.
+
+MAGIC = b"SDS3"
+VERSION = 3
+UNAUTHENTICATED_VERSION = 2
+FRAME_SIZE = 64 * 1024
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+DEFAULT_LEVELS = {CODEC_ZLIB: 6, CODEC_ZSTD: 3}
+LEVEL_RANGES = {CODEC_ZLIB: range(0, 10), CODEC_ZSTD: range(1, 23)}
+
+# Objects whose first frame starts with one of these, or whose bytes look
+# close to random, are stored uncompressed
+COMPRESSED_MAGIC = [
+    b"\x1f\x8b",  # gzip
+    b"PK\x03\x04",  # zip, docx, jar
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"\xfd7zXZ\x00",  # xz
+    b"BZh",  # bzip2
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"\x89PNG",
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF8",
+    b"RIFF",  # webp, wav, avi
+    b"OggS",
+    b"fLaC",
+    b"ID3",  # mp3
+]
+ENTROPY_SAMPLE_SIZE = 4096
+# Bits per byte above which a sample is treated as incompressible
+MAX_COMPRESSIBLE_ENTROPY = 7.5
+
+# The digest is sha256 over the part digests of a multipart upload rather
+# than over the plaintext itself.
+FLAG_COMPOSITE_DIGEST = 1
+# Frames hold up to frame_size bytes of plaintext rather than exactly that,
+# so their number doesn't follow from plaintext_size.
+FLAG_VARIABLE_FRAMES = 2
+# The body is a list of chunks, not frames; only ever stored by servers.
+FLAG_MANIFEST = 4
+
+HEADER = struct.Struct("<4sBBHIQ32s")
+FRAME_HEADER = struct.Struct("<I")
+# magic, version, codec, FLAG_VARIABLE_FRAMES, frame_size, frame index
+FRAME_AAD = struct.Struct("<4sBBHIQ")
+NO_FRAME_INDEX = 2**64 - 1
+# Entry of a frame offset index (see index_frames)
+FRAME_OFFSET = struct.Struct("<Q")
+NONCE_SIZE = 12
+TAG_SIZE = 16
+FRAME_OVERHEAD = FRAME_HEADER.size + NONCE_SIZE + TAG_SIZE
+MANIFEST_ENTRY = struct.Struct("<32sI")
+
+LEGACY_TAG_SIZE = 16
+LEGACY_NONCE_SIZE = 16
+LEGACY_HEADER_SIZE = LEGACY_TAG_SIZE + LEGACY_NONCE_SIZE
+
+
+class ObjectHeader:
+    def __init__(
+        self,
+        codec=CODEC_NONE,
+        flags=0,
+        frame_size=FRAME_SIZE,
+        plaintext_size=0,
+        digest=bytes(32),
+        version=VERSION,
+    ):
+        self.codec = codec
+        self.flags = flags
+        self.frame_size = frame_size
+        self.plaintext_size = plaintext_size
+        self.digest = digest
+        self.version = version
+
+    def pack(self) -> bytes:
+        return HEADER.pack(
+            MAGIC,
+            self.version,
+            self.codec,
+            self.flags,
+            self.frame_size,
+            self.plaintext_size,
+            self.digest,
+        )
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        magic, version, codec, flags, frame_size, plaintext_size, digest = (
+            HEADER.unpack(data[: HEADER.size])
+        )
+        if magic != MAGIC or version not in (VERSION, UNAUTHENTICATED_VERSION):
+            raise ValueError("Not a framed object")
+        return cls(codec, flags, frame_size, plaintext_size, digest, version)
+
+    @property
+    def frame_count(self) -> int:
+        return -(-self.plaintext_size // self.frame_size)
+
+
+class Manifest:
+    def __init__(self, header: ObjectHeader, entries: list[tuple[bytes, int]]):
+        self.header = header
+        self.entries = entries
+
+    def pack(self) -> bytes:
+        header = ObjectHeader(
+            self.header.codec,
+            self.header.flags | FLAG_MANIFEST,
+            self.header.frame_size,
+            self.header.plaintext_size,
+            self.header.digest,
+            self.header.version,
+        )
+        return header.pack() + b"".join(
+            MANIFEST_ENTRY.pack(chunk_id, size) for chunk_id, size in self.entries
+        )
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        header = ObjectHeader.unpack(data)
+        body = memoryview(data)[HEADER.size :]
+        if not header.flags & FLAG_MANIFEST or len(body) % MANIFEST_ENTRY.size:
+            raise ValueError("Not a manifest")
+        header.flags &= ~FLAG_MANIFEST
+        entries = [
+            (bytes(chunk_id), size)
+            for chunk_id, size in MANIFEST_ENTRY.iter_unpack(body)
+        ]
+        if sum(size for _, size in entries) != header.plaintext_size:
+            raise ValueError("Manifest doesn't add up to the object size")
+        return cls(header, entries)
+
+    def chunk_ids(self) -> list[bytes]:
+        """Every chunk the object uses, once each."""
+        return list(dict.fromkeys(chunk_id for chunk_id, _ in self.entries))
+
+    def span(self, start: int, end: int) -> tuple[int, int, int]:
+        """The first and last chunk covering plaintext bytes start..end
+        (inclusive), and the plaintext offset of the first."""
+        offset = 0
+        first = None
+        for index, (_, size) in enumerate(self.entries):
+            if first is None and start < offset + size:
+                first, first_offset = index, offset
+            if end < offset + size:
+                return first, index, first_offset
+            offset += size
+        raise ValueError("Range is past the end of the object")
+
+
+def is_manifest(prefix: bytes) -> bool:
+    if not is_framed(prefix) or len(prefix) < HEADER.size:
+        return False
+    return bool(ObjectHeader.unpack(prefix).flags & FLAG_MANIFEST)
+
+
+def read_header(file) -> ObjectHeader | None:
+    """Read the header at the start of file, or None for a legacy object."""
+    prefix = file.read(HEADER.size)
+    if not is_framed(prefix) or len(prefix) < HEADER.size:
+        return None
+    return ObjectHeader.unpack(prefix)
+
+
+def locate_frames(
+    file, header: ObjectHeader, first: int, last: int, offsets: bytes | None = None
+):
+    """Return the [start, end) byte span of frames first..last in file.
+
+    Compressed frames vary in size, so they are found through offsets, the
+    file's frame offset index, if there is one.
+    """
+    if header.codec != CODEC_NONE:
+        if offsets is not None:
+            return indexed_frames(file, offsets, first, last)
+        return walk_frames(file, first, last)
+    frame_record_size = FRAME_OVERHEAD + header.frame_size
+    start = HEADER.size + first * frame_record_size
+    end = HEADER.size + (last + 1) * frame_record_size
+    return start, min(end, file.seek(0, os.SEEK_END))
+
+
+def walk_frames(file, first: int, last: int):
+    """Find a span of compressed frames, which vary in size, by following
+    the length prefixes from the first frame."""
+    offset = HEADER.size
+    start = None
+    for index in range(last + 1):
+        if index == first:
+            start = offset
+        file.seek(offset)
+        prefix = file.read(FRAME_HEADER.size)
+        if len(prefix) < FRAME_HEADER.size:
+            break
+        (length,) = FRAME_HEADER.unpack(prefix)
+        offset += FRAME_OVERHEAD + length
+    return (offset if start is None else start), offset
+
+
+def index_frames(file, header: ObjectHeader) -> bytes | None:
+    """Build the frame offset index of an object file: the offset of each
+    frame, as FRAME_OFFSET entries. None if it has fixed-size frames, which
+    locate_frames finds without one.
+
+    Only the length prefixes are read, each with one pread.
+    """
+    if header.codec == CODEC_NONE:
+        return None
+    fd = file.fileno()
+    end = os.fstat(fd).st_size
+    offsets = []
+    offset = HEADER.size
+    while offset + FRAME_HEADER.size <= end:
+        offsets.append(offset)
+        (length,) = FRAME_HEADER.unpack(os.pread(fd, FRAME_HEADER.size, offset))
+        offset += FRAME_OVERHEAD + length
+    return b"".join(map(FRAME_OFFSET.pack, offsets))
+
+
+def indexed_frames(file, offsets: bytes, first: int, last: int):
+    """Find a span of compressed frames with the file's frame offset index."""
+    frame_count = len(offsets) // FRAME_OFFSET.size
+    end = file.seek(0, os.SEEK_END)
+    if first >= frame_count:
+        return end, end
+    (start,) = FRAME_OFFSET.unpack_from(offsets, first * FRAME_OFFSET.size)
+    if last + 1 < frame_count:
+        (end,) = FRAME_OFFSET.unpack_from(offsets, (last + 1) * FRAME_OFFSET.size)
+    return start, end
+
+
+def is_framed(prefix: bytes) -> bool:
+    return prefix[: len(MAGIC)] == MAGIC
+
+
+def codec_available(codec: int) -> bool:
+    return codec != CODEC_ZSTD or zstandard is not None
+
+
+def compress(codec: int, data: bytes, level: int | None = None) -> bytes:
+    if codec == CODEC_NONE:
+        return data
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, level)
+    if codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Codec {codec} is not available")
+
+
+def decompress(codec: int, data: bytes, max_size: int) -> bytes:
+    """Undo compress(), refusing frames that would inflate past max_size."""
+    if codec == CODEC_NONE:
+        return data
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        plaintext = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Frame inflates past the frame size")
+        return plaintext
+    if codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+    raise ValueError(f"Codec {codec} is not available")
+
+
+def looks_compressed(sample: bytes) -> bool:
+    """Cheap check for data that won't shrink: a known compressed format's
+    magic bytes, or near-random byte frequencies."""
+    if any(sample.startswith(magic) for magic in COMPRESSED_MAGIC):
+        return True
+    sample = sample[:ENTROPY_SAMPLE_SIZE]
+    if not sample:
+        return False
+    entropy = -sum(
+        count / len(sample) * math.log2(count / len(sample))
+        for count in Counter(sample).values()
+    )
+    return entropy > MAX_COMPRESSIBLE_ENTROPY
+
+
+def frame_aad(header: ObjectHeader, index: int) -> bytes | None:
+    """Associated data of frame index of an object with this header, or
+    None for a version 2 object. Chunk frames get no index."""
+    if header.version == UNAUTHENTICATED_VERSION:
+        return None
+    variable = header.flags & FLAG_VARIABLE_FRAMES
+    return FRAME_AAD.pack(
+        MAGIC,
+        header.version,
+        header.codec,
+        variable,
+        header.frame_size,
+        NO_FRAME_INDEX if variable else index,
+    )
+
+
+@functools.cache
+def digest_key(key: bytes) -> bytes:
+    # Kept apart from the API key itself, which chunk ids are HMACs under
+    return hmac.new(key, b"sds3 object digest", hashlib.sha256).digest()
+
+
+def digest_mac(key: bytes):
+    """A new HMAC for an object's digest."""
+    return hmac.new(digest_key(key), digestmod=hashlib.sha256)
+
+
+def composite_digest(key: bytes, part_digests: list[bytes]) -> bytes:
+    """Digest of a multipart upload, over the digests of its parts."""
+    mac = digest_mac(key)
+    for part_digest in part_digests:
+        mac.update(part_digest)
+    return mac.digest()
+
+
+def encrypt_frame(plaintext: bytes, key: bytes, aad: bytes | None = None) -> bytes:
+    nonce = os.urandom(NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    if aad is not None:
+        cipher.update(aad)
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    return FRAME_HEADER.pack(len(ciphertext)) + nonce + tag + ciphertext
+
+
+def decrypt_frame(frame: bytes, key: bytes, aad: bytes | None = None) -> bytes:
+    """Decrypt one frame record, raising ValueError if it fails to verify."""
+    (length,) = FRAME_HEADER.unpack_from(frame)
+    nonce_end = FRAME_HEADER.size + NONCE_SIZE
+    tag_end = nonce_end + TAG_SIZE
+    if len(frame) != tag_end + length:
+        raise ValueError("Truncated frame")
+    cipher = AES.new(key, AES.MODE_GCM, nonce=frame[FRAME_HEADER.size : nonce_end])
+    if aad is not None:
+        cipher.update(aad)
+    return cipher.decrypt_and_verify(frame[tag_end:], frame[nonce_end:tag_end])
+
+
+def seal_frame(
+    plaintext: bytes, aad: bytes | None, key: bytes, codec: int, level: int | None
+) -> bytes:
+    return encrypt_frame(compress(codec, plaintext, level), key, aad)
+
+
+def open_frame(
+    frame: bytes, aad: bytes | None, key: bytes, codec: int, max_size: int
+) -> bytes:
+    return decompress(codec, decrypt_frame(frame, key, aad), max_size)
+
+
+def map_frames(executor, function, frames: list[bytes], *others):
+    """Apply function to every frame (and the matching items of others), in
+    order, using executor's workers if there is more than one frame to
+    spread over them."""
+    if executor is None or len(frames) < 2:
+        return map(function, frames, *others)
+    return executor.map(function, frames, *others)
+
+
+class ObjectWriter:
+    """Encrypts a plaintext stream into a seekable file in fixed-size frames.
+
+    The header is written first with placeholder sizes and rewritten on
+    close, once the plaintext size and digest are known. Multipart upload
+    parts are written without a header and joined behind one later;
+    first_frame is the index their first frame will have in the object.
+
+    With a codec, frames are compressed before they are encrypted, unless
+    the first frame looks already compressed, in which case the object is
+    stored with CODEC_NONE.
+
+    With an executor, the frames of each write are sealed by its workers in
+    parallel and written out in order as they finish, so disk writes of
+    earlier frames overlap the encryption of later ones.
+    """
+
+    def __init__(
+        self,
+        file,
+        key: bytes,
+        frame_size: int = FRAME_SIZE,
+        write_header: bool = True,
+        codec: int = CODEC_NONE,
+        level: int | None = None,
+        executor=None,
+        first_frame: int = 0,
+    ):
+        self.file = file
+        self.key = key
+        self.level = level
+        self.executor = executor
+        self.header = ObjectHeader(codec=codec, frame_size=frame_size)
+        self.write_header = write_header
+        self.buffer = bytearray()
+        self.digest = digest_mac(key)
+        self.stored_size = 0
+        self.first_frame = first_frame
+        self.frames_written = 0
+        if write_header:
+            self.file.write(self.header.pack())
+            self.stored_size = HEADER.size
+
+    def write(self, data: bytes):
+        self.digest.update(data)
+        self.header.plaintext_size += len(data)
+        self.buffer += data
+        frame_size = self.header.frame_size
+        full_size = len(self.buffer) - len(self.buffer) % frame_size
+        self._write_frames(
+            [
+                bytes(self.buffer[start : start + frame_size])
+                for start in range(0, full_size, frame_size)
+            ]
+        )
+        del self.buffer[:full_size]
+
+    def close(self) -> ObjectHeader:
+        if self.buffer:
+            self._write_frames([bytes(self.buffer)])
+            self.buffer.clear()
+        self.header.digest = self.digest.digest()
+        if self.write_header:
+            self.file.seek(0)
+            self.file.write(self.header.pack())
+            self.file.seek(0, os.SEEK_END)
+        return self.header
+
+    def _write_frames(self, plaintexts: list[bytes]):
+        if not plaintexts:
+            return
+        # The first frame decides whether the object is worth compressing
+        if self.header.codec != CODEC_NONE and not self.frames_written:
+            if looks_compressed(plaintexts[0]):
+                self.header.codec = CODEC_NONE
+        seal = functools.partial(
+            seal_frame, key=self.key, codec=self.header.codec, level=self.level
+        )
+        first = self.first_frame + self.frames_written
+        aads = [frame_aad(self.header, first + i) for i in range(len(plaintexts))]
+        for frame in map_frames(self.executor, seal, plaintexts, aads):
+            self.file.write(frame)
+            self.stored_size += len(frame)
+            self.frames_written += 1
+
+
+class ObjectDecoder:
+    """Incrementally decrypts an object as its bytes arrive.
+
+    Feed it raw chunks; it returns whatever plaintext can be released so far.
+    For partial (range) responses, pass the number of frames expected and
+    the plaintext offset of the first. Legacy objects are a single GCM
+    message, so their plaintext is only trustworthy once finish() has
+    verified the tag. With an executor, the complete frames of each chunk
+    are opened by its workers in parallel.
+
+    finish() also checks the digest of a whole object, unless it is the
+    composite digest of a multipart upload, which can't be recomputed from
+    the plaintext.
+    """
+
+    def __init__(
+        self,
+        key: bytes,
+        frame_count: int | None = None,
+        executor=None,
+        offset: int = 0,
+    ):
+        self.key = key
+        self.frame_count = frame_count
+        self.executor = executor
+        self.offset = offset
+        self.buffer = bytearray()
+        self.header = None
+        self.legacy_cipher = None
+        self.legacy_tag = None
+        self.digest = None
+        self.first_frame = 0
+        self.frames_read = 0
+        self.plaintext_read = 0
+
+    def feed(self, data: bytes) -> bytes:
+        self.buffer += data
+        if self.header is None and self.legacy_cipher is None:
+            if len(self.buffer) < len(MAGIC):
+                return b""
+            if is_framed(self.buffer):
+                if len(self.buffer) < HEADER.size:
+                    return b""
+                self.header = ObjectHeader.unpack(bytes(self.buffer[: HEADER.size]))
+                del self.buffer[: HEADER.size]
+                self.first_frame = self.offset // self.header.frame_size
+                if (
+                    self.frame_count is None
+                    and self.header.version != UNAUTHENTICATED_VERSION
+                    and not self.header.flags & FLAG_COMPOSITE_DIGEST
+                ):
+                    self.digest = digest_mac(self.key)
+            else:
+                if len(self.buffer) < LEGACY_HEADER_SIZE:
+                    return b""
+                self.legacy_tag = bytes(self.buffer[:LEGACY_TAG_SIZE])
+                nonce = bytes(self.buffer[LEGACY_TAG_SIZE:LEGACY_HEADER_SIZE])
+                self.legacy_cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+                del self.buffer[:LEGACY_HEADER_SIZE]
+
+        if self.legacy_cipher is not None:
+            plaintext = self.legacy_cipher.decrypt(bytes(self.buffer))
+            self.buffer.clear()
+            return plaintext
+
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+            frame_end = offset + FRAME_OVERHEAD + length
+            if len(self.buffer) < frame_end:
+                break
+            frames.append(bytes(self.buffer[offset:frame_end]))
+            offset = frame_end
+        del self.buffer[:offset]
+        open_ = functools.partial(
+            open_frame,
+            key=self.key,
+            codec=self.header.codec,
+            max_size=self.header.frame_size,
+        )
+        first = self.first_frame + self.frames_read
+        aads = [frame_aad(self.header, first + i) for i in range(len(frames))]
+        plaintext = b"".join(map_frames(self.executor, open_, frames, aads))
+        if self.digest is not None:
+            self.digest.update(plaintext)
+        self.frames_read += len(frames)
+        self.plaintext_read += len(plaintext)
+        return plaintext
+
+    @property
+    def is_legacy(self) -> bool:
+        return self.legacy_cipher is not None
+
+    def finish(self):
+        """Raise ValueError unless the whole object was received and verified."""
+        if self.legacy_cipher is not None:
+            self.legacy_cipher.verify(self.legacy_tag)
+            return
+        if self.header is None:
+            if self.buffer:
+                raise ValueError("Truncated object")
+            return
+        if self.buffer:
+            raise ValueError("Truncated object")
+        if self.frame_count is not None:
+            complete = self.frames_read == self.frame_count
+        elif self.header.flags & FLAG_VARIABLE_FRAMES:
+            complete = self.plaintext_read == self.header.plaintext_size
+        else:
+            complete = self.frames_read == self.header.frame_count
+        if not complete:
+            raise ValueError("Truncated object")
+        if self.digest is not None and not hmac.compare_digest(
+            self.digest.digest(), self.header.digest
+        ):
+            raise ValueError("Digest mismatch")
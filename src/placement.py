@@ -0,0 +1,76 @@
+import bisect
+import hashlib
+
+# Consistent-hash placement of objects on file servers.
+#
+# Every server appears on the ring at VIRTUAL_NODES points. An object is
+# owned by the first replication_factor distinct servers found walking
+# clockwise from the hash of its placement key, so adding or removing a
+# server only moves the keys next to that server's points. Servers and
+# clients build the same ring from the name server's registry and agree
+# on placement without asking anyone.
+
+VIRTUAL_NODES = 128
+DEFAULT_REPLICATION_FACTOR = 3
+
+
+class HashRing:
+    def __init__(
+        self,
+        servers: list[str],
+        replication_factor: int = DEFAULT_REPLICATION_FACTOR,
+        virtual_nodes: int = VIRTUAL_NODES,
+    ):
+        self.servers = sorted(set(servers))
+        self.replication_factor = max(replication_factor, 1)
+        self.virtual_nodes = virtual_nodes
+        points = sorted(
+            (ring_hash(f"{server}#{i}"), server)
+            for server in self.servers
+            for i in range(virtual_nodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.point_servers = [server for _, server in points]
+
+    def owners(self, key: str, count: int | None = None) -> list[str]:
+        """Servers that should hold key, primary first.
+
+        count overrides the replication factor, e.g. to spread the shards
+        of an erasure-coded object.
+        """
+        if count is None:
+            count = self.replication_factor
+        count = min(count, len(self.servers))
+        owners = []
+        i = bisect.bisect(self.hashes, ring_hash(key))
+        while len(owners) < count:
+            server = self.point_servers[i % len(self.point_servers)]
+            if server not in owners:
+                owners.append(server)
+            i += 1
+        return owners
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, HashRing)
+            and self.servers == other.servers
+            and self.replication_factor == other.replication_factor
+            and self.virtual_nodes == other.virtual_nodes
+        )
+
+    def __len__(self):
+        return len(self.servers)
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big")
+
+
+def server_id(host: str, port: int) -> str:
+    return f"{host}:{port}"
+
+
+def placement_key(bucket_name: str, object_name: str) -> str:
+    """Key an object is placed by. Clients name objects without the .enc
+    suffix the server stores them under, so it is not part of the key."""
+    return f"{bucket_name}/{object_name.removesuffix('.enc')}"
@@ -0,0 +1,108 @@
+import asyncio
+import random
+import time
+
+# Scheduling of replication passes.
+#
+# Writes don't replicate themselves. They notify the scheduler, which waits
+# until writes have been quiet for `debounce` seconds (but never more than
+# `max_delay` after the first one) and then runs one pass over the journal.
+# Since the journal keeps only the last status of each key, everything
+# that was superseded during the wait (an upload followed by a delete, an
+# object written twice) is never sent.
+#
+# Peers that fail are retried with exponential backoff. While a peer backs
+# off, passes started by new writes skip it instead of retrying it.
+
+
+class PeerBackoff:
+    """Exponential backoff per peer, with jitter."""
+
+    def __init__(self, min_delay: float, max_delay: float):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.failures: dict[str, int] = {}
+        self.retry_at: dict[str, float] = {}
+
+    def ready(self, peer: str) -> bool:
+        return self.retry_at.get(peer, 0) <= time.monotonic()
+
+    def succeeded(self, peer: str):
+        self.failures.pop(peer, None)
+        self.retry_at.pop(peer, None)
+
+    def failed(self, peer: str):
+        failures = self.failures.get(peer, 0) + 1
+        self.failures[peer] = failures
+        delay = min(self.max_delay, self.min_delay * 2 ** (failures - 1))
+        # Jitter keeps servers that lost the same peer from retrying in step
+        self.retry_at[peer] = time.monotonic() + delay * random.uniform(0.5, 1)
+
+    def waiting(self) -> list[float]:
+        """Seconds each peer still backing off has left to wait."""
+        now = time.monotonic()
+        return [retry_at - now for retry_at in self.retry_at.values() if retry_at > now]
+
+    def next_retry(self) -> float | None:
+        """Seconds until the earliest peer is due a retry.
+
+        Peers whose time has come but that had nothing to retry don't
+        count, or they'd be retried in a loop.
+        """
+        return min(self.waiting(), default=None)
+
+    def reset(self):
+        self.failures.clear()
+        self.retry_at.clear()
+
+
+class ReplicationScheduler:
+    """Runs replicate() in the background, debounced.
+
+    replicate() returns how many seconds until a retry is due, or None when
+    nothing is left to retry.
+    """
+
+    def __init__(self, replicate, debounce: float, max_delay: float):
+        self.replicate = replicate
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.wakeup = asyncio.Event()
+        self.first_notified: float | None = None
+        self.last_notified: float | None = None
+
+    def notify(self):
+        """Ask for a pass soon. Must be called on the event loop."""
+        now = time.monotonic()
+        if self.first_notified is None:
+            self.first_notified = now
+        self.last_notified = now
+        self.wakeup.set()
+
+    async def run(self):
+        retry_at = None
+        while True:
+            timeout = None if retry_at is None else retry_at - time.monotonic()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            await self._wait_until_quiet()
+            self.wakeup.clear()
+            self.first_notified = self.last_notified = None
+            try:
+                delay = await self.replicate()
+            except Exception as e:
+                print(e, flush=True)
+                delay = self.max_delay
+            retry_at = None if delay is None else time.monotonic() + delay
+
+    async def _wait_until_quiet(self):
+        while self.first_notified is not None:
+            deadline = min(
+                self.last_notified + self.debounce, self.first_notified + self.max_delay
+            )
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            await asyncio.sleep(deadline - now)
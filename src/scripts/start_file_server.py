@@ -22,12 +22,12 @@ def parse_args():
     return args.port
 
 
-def advertise_to_name_server():
+def advertise_to_name_server(port):
     load_dotenv()
     url = os.environ.get("NAME_SERVER_URL")
     if url:
         response = httpx.post(
-            url, json={"host": gethostbyname(gethostname()), "port": DEFAULT_PORT}
+            url, json={"host": gethostbyname(gethostname()), "port": port}
         )
         if response.status_code not in [200, 409]:
             exit("Error: name server not available")
@@ -38,7 +38,9 @@ def advertise_to_name_server():
 if __name__ == "__main__":
     print(gethostbyname(gethostname()))
     port = parse_args()
-    advertise_to_name_server()
+    advertise_to_name_server(port)
+    # Lets the file server recognise its own registry entry
+    os.environ["FILE_SERVER_PORT"] = str(port)
 
     config = uvicorn.Config(
         "file_server:app", port=port, log_level="info", host="0.0.0.0"
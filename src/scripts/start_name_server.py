@@ -1,9 +1,30 @@
 import uvicorn
+import argparse
 from socket import gethostbyname, gethostname
 
+DEFAULT_PORT = 8232
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run the name server on the specified port."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help="Port number to run the server on.",
+    )
+    args = parser.parse_args()
+    return args.port
+
+
 # host = gethostbyname(gethostname())
 # print(f"hosting on {host}")
 if __name__ == "__main__":
-    config = uvicorn.Config("name_server:app", port=8232, log_level="info", host="0.0.0.0")
+    port = parse_args()
+    config = uvicorn.Config(
+        "name_server:app", port=port, log_level="info", host="0.0.0.0"
+    )
     server = uvicorn.Server(config)
     server.run()
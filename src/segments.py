@@ -0,0 +1,222 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# Segment storage for small objects.
+#
+# Instead of one file each, small objects are appended to large segment
+# files. Each record is crc32 | flags | created_at | bucket_len | name_len |
+# data_len | bucket | name | data, so segments describe themselves and the
+# index can be rebuilt from them. A delete appends a tombstone (a record
+# with FLAG_TOMBSTONE and no data). When a key has several records, the one
+# with the latest created_at wins; copies made by compaction keep the
+# original time, so they never shadow a newer write.
+#
+# Records are only ever appended to the newest (active) segment; a new one
+# is started when it reaches max_segment_size and at every startup, so a
+# torn record can only be at the end of a segment that is never written
+# again. Where each object lives is kept by the caller (the metadata
+# index); compact() rewrites a segment's live records into the active one.
+
+RECORD = struct.Struct("<IBdHHI")
+FLAG_TOMBSTONE = 1
+SEGMENT_SUFFIX = ".seg"
+
+
+class Record:
+    def __init__(self, segment, offset, flags, created_at, bucket, name, data):
+        self.segment = segment
+        self.offset = offset
+        self.flags = flags
+        self.created_at = created_at
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+
+    @property
+    def is_tombstone(self) -> bool:
+        return bool(self.flags & FLAG_TOMBSTONE)
+
+
+class SegmentStore:
+    def __init__(self, directory: Path, max_segment_size: int):
+        self.directory = Path(directory)
+        self.max_segment_size = max_segment_size
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.sizes = {
+            segment: self.segment_path(segment).stat().st_size
+            for segment in self.segment_ids()
+        }
+        self.active = max(self.sizes, default=0) + 1
+        self.fd = None
+
+    def segment_ids(self) -> list[int]:
+        return sorted(
+            int(path.stem)
+            for path in self.directory.iterdir()
+            if path.suffix == SEGMENT_SUFFIX and path.stem.isdigit()
+        )
+
+    def segment_path(self, segment: int) -> Path:
+        return self.directory / f"{segment:08d}{SEGMENT_SUFFIX}"
+
+    def sealed_segments(self) -> dict[int, int]:
+        """Size of every segment that is no longer appended to."""
+        with self.lock:
+            return {
+                segment: size
+                for segment, size in self.sizes.items()
+                if segment != self.active
+            }
+
+    def total_size(self) -> int:
+        return sum(self.sizes.values())
+
+    def append(
+        self, bucket: str, name: str, data: bytes, created_at: float, flags: int = 0
+    ) -> tuple[int, int]:
+        """Append a record; returns its (segment, offset)."""
+        record = pack_record(flags, created_at, bucket, name, data)
+        with self.lock:
+            size = self.sizes.get(self.active, 0)
+            if self.fd is None or (size and size + len(record) > self.max_segment_size):
+                self._roll()
+                size = 0
+            os.write(self.fd, record)
+            self.sizes[self.active] = size + len(record)
+            return self.active, size
+
+    def delete(self, bucket: str, name: str):
+        self.append(bucket, name, b"", time.time(), FLAG_TOMBSTONE)
+
+    def read(
+        self, segment: int, offset: int, bucket: str, name: str, size: int
+    ) -> bytes | None:
+        """Read an object's data with a single pread.
+
+        Returns None if the record isn't there (any more), e.g. because its
+        segment was compacted after the caller looked it up.
+        """
+        length = RECORD.size + len(bucket.encode()) + len(name.encode()) + size
+        try:
+            fd = os.open(self.segment_path(segment), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            data = os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+        record = unpack_record(data)
+        if (
+            record is None
+            or record.is_tombstone
+            or (record.bucket, record.name) != (bucket, name)
+            or len(record.data) != size
+        ):
+            return None
+        return record.data
+
+    def scan(self, segment: int | None = None):
+        """Yield the intact records of one segment, or of every segment in
+        the order they were written."""
+        segments = self.segment_ids() if segment is None else [segment]
+        for segment in segments:
+            try:
+                with open(self.segment_path(segment), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            offset = 0
+            while (record := unpack_record(data, offset)) is not None:
+                record.segment = segment
+                record.offset = offset
+                yield record
+                offset += record_size(record)
+
+    def compact(self, segment: int, live_offsets: set[int], move):
+        """Copy a sealed segment's live records to the active one and delete it.
+
+        move(bucket, name, old_location, new_location) is called for each
+        copied record and must repoint the index only if the object is
+        still at old_location. Tombstones are carried over while older
+        segments, which may hold what they deleted, still exist.
+        """
+        keep_tombstones = any(other < segment for other in self.sizes)
+        for record in self.scan(segment):
+            if record.is_tombstone:
+                if keep_tombstones:
+                    self.append(
+                        record.bucket,
+                        record.name,
+                        b"",
+                        record.created_at,
+                        record.flags,
+                    )
+            elif record.offset in live_offsets:
+                location = self.append(
+                    record.bucket, record.name, record.data, record.created_at
+                )
+                move(record.bucket, record.name, (segment, record.offset), location)
+        with self.lock:
+            self.segment_path(segment).unlink(missing_ok=True)
+            self.sizes.pop(segment, None)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def _roll(self):
+        """Start a new active segment. Caller holds the lock."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.active += 1
+        self.fd = os.open(
+            self.segment_path(self.active),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644,
+        )
+
+
+def pack_record(flags: int, created_at: float, bucket: str, name: str, data: bytes):
+    bucket_bytes = bucket.encode()
+    name_bytes = name.encode()
+    header = RECORD.pack(
+        0, flags, created_at, len(bucket_bytes), len(name_bytes), len(data)
+    )
+    body = header[4:] + bucket_bytes + name_bytes + data
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def unpack_record(data: bytes, offset: int = 0) -> Record | None:
+    """Parse the record at offset, or None if it is missing or torn."""
+    if offset + RECORD.size > len(data):
+        return None
+    crc, flags, created_at, bucket_len, name_len, data_len = RECORD.unpack_from(
+        data, offset
+    )
+    names_start = offset + RECORD.size
+    data_start = names_start + bucket_len + name_len
+    end = data_start + data_len
+    if end > len(data) or zlib.crc32(data[offset + 4 : end]) != crc:
+        return None
+    try:
+        bucket = data[names_start : names_start + bucket_len].decode()
+        name = data[names_start + bucket_len : data_start].decode()
+    except UnicodeDecodeError:
+        return None
+    return Record(None, offset, flags, created_at, bucket, name, data[data_start:end])
+
+
+def record_size(record: Record) -> int:
+    return (
+        RECORD.size
+        + len(record.bucket.encode())
+        + len(record.name.encode())
+        + len(record.data)
+    )
@@ -0,0 +1,106 @@
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# Write versions from hybrid logical clocks.
+#
+# Every write and delete of an object gets a version from the clock of the
+# server it was made on: wall-clock milliseconds, a counter that orders
+# versions within one millisecond, and that server's origin ID. A clock
+# never goes backwards, and never behind a version it has seen, so a write
+# made after another one was seen gets a higher version even if the two
+# servers' clocks disagree; otherwise versions follow wall time.
+#
+# Versions are strings: fixed-width hex for the clock, then the origin. They
+# compare as strings (in Python and SQLite alike) in clock order, ties
+# broken by origin, so every pair of versions is ordered and replicas that
+# keep the highest version of each key agree, whatever order writes reach
+# them in. Objects indexed before they had versions have the empty version,
+# which is older than any other.
+
+WALL_DIGITS = 12
+COUNTER_DIGITS = 4
+MAX_COUNTER = 16**COUNTER_DIGITS - 1
+UNVERSIONED = ""
+
+VERSION_REGEX = re.compile(r"^[0-9a-f]{16}-[0-9a-f]{1,32}$")
+
+
+class HybridLogicalClock:
+    def __init__(self, origin: str):
+        self.origin = origin
+        self.wall = 0
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def now(self) -> str:
+        """A version higher than every one this clock has made or seen."""
+        with self.lock:
+            physical = time.time_ns() // 1_000_000
+            if physical > self.wall:
+                self.wall, self.counter = physical, 0
+            elif self.counter < MAX_COUNTER:
+                self.counter += 1
+            else:
+                # Borrow the next millisecond rather than wrap
+                self.wall, self.counter = self.wall + 1, 0
+            return format_version(self.wall, self.counter, self.origin)
+
+    def update(self, version: str):
+        """Move the clock up to a version seen elsewhere, so versions made
+        here from now on are higher."""
+        if version == UNVERSIONED:
+            return
+        wall, counter = parse_version(version)
+        with self.lock:
+            if (wall, counter) > (self.wall, self.counter):
+                self.wall, self.counter = wall, counter
+
+    def receive(self, version: str | None) -> str:
+        """Check the version of a change from a peer and move the clock past
+        it; raises ValueError if it is malformed.
+
+        Peers from before versions send none. Their changes are versioned on
+        arrival, which applies them in arrival order as before.
+        """
+        if version is None:
+            return self.now()
+        self.update(version)
+        return version
+
+
+def supersedes(version: str, current: str | None) -> bool:
+    """Whether a change with this version replaces the object's current
+    version (None if there is no object or tombstone)."""
+    # Changes from before versions replace each other in arrival order, as
+    # they always did
+    return current is None or version > current or version == current == UNVERSIONED
+
+
+def format_version(wall: int, counter: int, origin: str) -> str:
+    return f"{wall:0{WALL_DIGITS}x}{counter:0{COUNTER_DIGITS}x}-{origin}"
+
+
+def parse_version(version: str) -> tuple[int, int]:
+    """The clock reading of a version, raising ValueError if it is malformed."""
+    if not VERSION_REGEX.match(version):
+        raise ValueError(f"Invalid version: {version!r}")
+    return (
+        int(version[:WALL_DIGITS], 16),
+        int(version[WALL_DIGITS : WALL_DIGITS + COUNTER_DIGITS], 16),
+    )
+
+
+def load_origin_id(path: Path) -> str:
+    """This server's origin ID, made up and saved the first time."""
+    try:
+        origin = path.read_text().strip()
+        if re.fullmatch(r"[0-9a-f]{1,32}", origin):
+            return origin
+    except FileNotFoundError:
+        pass
+    origin = uuid.uuid4().hex[:16]
+    path.write_text(origin + "\n")
+    return origin
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# The servers' modules live flat in src/ and import each other by name;
+# benchmark.py (and its LocalCluster) sits at the top level
+sys.path.insert(0, str(ROOT / "src"))
+sys.path.insert(0, str(ROOT))
@@ -0,0 +1,188 @@
+import io
+import random
+import time
+
+import pytest
+
+from chunks import (
+    MAX_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    ChunkStore,
+    ChunkWriter,
+    Chunker,
+    pack_chunk_records,
+    unpack_chunk_records,
+)
+from metadata import MetadataIndex
+from object_format import Manifest, ObjectDecoder
+from segments import SegmentStore
+from versions import UNVERSIONED
+
+KEY = bytes(range(32))
+BUCKET = "bucket"
+
+
+def chunk(data: bytes, feed_size: int | None = None) -> list[bytes]:
+    chunker = Chunker()
+    feed_size = feed_size or len(data) or 1
+    chunks = []
+    for start in range(0, len(data), feed_size):
+        chunks += chunker.feed(data[start : start + feed_size])
+    return chunks + chunker.finish()
+
+
+def test_chunks_join_up_and_respect_size_limits():
+    data = random.Random(1).randbytes(1 << 20)
+    chunks = chunk(data)
+    assert b"".join(chunks) == data
+    assert all(MIN_CHUNK_SIZE <= len(c) <= MAX_CHUNK_SIZE for c in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= MAX_CHUNK_SIZE
+
+
+@pytest.mark.parametrize("feed_size", [1000, 4096, 65536, 100_000])
+def test_boundaries_do_not_depend_on_how_data_arrives(feed_size):
+    data = random.Random(2).randbytes(400_000)
+    assert chunk(data, feed_size) == chunk(data)
+
+
+def test_boundaries_realign_after_an_insertion():
+    data = random.Random(3).randbytes(1 << 20)
+    edited = data[:300_000] + b"inserted" + data[300_000:]
+    before, after = chunk(data), chunk(edited)
+    changed = set(after) - set(before)
+    assert sum(map(len, changed)) <= 2 * MAX_CHUNK_SIZE
+
+
+def test_data_without_boundaries_is_cut_at_max_size():
+    chunks = chunk(bytes(3 * MAX_CHUNK_SIZE + 5))
+    assert [len(c) for c in chunks] == [MAX_CHUNK_SIZE] * 3 + [5]
+
+
+def test_short_and_empty_streams():
+    assert chunk(b"") == []
+    assert chunk(b"abc") == [b"abc"]
+
+
+def test_chunk_records_round_trip():
+    chunks = [(bytes([i]) * 32, bytes(40 + i)) for i in range(3)]
+    assert unpack_chunk_records(pack_chunk_records(chunks)) == chunks
+    with pytest.raises(ValueError):
+        unpack_chunk_records(pack_chunk_records(chunks)[:-1])
+
+
+@pytest.fixture
+def store(tmp_path):
+    (tmp_path / "root").mkdir()
+    segments = SegmentStore(tmp_path / "chunks", 256 * 1024)
+    index = MetadataIndex(
+        tmp_path / "index.db",
+        tmp_path / "root",
+        SegmentStore(tmp_path / "segments", 1 << 20),
+        segments,
+    )
+    index.put_bucket(BUCKET, 0.0)
+    store = ChunkStore(segments, index)
+    yield store
+    store.segments.close()
+    index.close()
+
+
+def put(store: ChunkStore, name: str, data: bytes) -> Manifest:
+    """Store an object the way a dedup bucket does: chunks, then its
+    manifest indexed while they are pinned."""
+    with store.pins() as pinned:
+        file = io.BytesIO()
+        writer = ChunkWriter(file, KEY, store, pinned)
+        writer.write(data)
+        writer.close()
+        manifest = file.getvalue()
+        store.index.put_packed_object(
+            BUCKET, name, manifest, len(manifest), time.time(), (1, 0), UNVERSIONED
+        )
+    return Manifest.unpack(manifest)
+
+
+def refs(store: ChunkStore, chunk_ids) -> list[int]:
+    with store.index.lock:
+        return [
+            (row or (None,))[0]
+            for row in (
+                store.index.db.execute(
+                    "SELECT refs FROM chunks WHERE chunk = ?", (chunk_id,)
+                ).fetchone()
+                for chunk_id in chunk_ids
+            )
+        ]
+
+
+def read(store: ChunkStore, manifest: Manifest) -> bytes:
+    decoder = ObjectDecoder(KEY)
+    data = decoder.feed(manifest.header.pack())
+    for frame in store.read(manifest.chunk_ids()):
+        data += decoder.feed(frame)
+    decoder.finish()
+    return data
+
+
+def test_identical_objects_share_their_chunks(store):
+    data = random.Random(4).randbytes(300_000)
+    first = put(store, "a", data)
+    size = store.total_size()
+    second = put(store, "b", data)
+    assert second.chunk_ids() == first.chunk_ids()
+    assert store.total_size() == size
+    assert refs(store, first.chunk_ids()) == [2] * len(first.chunk_ids())
+    assert store.index.list_buckets()[0]["dedup_ratio"] == 2.0
+    assert read(store, second) == data
+
+
+def test_overwrite_releases_only_the_replaced_chunks(store):
+    data = random.Random(5).randbytes(300_000)
+    old = put(store, "a", data)
+    new = put(store, "a", data[:150_000] + b"edit" + data[150_000:])
+    kept = set(old.chunk_ids()) & set(new.chunk_ids())
+    replaced = set(old.chunk_ids()) - kept
+    assert kept and replaced
+    assert refs(store, kept) == [1] * len(kept)
+    assert refs(store, replaced) == [0] * len(replaced)
+    assert store.collect(time.time() + 1) == len(replaced)
+    assert store.missing(list(replaced)) == list(replaced)
+    assert store.missing(new.chunk_ids()) == []
+
+
+def test_delete_releases_chunks_after_the_grace_period(store):
+    data = random.Random(6).randbytes(200_000)
+    manifest = put(store, "a", data)
+    ids = manifest.chunk_ids()
+    store.index.delete_object(BUCKET, "a")
+    assert refs(store, ids) == [0] * len(ids)
+    assert store.collect(time.time() - 60) == 0
+    assert store.collect(time.time() + 1) == len(ids)
+    assert refs(store, ids) == [None] * len(ids)
+
+
+def test_pinned_chunks_are_not_collected(store):
+    manifest = put(store, "a", random.Random(7).randbytes(100_000))
+    ids = manifest.chunk_ids()
+    store.index.delete_object(BUCKET, "a")
+    with store.pins() as pinned:
+        assert store.claim(pinned, ids) == set(ids)
+        assert store.collect(time.time() + 1) == 0
+    assert store.collect(time.time() + 1) == len(ids)
+
+
+def test_compaction_keeps_referenced_chunks_readable(store):
+    rng = random.Random(8)
+    data = rng.randbytes(300_000)
+    kept = put(store, "kept", data)
+    put(store, "dropped", rng.randbytes(600_000))
+    store.index.delete_object(BUCKET, "dropped")
+    store.collect(time.time() + 1)
+    size = store.total_size()
+    # Start a new active segment so every written one can be compacted
+    store.segments.close()
+    store.segments = SegmentStore(store.segments.directory, 256 * 1024)
+    store.compact(0.5)
+    assert store.total_size() < size
+    assert read(store, kept) == data
+    assert refs(store, kept.chunk_ids()) == [1] * len(kept.chunk_ids())
@@ -0,0 +1,214 @@
+import asyncio
+import io
+import tarfile
+
+import httpx
+import pytest
+
+import client
+from object_format import digest_mac
+
+API_KEY = bytes(range(32))
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    monkeypatch.setattr(client, "headers", {"Authorization": API_KEY.hex()})
+    monkeypatch.setattr(client, "ring", None)
+    monkeypatch.setattr(client, "PARENT_DIR", tmp_path)
+
+
+@pytest.fixture
+def timeline(monkeypatch):
+    """Replace the transfer commands with ones that record when they run."""
+    events = []
+
+    def fake(name):
+        async def command(_client, path, *args):
+            events.append(("start", name, path))
+            await asyncio.sleep(0.02)
+            events.append(("end", name, path))
+            return "ok"
+
+        return command
+
+    for name in ("get_obj", "get_dir", "post_obj"):
+        monkeypatch.setattr(client, name, fake(name))
+    return events
+
+
+def span(events, name, path) -> tuple[int, int]:
+    return (
+        events.index(("start", name, path)),
+        events.index(("end", name, path)),
+    )
+
+
+def test_commands_on_the_same_local_file_run_in_order(timeline, tmp_path):
+    local = tmp_path / "shared"
+    local.write_bytes(b"data")
+    asyncio.run(
+        client.run_batch(
+            [
+                "get /a/shared.enc",
+                "get /b/shared.enc",
+                f"post /c {local}",
+                "get /a/other.enc",
+            ]
+        )
+    )
+    first = span(timeline, "get_obj", "/a/shared.enc")
+    second = span(timeline, "get_obj", "/b/shared.enc")
+    upload = span(timeline, "post_obj", "/c")
+    other = span(timeline, "get_obj", "/a/other.enc")
+    # Both downloads write the same file, which the upload reads
+    assert first[1] < second[0]
+    assert second[1] < upload[0]
+    # Another file is downloaded alongside them
+    assert other[0] < first[1]
+
+
+def test_bucket_wide_commands_run_alone(timeline):
+    asyncio.run(
+        client.run_batch(["get /a/x.enc", "get /a/", "get /a/y.enc", "get /b/z.enc"])
+    )
+    listing = span(timeline, "get_dir", "/a/")
+    assert span(timeline, "get_obj", "/a/x.enc")[1] < listing[0]
+    assert listing[1] < span(timeline, "get_obj", "/a/y.enc")[0]
+    assert listing[1] < span(timeline, "get_obj", "/b/z.enc")[0]
+
+
+def test_command_keys(tmp_path):
+    first = client.parse_command("get /a/x.enc")
+    second = client.parse_command("get /b/x.enc --range 0-9")
+    assert first.keys & second.keys == {client.local_key(tmp_path / "x")}
+    upload = client.parse_command(f"post /c {tmp_path / 'x'}")
+    assert upload.keys == {"/c/x.enc", client.local_key(tmp_path / "x")}
+    assert client.parse_command("delete /c/x.enc").keys == {"/c/x.enc"}
+    assert client.parse_command("delete /c").keys is None
+    with pytest.raises(ValueError):
+        client.parse_command("get /a/x.enc --range 9")
+
+
+def digest(data: bytes) -> str:
+    mac = digest_mac(API_KEY)
+    mac.update(data)
+    return mac.hexdigest()
+
+
+@pytest.fixture
+def sync_server(monkeypatch, tmp_path):
+    """A directory to sync and a fake server for it. The bucket already
+    holds "same" and an older "changed"; uploads of "bad" fail."""
+    monkeypatch.setattr(client, "MULTIPART_PART_SIZE", 1000)
+    local = tmp_path / "local"
+    local.mkdir()
+    files = {
+        "same": b"unchanged",
+        "changed": b"new bytes",
+        "new": b"fresh",
+        "bad": b"rejected",
+        "large": bytes(2500),
+        "large_bad": bytes(3000),
+    }
+    for name, data in files.items():
+        (local / name).write_bytes(data)
+    server = {
+        "listing": [
+            {"name": "same.enc", "size": 9, "digest": digest(b"unchanged")},
+            {"name": "changed.enc", "size": 9, "digest": digest(b"old bytes")},
+        ],
+        "bulk_status": 200,
+        "tarred": [],
+    }
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "GET" and request.url.path == "/bucket":
+            return httpx.Response(
+                200,
+                json={
+                    "contents": server["listing"],
+                    "is_truncated": False,
+                    "next_continuation_token": None,
+                },
+            )
+        if request.method == "POST" and request.url.path == "/_bulk/bucket/upload":
+            with tarfile.open(fileobj=io.BytesIO(request.content)) as tar:
+                names = tar.getnames()
+            server["tarred"] += names
+            if server["bulk_status"] != 200:
+                return httpx.Response(server["bulk_status"], text="Unavailable")
+            return httpx.Response(
+                200,
+                json={
+                    "uploaded": [f"{name}.enc" for name in names if name != "bad"],
+                    "errors": [
+                        {"name": f"{name}.enc", "message": "Disk full"}
+                        for name in names
+                        if name == "bad"
+                    ],
+                },
+            )
+        return httpx.Response(404)
+
+    async def post_obj_multipart(_client, server_side_path, local_path, _concurrency):
+        if local_path.endswith("large_bad"):
+            return "Error completing upload:\n500\n"
+        return {"status": "ok", "filename": f"{local_path}.enc"}
+
+    monkeypatch.setattr(client, "post_obj_multipart", post_obj_multipart)
+
+    def sync():
+        async def run():
+            transport = httpx.MockTransport(handler)
+            async with httpx.AsyncClient(transport=transport) as http:
+                return await client.sync_dir(http, str(local), "/bucket")
+
+        return asyncio.run(run())
+
+    server["sync"] = sync
+    return server
+
+
+def test_sync_reports_what_was_sent(sync_server, capsys):
+    result = sync_server["sync"]()
+    assert sorted(sync_server["tarred"]) == ["bad", "changed", "new"]
+    assert result["status"] == "error"
+    assert sorted(result["uploaded"]) == ["changed.enc", "large.enc", "new.enc"]
+    assert result["skipped"] == 1
+    assert sorted(error["name"] for error in result["errors"]) == [
+        "bad.enc",
+        "large_bad",
+    ]
+    output = capsys.readouterr().out
+    assert "Sent 2 of 3 files to /bucket, 1 failed" in output
+    assert "Failed to send large_bad" in output
+    assert "5 files sent in" in output
+    assert "; 3 uploaded, 2 failed" in output
+
+
+def test_sync_counts_a_failed_batch_as_failed_files(sync_server, capsys):
+    sync_server["bulk_status"] = 503
+    result = sync_server["sync"]()
+    assert sorted(result["uploaded"]) == ["large.enc"]
+    assert result["errors"][0] == {"message": "503: Unavailable"}
+    output = capsys.readouterr().out
+    assert "Sent 0 of 3 files to /bucket, 3 failed" in output
+    assert "; 1 uploaded, 4 failed" in output
+
+
+def test_sync_of_an_unchanged_directory_sends_nothing(sync_server, capsys):
+    sync_server["listing"] = []
+    for path in sorted((client.PARENT_DIR / "local").iterdir()):
+        data = path.read_bytes()
+        stored_digest = digest(data)
+        if len(data) >= client.MULTIPART_PART_SIZE:
+            # Uploaded in parts, so stored with the composite digest
+            (stored_digest,) = client.file_digests(path) - {stored_digest}
+        sync_server["listing"].append(
+            {"name": f"{path.name}.enc", "size": len(data), "digest": stored_digest}
+        )
+    result = sync_server["sync"]()
+    assert result == {"status": "ok", "uploaded": [], "skipped": 6, "errors": []}
+    assert sync_server["tarred"] == []
+    assert "; 0 uploaded, 0 failed" in capsys.readouterr().out
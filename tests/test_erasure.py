@@ -0,0 +1,84 @@
+import io
+import itertools
+import random
+
+import pytest
+
+from erasure import (
+    ShardSetHeader,
+    decode_stripe,
+    encode_stripe,
+    gf_inv,
+    gf_mul,
+    read_shard_sets,
+    write_shard_sets,
+)
+
+# (data_shards, parity_shards) layouts to check every surviving subset of
+LAYOUTS = [(1, 1), (2, 1), (2, 2), (3, 2), (4, 2), (5, 3), (6, 4)]
+
+
+def test_every_element_has_an_inverse():
+    for a in range(1, 256):
+        assert gf_mul(a, gf_inv(a)) == 1
+
+
+@pytest.mark.parametrize("data_shards, parity_shards", LAYOUTS)
+def test_stripe_rebuilds_from_any_data_shards_chunks(data_shards, parity_shards):
+    rng = random.Random(data_shards * 256 + parity_shards)
+    chunk_size = 37
+    data = rng.randbytes(data_shards * chunk_size)
+    chunks = encode_stripe(data, data_shards, parity_shards, chunk_size)
+    assert len(chunks) == data_shards + parity_shards
+    assert b"".join(chunks[:data_shards]) == data
+
+    for survivors in itertools.combinations(range(len(chunks)), data_shards):
+        available = {shard: chunks[shard] for shard in survivors}
+        assert decode_stripe(available, data_shards, parity_shards) == data
+
+
+@pytest.mark.parametrize("data_shards, parity_shards", LAYOUTS)
+def test_stripe_needs_data_shards_chunks(data_shards, parity_shards):
+    chunks = encode_stripe(b"x" * data_shards, data_shards, parity_shards, 1)
+    for survivors in itertools.combinations(range(len(chunks)), data_shards - 1):
+        available = {shard: chunks[shard] for shard in survivors}
+        with pytest.raises(ValueError):
+            decode_stripe(available, data_shards, parity_shards)
+
+
+def test_short_stripe_is_padded():
+    chunks = encode_stripe(b"abcde", 3, 2, 2)
+    assert chunks[:3] == [b"ab", b"cd", b"e\0"]
+    assert decode_stripe({3: chunks[3], 4: chunks[4], 1: chunks[1]}, 3, 2) == (
+        b"abcde\0"
+    )
+
+
+@pytest.mark.parametrize("data_shards, parity_shards", LAYOUTS)
+def test_object_rebuilds_from_any_data_shards_sets(data_shards, parity_shards):
+    rng = random.Random(data_shards * 256 + parity_shards)
+    chunk_size = 16
+    # Several stripes, the last one partial
+    stored_size = 3 * data_shards * chunk_size + 5
+    stored = rng.randbytes(stored_size)
+    shard_count = data_shards + parity_shards
+    holders = [f"server{shard}:80" for shard in range(shard_count)]
+    headers = [
+        ShardSetHeader(
+            data_shards,
+            parity_shards,
+            chunk_size,
+            stored_size,
+            stored_size,
+            b"\0" * 32,
+            holders,
+            [shard],
+        )
+        for shard in range(shard_count)
+    ]
+    files = [io.BytesIO() for _ in headers]
+    write_shard_sets(io.BytesIO(stored), files, headers)
+
+    for survivors in itertools.combinations(range(shard_count), data_shards):
+        sets = [(files[shard], headers[shard]) for shard in survivors]
+        assert b"".join(read_shard_sets(sets)) == stored
@@ -0,0 +1,141 @@
+import os
+import secrets
+import socket
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from benchmark import LocalCluster
+from object_format import ObjectDecoder
+
+# Three file servers on localhost hold an erasure-coded bucket with two
+# data shards and one parity shard, one shard on each. Any two servers
+# are enough to read an object back.
+
+SERVERS = 3
+PLACEMENT_TIMEOUT = 30
+DOWN_READ_TIMEOUT = 30
+
+
+def free_ports(count: int) -> int:
+    """First of count consecutive ports that are free on localhost."""
+    for _ in range(100):
+        base = 20000 + secrets.randbelow(30000)
+        try:
+            for port in range(base, base + count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port))
+        except OSError:
+            continue
+        return base
+    raise RuntimeError("No free ports")
+
+
+@pytest.fixture(scope="module")
+def cluster():
+    base_port = free_ports(SERVERS + 1)
+    args = SimpleNamespace(
+        servers=SERVERS,
+        name_server_port=base_port + SERVERS,
+        base_port=base_port,
+        keep=False,
+        replication_factor=2,
+    )
+    api_key = secrets.token_hex(32)
+    cluster = LocalCluster(args, api_key)
+    try:
+        cluster.start()
+        urls = [f"http://127.0.0.1:{base_port + i}/" for i in range(SERVERS)]
+        with httpx.Client(headers={"Authorization": api_key}, timeout=30) as client:
+            yield SimpleNamespace(
+                processes=cluster.processes[1:],
+                urls=urls,
+                key=bytes.fromhex(api_key),
+                client=client,
+            )
+    finally:
+        cluster.stop()
+
+
+def put_erasure_coded(cluster, name: str, data: bytes):
+    """Create the bucket and store the object on every server. Servers
+    learn about each other shortly after they start, so the upload is
+    repeated until each one holds a shard set of it."""
+    client = cluster.client
+    deadline = time.monotonic() + PLACEMENT_TIMEOUT
+    created = client.post(
+        cluster.urls[0],
+        json={
+            "dir_name": "ec",
+            "storage_mode": "erasure",
+            "data_shards": 2,
+            "parity_shards": 1,
+        },
+    )
+    assert created.status_code == 200
+    while time.monotonic() < deadline:
+        r = client.post(f"{cluster.urls[0]}ec", files={"file": (name, data)})
+        if r.status_code == 200:
+            held = [
+                client.get(f"{url}ec/{name}.enc", headers={"X-Sync": "true"})
+                for url in cluster.urls
+            ]
+            if all(r.status_code == 200 for r in held):
+                return
+        time.sleep(0.5)
+    pytest.fail("The object's shard sets were not placed on every server")
+
+
+def decrypt(key: bytes, r: httpx.Response) -> bytes:
+    if r.status_code == 206:
+        decoder = ObjectDecoder(
+            key,
+            int(r.headers["X-Frame-Count"]),
+            offset=int(r.headers["X-Frame-Offset"]),
+        )
+    else:
+        decoder = ObjectDecoder(key)
+    plaintext = decoder.feed(r.content)
+    decoder.finish()
+    return plaintext
+
+
+def get_while_down(cluster, url: str, name: str, headers=None) -> httpx.Response:
+    """Read an object through url; the servers only stop placing shards on
+    a server that is down once the name server notices."""
+    deadline = time.monotonic() + DOWN_READ_TIMEOUT
+    while True:
+        r = cluster.client.get(f"{url}ec/{name}.enc", headers=headers)
+        if r.status_code != 503 or time.monotonic() > deadline:
+            return r
+        time.sleep(0.5)
+
+
+def test_reads_rebuild_while_one_server_is_down(cluster):
+    data = os.urandom(3 * 64 * 1024 + 12345)
+    put_erasure_coded(cluster, "object", data)
+
+    r = cluster.client.get(f"{cluster.urls[0]}ec/object.enc")
+    assert r.status_code == 200
+    assert decrypt(cluster.key, r) == data
+
+    cluster.processes[2].kill()
+    cluster.processes[2].wait()
+    for url in cluster.urls[:2]:
+        r = get_while_down(cluster, url, "object")
+        assert r.status_code == 200
+        assert decrypt(cluster.key, r) == data
+
+        start, end = 70000, 140000
+        r = get_while_down(
+            cluster, url, "object", headers={"Range": f"bytes={start}-{end}"}
+        )
+        assert r.status_code == 206
+        assert r.headers["Content-Range"] == f"bytes {start}-{end}/{len(data)}"
+        frame_offset = int(r.headers["X-Frame-Offset"])
+        plaintext = decrypt(cluster.key, r)
+        assert plaintext[start - frame_offset : end - frame_offset + 1] == (
+            data[start : end + 1]
+        )
@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+import journal
+from journal import DELETED, UPLOADED, UPLOADING, Journal, pack_record
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "journal.log"
+
+
+def reopen(j: Journal) -> Journal:
+    j.close()
+    return Journal(j.path)
+
+
+def test_pending_changes_survive_reopening(path):
+    j = Journal(path)
+    assert j.commit("a", UPLOADED, "v1") == 1
+    assert j.commit_many([("b", UPLOADED, "v2"), ("c", DELETED, "")]) == 3
+    j = reopen(j)
+    assert sorted(j.pending()) == [
+        ("a", 1, UPLOADED, "v1"),
+        ("b", 2, UPLOADED, "v2"),
+        ("c", 3, DELETED, ""),
+    ]
+    assert j.append("d", UPLOADING, "v3") == 4
+    j.close()
+
+
+def test_acknowledged_changes_stay_dropped(path):
+    j = Journal(path)
+    seq = j.commit("a", UPLOADED, "v1")
+    j.commit("b", UPLOADED, "v1")
+    j.acknowledge("a", seq)
+    assert j.get("a") is None
+    j = reopen(j)
+    assert [key for key, *_ in j.pending()] == ["b"]
+    j.close()
+
+
+def test_superseded_change_is_not_acknowledged(path):
+    j = Journal(path)
+    old = j.commit("a", UPLOADED, "v1")
+    new = j.commit("a", DELETED, "v2")
+    j.acknowledge("a", old)
+    assert j.pending() == [("a", new, DELETED, "v2")]
+    j = reopen(j)
+    assert j.pending() == [("a", new, DELETED, "v2")]
+    j.close()
+
+
+def test_torn_tail_is_cut_off_at_every_length(path):
+    j = Journal(path)
+    j.commit("a", UPLOADED, "v1")
+    j.commit("b", UPLOADED, "")
+    j.close()
+    intact = path.read_bytes()
+    last = pack_record(3, 0, UPLOADED, "torn", "v3")
+    for cut in range(1, len(last)):
+        path.write_bytes(intact + last[:cut])
+        j = Journal(path)
+        assert sorted(j.pending()) == [("a", 1, UPLOADED, "v1"), ("b", 2, UPLOADED, "")]
+        assert path.read_bytes() == intact
+        # New records go where the torn one was, and are read back
+        assert j.commit("c", UPLOADED, "v4") == 3
+        j = reopen(j)
+        assert j.get("c") == UPLOADED
+        j.close()
+
+
+def test_replay_stops_at_a_record_that_fails_its_crc(path):
+    records = [
+        pack_record(1, 0, UPLOADED, "a", "v1"),
+        pack_record(2, 0, UPLOADED, "b", "v2"),
+        pack_record(3, 0, UPLOADED, "c", "v3"),
+    ]
+    corrupt = bytearray(records[1])
+    corrupt[-1] ^= 1
+    path.write_bytes(records[0] + corrupt + records[2])
+    j = Journal(path)
+    assert j.pending() == [("a", 1, UPLOADED, "v1")]
+    assert path.read_bytes() == records[0]
+    assert j.append("d", UPLOADED, "v4") == 2
+    j.close()
+
+
+def test_unversioned_records_replay(path):
+    path.write_bytes(pack_record(1, 0, UPLOADED, "a") + pack_record(2, 0, DELETED, "b"))
+    j = Journal(path)
+    assert sorted(j.pending()) == [("a", 1, UPLOADED, ""), ("b", 2, DELETED, "")]
+    j.close()
+
+
+def test_compaction_keeps_live_entries(path, monkeypatch):
+    monkeypatch.setattr(journal, "COMPACT_MIN_DEAD_RECORDS", 10)
+    j = Journal(path)
+    written = 0
+    for i in range(20):
+        seq = j.append(f"key{i}", UPLOADED, f"v{i}")
+        written += len(pack_record(seq, 0, UPLOADED, f"key{i}", f"v{i}"))
+        if i % 4:
+            j.acknowledge(f"key{i}", seq)
+            written += len(pack_record(seq + 1, seq, journal.ACK, f"key{i}"))
+    j.commit("key0", DELETED, "v20")
+    live = sorted(j.pending())
+    assert len(live) == 5
+    # The flusher compacts after an fsync once enough records are dead
+    assert path.stat().st_size < written
+    j = reopen(j)
+    assert sorted(j.pending()) == live
+    assert j.append("new", UPLOADED, "v21") > max(seq for _, seq, _, _ in live)
+    j.close()
+
+
+def test_compacted_log_holds_only_live_records_in_order(path):
+    j = Journal(path)
+    for i in range(5):
+        j.acknowledge("dead", j.append("dead", UPLOADED, f"v{i}"))
+    j.append("b", UPLOADED, "v5")
+    j.append("a", DELETED, "v6")
+    j.commit("b", DELETED, "v7")
+    with j.cond:
+        j._compact()
+    assert path.read_bytes() == pack_record(12, 0, DELETED, "a", "v6") + pack_record(
+        13, 0, DELETED, "b", "v7"
+    )
+    j.close()
+
+
+def test_appends_after_compaction_are_replayed(path, monkeypatch):
+    monkeypatch.setattr(journal, "COMPACT_MIN_DEAD_RECORDS", 2)
+    j = Journal(path)
+    for i in range(3):
+        j.acknowledge("a", j.commit("a", UPLOADED, f"v{i}"))
+    j.commit("b", UPLOADED, "v3")
+    j.commit("c", UPLOADED, "v4")
+    j = reopen(j)
+    assert sorted(key for key, *_ in j.pending()) == ["b", "c"]
+    assert not os.path.exists(path.with_suffix(".compact"))
+    j.close()
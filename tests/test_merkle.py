@@ -0,0 +1,180 @@
+import hashlib
+
+import pytest
+
+import metadata
+from metadata import MetadataIndex, shard_of
+from object_format import ObjectHeader
+from segments import SegmentStore
+
+BUCKET = "bucket"
+LEAF_SIZE = 4
+
+
+@pytest.fixture(autouse=True)
+def small_leaves(monkeypatch):
+    monkeypatch.setattr(metadata, "MERKLE_LEAF_SIZE", LEAF_SIZE)
+
+
+@pytest.fixture
+def make_index(tmp_path):
+    indexes = []
+
+    def make_index() -> MetadataIndex:
+        parent = tmp_path / str(len(indexes))
+        (parent / "root").mkdir(parents=True)
+        index = MetadataIndex(
+            parent / "index.db",
+            parent / "root",
+            SegmentStore(parent / "segments", 1 << 20),
+            SegmentStore(parent / "chunks", 1 << 20),
+        )
+        index.put_bucket(BUCKET, 0.0)
+        indexes.append(index)
+        return index
+
+    yield make_index
+    for index in indexes:
+        index.close()
+
+
+def put(index: MetadataIndex, name: str, content: str = "v1"):
+    header = ObjectHeader(
+        plaintext_size=1, digest=hashlib.sha256(f"{name}/{content}".encode()).digest()
+    )
+    index.put_packed_object(BUCKET, name, header.pack(), 100, 0.0, (1, 0), content)
+
+
+def root(index: MetadataIndex, **scope) -> str:
+    return index.merkle_roots(**scope)[BUCKET]
+
+
+def differing_leaves(index, peer, node="") -> tuple[set[str], int]:
+    """Names listed in the leaves whose hashes differ, found by walking down
+    from the root as reconciliation does, and how many nodes it fetched."""
+    local, remote = index.merkle_node(BUCKET, node), peer.merkle_node(BUCKET, node)
+    if local["hash"] == remote["hash"]:
+        return set(), 1
+    if "children" not in remote:
+        return set(remote["objects"]) | set(local.get("objects", {})), 1
+    names, fetched = set(), 1
+    for child, child_hash in remote["children"].items():
+        if local.get("children", {}).get(child) != child_hash:
+            child_names, child_fetched = differing_leaves(index, peer, child)
+            names |= child_names
+            fetched += child_fetched
+    return names, fetched
+
+
+def test_same_objects_give_the_same_tree(make_index):
+    names = [f"object-{i}" for i in range(200)]
+    first, second = make_index(), make_index()
+    for name in names:
+        put(first, name)
+    for name in reversed(names):
+        put(second, name)
+    assert root(first) == root(second)
+    assert first.merkle_node(BUCKET) == second.merkle_node(BUCKET)
+
+
+def test_small_node_is_a_leaf_listing_its_objects(make_index):
+    index = make_index()
+    for i in range(LEAF_SIZE):
+        put(index, f"object-{i}")
+    index.delete_object(BUCKET, "gone", "v9")
+    node = index.merkle_node(BUCKET)
+    assert "children" not in node
+    assert sorted(node["objects"]) == [f"object-{i}" for i in range(LEAF_SIZE)]
+    assert node["objects"]["object-0"]["version"] == "v1"
+    assert node["tombstones"] == {"gone": "v9"}
+
+
+def test_node_splits_past_leaf_size(make_index):
+    index = make_index()
+    names = [f"object-{i}" for i in range(200)]
+    for name in names:
+        put(index, name)
+    node = index.merkle_node(BUCKET)
+    assert sorted(node["children"]) == [f"{digit:x}" for digit in range(16)]
+    # Every object is in exactly one leaf, under the node its shard names
+    found = []
+    pending = [""]
+    while pending:
+        node = index.merkle_node(BUCKET, pending.pop())
+        if "children" in node:
+            pending += node["children"]
+        else:
+            assert len(node["objects"]) <= LEAF_SIZE
+            for name in node["objects"]:
+                assert shard_of(name).startswith(node["node"])
+            found += node["objects"]
+    assert sorted(found) == sorted(names)
+
+
+def test_max_depth_node_is_a_leaf_however_many_objects(make_index, monkeypatch):
+    monkeypatch.setattr(metadata, "MERKLE_MAX_DEPTH", 1)
+    index = make_index()
+    names = [f"object-{i}" for i in range(200)]
+    for name in names:
+        put(index, name)
+    children = index.merkle_node(BUCKET)["children"]
+    leaves = [index.merkle_node(BUCKET, child) for child in children]
+    assert all("children" not in leaf for leaf in leaves)
+    assert sum(len(leaf["objects"]) for leaf in leaves) == len(names)
+
+
+def test_changes_update_cached_hashes(make_index):
+    index = make_index()
+    for i in range(100):
+        put(index, f"object-{i}")
+    before = root(index)
+    put(index, "object-7", "v2")
+    changed = root(index)
+    assert changed != before
+    put(index, "object-7", "v1")
+    assert root(index) == before
+    index.delete_object(BUCKET, "object-7", "v3")
+    assert root(index) not in (before, changed)
+    put(index, "object-7", "v1")
+    assert root(index) == before
+
+
+def test_diff_walks_only_to_the_leaves_that_differ(make_index):
+    index, peer = make_index(), make_index()
+    names = [f"object-{i}" for i in range(500)]
+    for name in names:
+        put(index, name)
+        put(peer, name, "v2" if name in ("object-3", "object-400") else "v1")
+    put(peer, "extra")
+    names_found, fetched = differing_leaves(index, peer)
+    assert {"object-3", "object-400", "extra"} <= names_found
+    assert len(names_found) <= 3 * LEAF_SIZE
+    assert fetched < 20
+
+
+def test_scoped_tree_covers_only_owned_objects(make_index):
+    index, owned_only = make_index(), make_index()
+    owns = lambda bucket, name: name.endswith(("0", "2", "4"))
+    for i in range(100):
+        put(index, f"object-{i}")
+        if owns(BUCKET, f"object-{i}"):
+            put(owned_only, f"object-{i}")
+    assert root(index, scope="even", owns=owns) == root(owned_only)
+    assert root(index, scope="even", owns=owns) != root(index)
+    # Writes drop the cached hashes of every scope
+    put(index, "object-200")
+    put(owned_only, "object-200")
+    assert root(index, scope="even", owns=owns) == root(owned_only)
+
+
+def test_dropping_scopes_forgets_hashes_of_old_placements(make_index):
+    index = make_index()
+    for i in range(100):
+        put(index, f"object-{i}")
+    owns_all = lambda bucket, name: True
+    owns_none = lambda bucket, name: False
+    assert root(index, scope="peer", owns=owns_all) == root(index)
+    # Placement changed, but no object did
+    assert root(index, scope="peer", owns=owns_none) == root(index)
+    index.drop_merkle_scopes()
+    assert root(index, scope="peer", owns=owns_none) == hashlib.sha256().hexdigest()
@@ -0,0 +1,208 @@
+import random
+
+import pytest
+
+from metadata import (
+    MetadataIndex,
+    decode_token,
+    encode_token,
+    listing_position,
+    merge_listings,
+)
+from object_format import ObjectHeader
+from segments import SegmentStore
+from versions import UNVERSIONED
+
+BUCKET = "bucket"
+KEYS = [
+    "a",
+    "dir/1",
+    "dir/2",
+    "dir/sub/3",
+    "dir/sub/4",
+    "dir/\uffff",
+    "dir/\U0010fffe/5",
+    "dir0",
+    "e/x",
+    "e/y/z",
+    "f",
+]
+
+
+@pytest.fixture
+def make_index(tmp_path):
+    indexes = []
+
+    def make_index(names: list[str]) -> MetadataIndex:
+        parent = tmp_path / str(len(indexes))
+        (parent / "root").mkdir(parents=True)
+        index = MetadataIndex(
+            parent / "index.db",
+            parent / "root",
+            SegmentStore(parent / "segments", 1 << 20),
+            SegmentStore(parent / "chunks", 1 << 20),
+        )
+        index.put_bucket(BUCKET, 0.0)
+        for offset, name in enumerate(names):
+            index.put_packed_object(
+                BUCKET,
+                name,
+                ObjectHeader(plaintext_size=1).pack(),
+                100,
+                0.0,
+                (1, offset),
+                UNVERSIONED,
+            )
+        indexes.append(index)
+        return index
+
+    yield make_index
+    for index in indexes:
+        index.close()
+
+
+def listed(page: dict) -> list[str]:
+    names = [item["name"] for item in page["contents"]] + page["common_prefixes"]
+    return sorted(names)
+
+
+def expected(names: list[str], prefix: str = "", delimiter: str = "") -> list[str]:
+    entries = set()
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        index = name.find(delimiter, len(prefix)) if delimiter else -1
+        entries.add(name[: index + len(delimiter)] if index >= 0 else name)
+    return sorted(entries)
+
+
+def paginate(list_page, max_keys: int, **query) -> list[str]:
+    """Every entry of a listing, page by page, checking each page's size."""
+    names = []
+    token = None
+    while True:
+        page = list_page(max_keys=max_keys, continuation_token=token, **query)
+        assert page["key_count"] == len(listed(page)) <= max_keys
+        names += listed(page)
+        if not page["is_truncated"]:
+            assert page["next_continuation_token"] is None
+            return names
+        token = page["next_continuation_token"]
+
+
+@pytest.mark.parametrize("max_keys", [1, 2, 3, 1000])
+@pytest.mark.parametrize(
+    "prefix, delimiter", [("", ""), ("", "/"), ("dir/", "/"), ("dir", ""), ("e/", "")]
+)
+def test_pages_cover_the_listing_once(make_index, max_keys, prefix, delimiter):
+    index = make_index(KEYS)
+    page = lambda **query: index.list_objects(BUCKET, **query)
+    names = paginate(page, max_keys, prefix=prefix, delimiter=delimiter)
+    assert names == expected(KEYS, prefix, delimiter)
+
+
+def test_delimiter_rolls_keys_up_into_common_prefixes(make_index):
+    index = make_index(KEYS)
+    page = index.list_objects(BUCKET, prefix="dir/", delimiter="/")
+    assert [item["name"] for item in page["contents"]] == [
+        "dir/1",
+        "dir/2",
+        "dir/\uffff",
+    ]
+    assert page["common_prefixes"] == ["dir/sub/", "dir/\U0010fffe/"]
+
+
+def test_token_after_a_common_prefix_skips_every_key_under_it(make_index):
+    index = make_index(KEYS)
+    page = index.list_objects(BUCKET, delimiter="/", max_keys=2)
+    assert listed(page) == ["a", "dir/"]
+    assert decode_token(page["next_continuation_token"]) == listing_position("dir/")
+    page = index.list_objects(
+        BUCKET, delimiter="/", continuation_token=page["next_continuation_token"]
+    )
+    assert listed(page) == ["dir0", "e/", "f"]
+
+
+def test_listing_position_sorts_after_keys_with_the_highest_code_points():
+    position = listing_position("dir/")
+    for name in ["dir/\uffff", "dir/\U0010fffe/5", "dir/\U0010fffe"]:
+        assert name < position
+        assert name.encode() < position.encode()
+    assert position < "dir0"
+
+
+def test_start_after(make_index):
+    index = make_index(KEYS)
+    page = index.list_objects(BUCKET, start_after="dir/sub/3")
+    assert listed(page) == expected(KEYS)[4:]
+
+
+def test_invalid_continuation_token(make_index):
+    index = make_index(KEYS)
+    with pytest.raises((ValueError, UnicodeDecodeError)):
+        index.list_objects(BUCKET, continuation_token=encode_token("a")[:-1] + "*")
+
+
+def page(names, next_after=None, common_prefixes=()):
+    return {
+        "name": BUCKET,
+        "prefix": "",
+        "delimiter": "",
+        "max_keys": 1000,
+        "key_count": len(names) + len(common_prefixes),
+        "is_truncated": next_after is not None,
+        "next_continuation_token": next_after and encode_token(next_after),
+        "contents": [{"name": name} for name in names],
+        "common_prefixes": list(common_prefixes),
+    }
+
+
+def test_merge_stops_at_a_truncated_page():
+    merged = merge_listings([page(["a", "c"], next_after="c"), page(["b", "d", "e"])])
+    assert listed(merged) == ["a", "b", "c"]
+    assert merged["is_truncated"]
+    assert decode_token(merged["next_continuation_token"]) == "c"
+
+
+def test_merge_truncates_to_max_keys():
+    merged = merge_listings([page(["a", "c"]), page(["b", "d"])], max_keys=3)
+    assert listed(merged) == ["a", "b", "c"]
+    assert merged["key_count"] == 3
+    assert decode_token(merged["next_continuation_token"]) == "c"
+
+
+def test_merge_continues_past_a_common_prefix():
+    merged = merge_listings(
+        [page(["a"], common_prefixes=["d/"]), page(["b", "e"])], max_keys=3
+    )
+    assert merged["common_prefixes"] == ["d/"]
+    assert [item["name"] for item in merged["contents"]] == ["a", "b"]
+    assert decode_token(merged["next_continuation_token"]) == listing_position("d/")
+
+
+def test_merge_drops_duplicates():
+    merged = merge_listings([page(["a", "b"]), page(["b", "c"])])
+    assert [item["name"] for item in merged["contents"]] == ["a", "b", "c"]
+    assert not merged["is_truncated"]
+
+
+@pytest.mark.parametrize("max_keys", [1, 2, 3, 5])
+@pytest.mark.parametrize("prefix, delimiter", [("", ""), ("", "/"), ("dir/", "/")])
+def test_merged_pages_from_servers_cover_the_listing_once(
+    make_index, max_keys, prefix, delimiter
+):
+    # Every key on one or two of three servers, so pages are truncated on
+    # some servers and not on others
+    rng = random.Random(max_keys)
+    holders = [set() for _ in range(3)]
+    for name in KEYS:
+        for server in rng.sample(range(3), rng.choice([1, 2])):
+            holders[server].add(name)
+    indexes = [make_index(sorted(names)) for names in holders]
+
+    def cluster_page(**query):
+        listings = [index.list_objects(BUCKET, **query) for index in indexes]
+        return merge_listings(listings, query["max_keys"])
+
+    names = paginate(cluster_page, max_keys, prefix=prefix, delimiter=delimiter)
+    assert names == expected(KEYS, prefix, delimiter)
@@ -0,0 +1,118 @@
+import threading
+
+from metrics import Callback, Counter, Histogram, Registry
+
+
+def samples(registry: Registry) -> dict[str, str]:
+    """Rendered samples by series, without the HELP and TYPE lines."""
+    series = {}
+    for line in registry.render().splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            series[name] = value
+    return series
+
+
+def test_counter_with_and_without_labels():
+    registry = Registry()
+    plain = Counter(registry, "plain_total", "Plain.")
+    labelled = Counter(registry, "labelled_total", "Labelled.", ("peer", "op"))
+    plain.inc()
+    plain.inc(2.5)
+    labelled.inc(1, "a", "put")
+    labelled.inc(3, "a", "put")
+    labelled.inc(1, "b", "delete")
+    assert samples(registry) == {
+        "plain_total": "3.5",
+        'labelled_total{peer="a",op="put"}': "4",
+        'labelled_total{peer="b",op="delete"}': "1",
+    }
+
+
+def test_help_and_type_lines():
+    registry = Registry()
+    Counter(registry, "requests_total", "Requests handled.").inc()
+    Histogram(registry, "latency_seconds", "Latency.", buckets=(1,)).observe(0.5)
+    lines = registry.render().splitlines()
+    assert lines[:2] == [
+        "# HELP requests_total Requests handled.",
+        "# TYPE requests_total counter",
+    ]
+    assert "# TYPE latency_seconds histogram" in lines
+    assert registry.render().endswith("\n")
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = Histogram(
+        registry, "latency_seconds", "Latency.", ("route",), buckets=(0.1, 1, 10)
+    )
+    for value in (0.05, 0.1, 0.5, 2, 20, 30):
+        histogram.observe(value, "/a")
+    assert samples(registry) == {
+        'latency_seconds_bucket{route="/a",le="0.1"}': "2",
+        'latency_seconds_bucket{route="/a",le="1"}': "3",
+        'latency_seconds_bucket{route="/a",le="10"}': "4",
+        'latency_seconds_bucket{route="/a",le="+Inf"}': "6",
+        'latency_seconds_sum{route="/a"}': "52.65",
+        'latency_seconds_count{route="/a"}': "6",
+    }
+
+
+def test_unlabelled_histogram_and_timer():
+    registry = Registry()
+    histogram = Histogram(registry, "task_seconds", "Tasks.", buckets=(60,))
+    with histogram.time():
+        pass
+    series = samples(registry)
+    assert series['task_seconds_bucket{le="60"}'] == "1"
+    assert series['task_seconds_bucket{le="+Inf"}'] == "1"
+    assert series["task_seconds_count"] == "1"
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = Counter(registry, "odd_total", "Odd labels.", ("value",))
+    counter.inc(1, 'back\\slash "quoted"\nnewline')
+    assert samples(registry) == {
+        'odd_total{value="back\\\\slash \\"quoted\\"\\nnewline"}': "1"
+    }
+
+
+def test_recordings_from_every_thread_are_summed():
+    registry = Registry()
+    counter = Counter(registry, "events_total", "Events.", ("kind",))
+    histogram = Histogram(registry, "sizes", "Sizes.", buckets=(10,))
+
+    def record():
+        for _ in range(1000):
+            counter.inc(1, "x")
+            histogram.observe(1)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    series = samples(registry)
+    assert series['events_total{kind="x"}'] == "8000"
+    assert series["sizes_count"] == "8000"
+
+
+def test_callbacks_are_read_at_render_time():
+    registry = Registry()
+    depth = {"value": 1}
+    Callback(registry, "queue_depth", "Queue depth.", lambda: depth["value"])
+    Callback(
+        registry,
+        "servers",
+        "Servers by state.",
+        lambda: {("alive",): 2, ("dead",): 1},
+        ("state",),
+    )
+    depth["value"] = 7
+    assert samples(registry) == {
+        "queue_depth": "7",
+        'servers{state="alive"}': "2",
+        'servers{state="dead"}': "1",
+    }
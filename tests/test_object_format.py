@@ -0,0 +1,175 @@
+import hashlib
+import io
+import os
+import random
+
+import pytest
+from Crypto.Cipher import AES
+
+from object_format import (
+    CODEC_ZLIB,
+    FRAME_HEADER,
+    FRAME_OVERHEAD,
+    HEADER,
+    LEGACY_NONCE_SIZE,
+    UNAUTHENTICATED_VERSION,
+    ObjectDecoder,
+    ObjectHeader,
+    ObjectWriter,
+    encrypt_frame,
+)
+
+KEY = bytes(range(32))
+FRAME_SIZE = 1024
+SIZES = [0, 1, FRAME_SIZE - 1, FRAME_SIZE, 3 * FRAME_SIZE + 5]
+
+
+def write_object(data: bytes, **kwargs) -> bytes:
+    file = io.BytesIO()
+    writer = ObjectWriter(file, KEY, frame_size=FRAME_SIZE, **kwargs)
+    # Uneven writes, so frames are cut across them
+    for start in range(0, len(data), 700):
+        writer.write(data[start : start + 700])
+    writer.close()
+    return file.getvalue()
+
+
+def split_frames(stored: bytes) -> tuple[bytes, list[bytes]]:
+    frames = []
+    offset = HEADER.size
+    while offset < len(stored):
+        (length,) = FRAME_HEADER.unpack_from(stored, offset)
+        frames.append(stored[offset : offset + FRAME_OVERHEAD + length])
+        offset += FRAME_OVERHEAD + length
+    return stored[: HEADER.size], frames
+
+
+def decode(stored: bytes, chunk_size: int = 333, **kwargs) -> bytes:
+    decoder = ObjectDecoder(KEY, **kwargs)
+    plaintext = b"".join(
+        decoder.feed(stored[start : start + chunk_size])
+        for start in range(0, len(stored), chunk_size)
+    )
+    decoder.finish()
+    return plaintext
+
+
+def compressible(size: int) -> bytes:
+    rng = random.Random(size)
+    return bytes(rng.choice(b"abcd ") for _ in range(size))
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip(size):
+    data = os.urandom(size)
+    stored = write_object(data)
+    assert ObjectHeader.unpack(stored).plaintext_size == size
+    assert decode(stored) == data
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_compressed_round_trip(size):
+    data = compressible(size)
+    stored = write_object(data, codec=CODEC_ZLIB)
+    if size > FRAME_SIZE:
+        assert ObjectHeader.unpack(stored).codec == CODEC_ZLIB
+        assert len(stored) < size
+    assert decode(stored) == data
+
+
+def test_random_data_is_stored_uncompressed():
+    data = os.urandom(3 * FRAME_SIZE)
+    stored = write_object(data, codec=CODEC_ZLIB)
+    assert ObjectHeader.unpack(stored).codec != CODEC_ZLIB
+    assert decode(stored) == data
+
+
+def test_range_of_frames_decodes_at_its_offset():
+    data = os.urandom(5 * FRAME_SIZE + 17)
+    header, frames = split_frames(write_object(data))
+    stored = header + b"".join(frames[2:4])
+    plaintext = decode(stored, frame_count=2, offset=2 * FRAME_SIZE)
+    assert plaintext == data[2 * FRAME_SIZE : 4 * FRAME_SIZE]
+
+
+def test_range_at_the_wrong_offset_is_rejected():
+    data = os.urandom(5 * FRAME_SIZE)
+    header, frames = split_frames(write_object(data))
+    with pytest.raises(ValueError):
+        decode(header + frames[2], frame_count=1, offset=3 * FRAME_SIZE)
+
+
+def test_reordered_frames_are_rejected():
+    data = os.urandom(3 * FRAME_SIZE)
+    header, frames = split_frames(write_object(data))
+    frames[0], frames[1] = frames[1], frames[0]
+    with pytest.raises(ValueError):
+        decode(header + b"".join(frames))
+
+
+def test_dropped_last_frame_is_rejected():
+    data = os.urandom(3 * FRAME_SIZE)
+    header, frames = split_frames(write_object(data))
+    with pytest.raises(ValueError, match="Truncated"):
+        decode(header + b"".join(frames[:-1]))
+
+
+@pytest.mark.parametrize("cut", [1, FRAME_OVERHEAD, FRAME_OVERHEAD + 10])
+def test_object_cut_inside_a_frame_is_rejected(cut):
+    stored = write_object(os.urandom(2 * FRAME_SIZE))
+    with pytest.raises(ValueError, match="Truncated"):
+        decode(stored[:-cut])
+
+
+def test_changed_plaintext_size_is_rejected():
+    data = os.urandom(2 * FRAME_SIZE)
+    stored = bytearray(write_object(data))
+    header = ObjectHeader.unpack(stored)
+    header.plaintext_size += FRAME_SIZE
+    stored[: HEADER.size] = header.pack()
+    with pytest.raises(ValueError):
+        decode(bytes(stored))
+
+
+def test_changed_codec_is_rejected():
+    data = compressible(3 * FRAME_SIZE)
+    stored = bytearray(write_object(data))
+    header = ObjectHeader.unpack(stored)
+    header.codec = CODEC_ZLIB
+    stored[: HEADER.size] = header.pack()
+    with pytest.raises(ValueError):
+        decode(bytes(stored))
+
+
+def test_version_2_object_decodes():
+    data = os.urandom(2 * FRAME_SIZE + 3)
+    header = ObjectHeader(
+        frame_size=FRAME_SIZE,
+        plaintext_size=len(data),
+        digest=hashlib.sha256(data).digest(),
+        version=UNAUTHENTICATED_VERSION,
+    )
+    frames = [
+        encrypt_frame(data[start : start + FRAME_SIZE], KEY)
+        for start in range(0, len(data), FRAME_SIZE)
+    ]
+    assert decode(header.pack() + b"".join(frames)) == data
+
+
+def version_1_object(data: bytes) -> bytes:
+    nonce = os.urandom(LEGACY_NONCE_SIZE)
+    cipher = AES.new(KEY, AES.MODE_GCM, nonce=nonce)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return tag + nonce + ciphertext
+
+
+def test_version_1_object_decodes():
+    data = os.urandom(2 * FRAME_SIZE + 3)
+    assert decode(version_1_object(data)) == data
+
+
+def test_tampered_version_1_object_is_rejected():
+    stored = bytearray(version_1_object(os.urandom(100)))
+    stored[-1] ^= 1
+    with pytest.raises(ValueError):
+        decode(bytes(stored))
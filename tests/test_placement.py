@@ -0,0 +1,78 @@
+import pytest
+
+from placement import HashRing, placement_key, server_id
+
+SERVERS = [server_id("10.0.0.1", 8000 + i) for i in range(5)]
+KEYS = [placement_key("bucket", f"object-{i}") for i in range(5000)]
+
+
+def test_owners_are_distinct_servers():
+    ring = HashRing(SERVERS, replication_factor=3)
+    for key in KEYS[:500]:
+        owners = ring.owners(key)
+        assert len(owners) == len(set(owners)) == 3
+        assert set(owners) <= set(SERVERS)
+
+
+def test_replication_factor_is_capped_by_the_servers():
+    ring = HashRing(SERVERS[:2], replication_factor=3)
+    assert sorted(ring.owners(KEYS[0])) == sorted(SERVERS[:2])
+    assert HashRing([], replication_factor=3).owners(KEYS[0]) == []
+
+
+def test_placement_does_not_depend_on_server_order():
+    ring = HashRing(SERVERS)
+    shuffled = HashRing(list(reversed(SERVERS)) + SERVERS[:1])
+    assert ring == shuffled
+    assert all(ring.owners(key) == shuffled.owners(key) for key in KEYS)
+
+
+def test_count_extends_the_owner_list():
+    ring = HashRing(SERVERS, replication_factor=2)
+    for key in KEYS[:500]:
+        assert ring.owners(key, 4)[:2] == ring.owners(key)
+
+
+def test_primaries_are_spread_evenly():
+    ring = HashRing(SERVERS)
+    primaries = [ring.owners(key, 1)[0] for key in KEYS]
+    fair = len(KEYS) / len(SERVERS)
+    for server in SERVERS:
+        assert 0.7 * fair < primaries.count(server) < 1.3 * fair
+
+
+@pytest.mark.parametrize("replication_factor", [1, 2, 3])
+def test_adding_a_server_only_moves_keys_to_it(replication_factor):
+    before = HashRing(SERVERS[:4], replication_factor)
+    after = HashRing(SERVERS, replication_factor)
+    new = SERVERS[4]
+    moved = 0
+    for key in KEYS:
+        old_owners, new_owners = before.owners(key), after.owners(key)
+        if new_owners == old_owners:
+            continue
+        moved += 1
+        # The new server takes one place; the others keep their order
+        assert new in new_owners
+        assert [s for s in new_owners if s != new] == old_owners[:-1]
+    # About replication_factor / 5 of the keys gain the new server
+    assert moved < 1.3 * len(KEYS) * replication_factor / len(SERVERS)
+
+
+@pytest.mark.parametrize("replication_factor", [1, 2, 3])
+def test_removing_a_server_only_moves_its_keys(replication_factor):
+    before = HashRing(SERVERS, replication_factor)
+    after = HashRing(SERVERS[1:], replication_factor)
+    gone = SERVERS[0]
+    for key in KEYS:
+        old_owners, new_owners = before.owners(key), after.owners(key)
+        if gone not in old_owners:
+            assert new_owners == old_owners
+        else:
+            survivors = [s for s in old_owners if s != gone]
+            assert new_owners[: len(survivors)] == survivors
+
+
+def test_placement_key_ignores_the_stored_suffix():
+    assert placement_key("b", "photo.jpg.enc") == placement_key("b", "photo.jpg")
+    assert placement_key("b", "x") != placement_key("c", "x")
@@ -0,0 +1,135 @@
+import pytest
+
+from segments import SegmentStore, pack_record
+
+BUCKET = "bucket"
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return tmp_path / "segments"
+
+
+def live_objects(store: SegmentStore) -> dict[str, bytes]:
+    """What a rebuild of the index would find: the latest record of each key,
+    unless it is a tombstone."""
+    latest = {}
+    for record in store.scan():
+        current = latest.get(record.name)
+        if current is None or record.created_at >= current.created_at:
+            latest[record.name] = record
+    return {
+        name: record.data for name, record in latest.items() if not record.is_tombstone
+    }
+
+
+def test_append_and_read(directory):
+    store = SegmentStore(directory, 1 << 20)
+    first = store.append(BUCKET, "a", b"alpha", 1.0)
+    second = store.append(BUCKET, "b", b"beta", 2.0)
+    assert first == (1, 0)
+    assert second == (1, len(pack_record(0, 1.0, BUCKET, "a", b"alpha")))
+    assert store.read(*first, BUCKET, "a", 5) == b"alpha"
+    assert store.read(*second, BUCKET, "b", 4) == b"beta"
+    # A record that isn't the one asked for is not returned
+    assert store.read(*first, BUCKET, "b", 5) is None
+    assert store.read(*first, BUCKET, "a", 4) is None
+    assert store.read(2, 0, BUCKET, "a", 5) is None
+    store.close()
+
+
+def test_segments_roll_at_max_size(directory):
+    record_size = len(pack_record(0, 0.0, BUCKET, "k0", bytes(100)))
+    store = SegmentStore(directory, 2 * record_size)
+    locations = [store.append(BUCKET, f"k{i}", bytes(100), float(i)) for i in range(5)]
+    assert [segment for segment, _ in locations] == [1, 1, 2, 2, 3]
+    assert store.sealed_segments() == {1: 2 * record_size, 2: 2 * record_size}
+    assert store.total_size() == 5 * record_size
+    store.close()
+
+
+def test_delete_appends_a_tombstone(directory):
+    store = SegmentStore(directory, 1 << 20)
+    store.append(BUCKET, "a", b"alpha", 1.0)
+    store.delete(BUCKET, "a")
+    records = list(store.scan())
+    assert [record.is_tombstone for record in records] == [False, True]
+    assert store.read(1, records[1].offset, BUCKET, "a", 0) is None
+    assert live_objects(store) == {}
+    store.close()
+
+
+def test_reopening_starts_a_new_segment_after_a_torn_record(directory):
+    store = SegmentStore(directory, 1 << 20)
+    store.append(BUCKET, "a", b"alpha", 1.0)
+    store.close()
+    torn = pack_record(0, 2.0, BUCKET, "b", b"beta")
+    with open(store.segment_path(1), "ab") as f:
+        f.write(torn[:-1])
+
+    store = SegmentStore(directory, 1 << 20)
+    assert [record.name for record in store.scan()] == ["a"]
+    assert store.append(BUCKET, "b", b"beta", 2.0) == (2, 0)
+    assert live_objects(store) == {"a": b"alpha", "b": b"beta"}
+    store.close()
+
+
+def test_compaction_moves_live_records(directory):
+    store = SegmentStore(directory, 1 << 20)
+    a = store.append(BUCKET, "a", b"old", 1.0)
+    b = store.append(BUCKET, "b", b"beta", 2.0)
+    store.append(BUCKET, "a", b"new", 3.0)
+    store.close()
+    store = SegmentStore(directory, 1 << 20)
+    store.append(BUCKET, "c", b"gamma", 4.0)
+
+    moved = {}
+    store.compact(1, {b[1]}, lambda bucket, name, old, new: moved.update({name: new}))
+    assert not store.segment_path(1).exists()
+    assert 1 not in store.sizes
+    assert list(moved) == ["b"]
+    assert moved["b"][0] == 2
+    assert store.read(*moved["b"], BUCKET, "b", 4) == b"beta"
+    assert store.read(*a, BUCKET, "a", 3) is None
+    store.close()
+
+    store = SegmentStore(directory, 1 << 20)
+    assert live_objects(store) == {"b": b"beta", "c": b"gamma"}
+    assert store.read(*moved["b"], BUCKET, "b", 4) == b"beta"
+    store.close()
+
+
+def test_copies_keep_their_time_and_never_shadow_newer_writes(directory):
+    store = SegmentStore(directory, 1 << 20)
+    old = store.append(BUCKET, "a", b"old", 1.0)
+    store.close()
+    store = SegmentStore(directory, 1 << 20)
+    store.append(BUCKET, "a", b"new", 2.0)
+    # A compaction that still counts the old record as live copies it
+    # after the newer one
+    store.compact(1, {old[1]}, lambda *args: None)
+    assert live_objects(store) == {"a": b"new"}
+    store.close()
+
+
+def test_tombstones_are_kept_while_older_segments_exist(directory):
+    store = SegmentStore(directory, 1 << 20)
+    store.append(BUCKET, "a", b"alpha", 1.0)
+    store.close()
+    store = SegmentStore(directory, 1 << 20)
+    store.delete(BUCKET, "a")
+    store.close()
+    store = SegmentStore(directory, 1 << 20)
+
+    # Segment 1 still holds what the tombstone deleted
+    store.compact(2, set(), lambda *args: None)
+    assert live_objects(store) == {}
+    assert [record.segment for record in store.scan()] == [1, 3]
+
+    store.compact(1, set(), lambda *args: None)
+    store.close()
+    store = SegmentStore(directory, 1 << 20)
+    # Nothing older is left for the tombstone to shadow
+    store.compact(3, set(), lambda *args: None)
+    assert list(store.scan()) == []
+    store.close()
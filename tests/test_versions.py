@@ -0,0 +1,126 @@
+import pytest
+
+import versions
+from versions import (
+    MAX_COUNTER,
+    UNVERSIONED,
+    HybridLogicalClock,
+    format_version,
+    load_origin_id,
+    parse_version,
+    supersedes,
+)
+
+
+@pytest.fixture
+def wall_time(monkeypatch):
+    """Set the wall-clock milliseconds the clocks read."""
+    now = {"ms": 1_700_000_000_000}
+    monkeypatch.setattr(versions.time, "time_ns", lambda: now["ms"] * 1_000_000)
+    return now
+
+
+def test_format_and_parse_round_trip():
+    version = format_version(0x18B_CFE5_6800, 7, "abc")
+    assert version == "018bcfe568000007-abc"
+    assert parse_version(version) == (0x18B_CFE5_6800, 7)
+
+
+@pytest.mark.parametrize(
+    "version", ["", "018bcfe568000007", "018bcfe56800007-abc", "018BCFE568000007-abc"]
+)
+def test_malformed_versions_are_rejected(version):
+    with pytest.raises(ValueError):
+        parse_version(version)
+
+
+def test_versions_compare_in_clock_order_then_origin():
+    ordered = [
+        UNVERSIONED,
+        format_version(0xFFF, MAX_COUNTER, "f"),
+        format_version(0x1000, 0, "0"),
+        format_version(0x1000, 1, "0"),
+        format_version(0x1000, 1, "1"),
+        format_version(0x1001, 0, "0"),
+    ]
+    assert sorted(reversed(ordered)) == ordered
+
+
+def test_versions_increase_within_a_millisecond(wall_time):
+    clock = HybridLogicalClock("a")
+    made = [clock.now() for _ in range(100)]
+    assert made == sorted(set(made))
+    assert parse_version(made[-1]) == (wall_time["ms"], 99)
+
+
+def test_clock_never_goes_backwards(wall_time):
+    clock = HybridLogicalClock("a")
+    before = clock.now()
+    wall_time["ms"] -= 5000
+    assert clock.now() > before
+
+
+def test_counter_overflow_borrows_the_next_millisecond(wall_time):
+    clock = HybridLogicalClock("a")
+    clock.update(format_version(wall_time["ms"], MAX_COUNTER, "b"))
+    assert parse_version(clock.now()) == (wall_time["ms"] + 1, 0)
+
+
+def test_update_moves_the_clock_past_a_peer_version(wall_time):
+    clock = HybridLogicalClock("a")
+    ahead = format_version(wall_time["ms"] + 60_000, 3, "b")
+    clock.update(ahead)
+    version = clock.now()
+    assert version > ahead
+    assert parse_version(version) == (wall_time["ms"] + 60_000, 4)
+
+
+def test_update_with_an_older_version_leaves_the_clock(wall_time):
+    clock = HybridLogicalClock("a")
+    clock.now()
+    clock.update(format_version(wall_time["ms"] - 1, 9, "b"))
+    clock.update(UNVERSIONED)
+    assert parse_version(clock.now()) == (wall_time["ms"], 1)
+
+
+def test_write_after_a_seen_write_is_newer_despite_clock_skew(wall_time):
+    fast, slow = HybridLogicalClock("fa"), HybridLogicalClock("5e")
+    wall_time["ms"] += 10_000
+    first = fast.now()
+    wall_time["ms"] -= 10_000
+    assert slow.receive(first) == first
+    assert slow.now() > first
+
+
+def test_receive_versions_changes_from_peers_without_one(wall_time):
+    clock = HybridLogicalClock("a")
+    first = clock.receive(None)
+    second = clock.receive(None)
+    assert first < second
+    assert second.endswith("-a")
+
+
+def test_receive_rejects_malformed_versions():
+    with pytest.raises(ValueError):
+        HybridLogicalClock("a").receive("not a version")
+
+
+def test_supersedes():
+    old = format_version(1000, 0, "a")
+    new = format_version(1000, 1, "a")
+    assert supersedes(old, None)
+    assert supersedes(new, old)
+    assert not supersedes(old, new)
+    assert not supersedes(old, old)
+    assert supersedes(old, UNVERSIONED)
+    assert not supersedes(UNVERSIONED, old)
+    # Changes from before versions apply in arrival order
+    assert supersedes(UNVERSIONED, UNVERSIONED)
+
+
+def test_origin_id_is_made_up_once(tmp_path):
+    path = tmp_path / "origin_id"
+    origin = load_origin_id(path)
+    assert origin == load_origin_id(path)
+    path.write_text("not hex\n")
+    assert load_origin_id(path) not in (origin, "not hex")